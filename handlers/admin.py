@@ -1,10 +1,30 @@
-from aiogram import F, Router
-from aiogram.types import Message
+import time
 
-from storage.credits import add_credits, ensure_user, get_balance
+from aiogram import F, Router
+from aiogram.types import CallbackQuery, Message
+
+from services import resilience
+from services.admission import ADMISSION
+from services.backend_router import ROUTER
+from services.job_worker import WORKERS
+from services.kie_keys import KEYS
+from services.payments_reconciler import RECONCILER
+from services.video_pipeline import FLIGHT
+from storage import jobs, result_cache
+from storage.credits import (
+    DB,
+    add_credits,
+    ensure_user,
+    get_balance,
+    pending_payments,
+    spent_in_window,
+    user_history,
+)
 from utils.config import cfg
+from utils.keyboards import more_keyboard
 
 router = Router()
+_PAGE = 10
 
 
 def _is_admin(uid: int) -> bool:
@@ -66,8 +86,170 @@ async def cmd_grant(message: Message):
         )
         return
 
-    ensure_user(target_id, 0)
-    add_credits(target_id, amount, reason=f"admin:{admin_id}")
+    await ensure_user(target_id, 0)
+    await add_credits(target_id, amount, reason=f"admin:{admin_id}")
+    await message.answer(
+        f"Начислено {amount} кредитов пользователю {target_id}. Баланс: {await get_balance(target_id)}."
+    )
+
+
+@router.message(F.text == "/cachestats")
+async def cmd_cachestats(message: Message):
+    if not _is_admin(message.from_user.id):
+        await message.answer("Команда доступна только администраторам.")
+        return
+    st = result_cache.stats()
+    fl = FLIGHT.stats()
+    db = DB.stats()
+    hit_rate = f"{st['hit_rate']:.1%}" if st["hit_rate"] is not None else "—"
+    await message.answer(
+        "Кэш результатов:\n"
+        f"• записей: {st['entries']} ({st['bytes'] / 1024 / 1024:.1f} МБ)\n"
+        f"• hit/miss: {st['hits']}/{st['misses']} (hit rate {hit_rate}), "
+        f"из них по pHash: {st['phash_hits']}\n"
+        f"• сохранено: {st['stores']}, вытеснено: {st['evictions']}\n"
+        f"Склейка дублей: в работе {fl['in_flight']}, задач {fl['started']}, "
+        f"присоединено {fl['coalesced']}\n"
+        f"Журнал кредитов: записей {db['writes']}, коммитов {db['commits']}, "
+        f"в очереди {db['queued']}"
+    )
+
+
+def _fmt_ts(ts: int) -> str:
+    return time.strftime("%d.%m %H:%M", time.localtime(ts))
+
+
+async def _history_page(target_id: int, before: tuple[int, int] | None) -> tuple[str, str | None]:
+    """Текст страницы истории и callback_data следующей страницы (или None)."""
+    rows = await user_history(target_id, before=before, limit=_PAGE)
+    lines = [
+        f"{_fmt_ts(r['created_at'])}  {r['amount']:+d}  {r['type']}"
+        + (f" ({r['meta']})" if r["meta"] else "")
+        for r in rows
+    ]
+    if before is None:
+        now = int(time.time())
+        day = await spent_in_window(now - 86400, user_id=target_id)
+        month = await spent_in_window(now - 30 * 86400, user_id=target_id)
+        head = (
+            f"История {target_id}. Баланс: {await get_balance(target_id)}, "
+            f"потрачено за сутки: {day}, за 30 дней: {month}\n"
+        )
+    else:
+        head = ""
+    body = "\n".join(lines) if lines else "Операций больше нет."
+    last = rows[-1] if rows else None
+    more = f"hist:{target_id}:{last['created_at']}:{last['id']}" if len(rows) == _PAGE else None
+    return head + body, more
+
+
+@router.message(F.text.regexp(r"^/history(\s+\d+)?$"))
+async def cmd_history(message: Message):
+    uid = message.from_user.id
+    args = (message.text or "").split()
+    target_id = uid
+    if len(args) == 2:
+        if not _is_admin(uid):
+            await message.answer("Чужую историю могут смотреть только администраторы.")
+            return
+        target_id = int(args[1])
+    text, more = await _history_page(target_id, None)
+    await message.answer(text, reply_markup=more_keyboard(more) if more else None)
+
+
+@router.callback_query(F.data.startswith("hist:"))
+async def on_history_more(callback: CallbackQuery):
+    parts = callback.data.split(":")
+    if len(parts) != 4:
+        # why: кнопка из старого сообщения (курсор был только id) — начни заново
+        await callback.answer("Кнопка устарела, запроси /history ещё раз.", show_alert=True)
+        return
+    target_id, before = int(parts[1]), (int(parts[2]), int(parts[3]))
+    if target_id != callback.from_user.id and not _is_admin(callback.from_user.id):
+        await callback.answer("Недоступно.", show_alert=True)
+        return
+    text, more = await _history_page(target_id, before)
+    await callback.message.answer(text, reply_markup=more_keyboard(more) if more else None)
+    await callback.answer()
+
+
+async def _pending_page(after_id: int) -> tuple[str, str | None]:
+    rows = await pending_payments(after_id=after_id, limit=_PAGE)
+    lines = [
+        f"{_fmt_ts(r['created_at'])}  {r['provider_id']}  user {r['user_id']}  "
+        f"{r['credits']} кр. / {r['amount'] / 100:.2f} {r['currency']}  [{r['status']}]"
+        for r in rows
+    ]
+    body = "\n".join(lines) if lines else "Неприменённых платежей нет."
+    more = f"pend:{rows[-1]['id']}" if len(rows) == _PAGE else None
+    return body, more
+
+
+@router.message(F.text == "/pending")
+async def cmd_pending(message: Message):
+    if not _is_admin(message.from_user.id):
+        await message.answer("Команда доступна только администраторам.")
+        return
+    text, more = await _pending_page(0)
+    rec = RECONCILER.stats()
+    last = ", ".join(f"{k}: {v}" for k, v in rec["last_run"].items()) or "ещё не было"
+    text = (
+        f"Сверка: запросов статуса {rec['checks']}, начислено {rec['settled']}, "
+        f"ошибок {rec['errors']}; последний проход — {last}\n\n" + text
+    )
+    await message.answer(text, reply_markup=more_keyboard(more) if more else None)
+
+
+@router.callback_query(F.data.startswith("pend:"))
+async def on_pending_more(callback: CallbackQuery):
+    if not _is_admin(callback.from_user.id):
+        await callback.answer("Недоступно.", show_alert=True)
+        return
+    text, more = await _pending_page(int(callback.data.split(":")[1]))
+    await callback.message.answer(text, reply_markup=more_keyboard(more) if more else None)
+    await callback.answer()
+
+
+@router.message(F.text == "/queue")
+async def cmd_queue(message: Message):
+    if not _is_admin(message.from_user.id):
+        await message.answer("Команда доступна только администраторам.")
+        return
+    st = WORKERS.stats()
+    adm = ADMISSION.stats()
+    providers = "\n".join(
+        f"  {name}: {ep['state']}"
+        + (f" ещё {ep['retry_after']} с" if ep["retry_after"] else "")
+        + f", запросов {ep['calls']}, отказов {ep['rejected']}"
+        for name, ep in resilience.stats().items()
+    )
+    routes = "\n".join(
+        f"  {name}: p95 {r['p95']} с, ошибок {r['errors']:.0%}, замеров {r['samples']}, "
+        f"стоимость {'—' if r['cost'] is None else r['cost']}"
+        for name, r in ROUTER.stats().items()
+    )
+    keys = "\n".join(
+        f"  {k['key']}: задач {k['inflight']}"
+        + (f", карантин {k['quarantine']} с ({k['reason']})" if k["quarantine"] else "")
+        for k in KEYS.stats()
+    )
+    states = await jobs.stats()
+    by_class = ", ".join(f"{k}: {v}" for k, v in sorted(st.get("by_class", {}).items())) or "—"
+    p50 = st.get("wait_p50")
+    p95 = st.get("wait_p95")
     await message.answer(
-        f"Начислено {amount} кредитов пользователю {target_id}. Баланс: {get_balance(target_id)}."
+        "Очередь генераций:\n"
+        f"• в очереди: {st.get('queued', 0)} ({by_class}), пользователей: "
+        f"{st.get('users_waiting', 0)}\n"
+        f"• выполняется: {st.get('running', 0)}\n"
+        f"• ожидание: старейшая {st.get('oldest_wait', 0)} с, "
+        f"p50 {'—' if p50 is None else p50} с, p95 {'—' if p95 is None else p95} с\n"
+        f"• допуск: принято {adm['accepted']}, отклонено {adm['rejected']}; "
+        f"длительность KIE {adm['kie_latency']} с, TNB {adm['tnb_latency']} с "
+        f"(сейчас TNB: {adm['inline']})\n"
+        + "• в БД: "
+        + ", ".join(f"{k}: {v}" for k, v in sorted(states.items()))
+        + (f"\n• провайдеры:\n{providers}" if providers else "")
+        + (f"\n• ключи KIE:\n{keys}" if keys else "")
+        + f"\n• роутер правок:\n{routes}"
     )
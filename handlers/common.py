@@ -1,23 +1,36 @@
 # path: handlers/common.py
 import logging
+import time
+from collections.abc import Awaitable
 from pathlib import Path
 
-from aiogram import F, Router
-from aiogram.types import CallbackQuery, FSInputFile, Message
+from aiogram import Bot, F, Router
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import (
+    BufferedInputFile,
+    CallbackQuery,
+    FSInputFile,
+    InputFile,
+    Message,
+    PhotoSize,
+)
 
-from services.payments_yookassa import create_payment, get_payment_status, is_enabled as yk_enabled
+from handlers.middlewares import UserContext
+from services import backend_router
+from services.admission import ADMISSION, Verdict
+from services.deadline import Deadline
+from services.job_worker import WORKERS
+from services.payments_reconciler import PAID, RECONCILER
+from services.payments_yookassa import create_payment, is_enabled as yk_enabled
 from services.presets import build_presets
-from services.video_pipeline import (
-    run_kie_from_telegram_file,  # KIE нужен всегда
-    run_mock_pipeline,
-)
+from services.resilience import ProviderUnavailable
+from services.video_pipeline import ResultFile, download_result, run_mock_pipeline
 from storage.credits import (
-    add_credits,
-    ensure_user,
-    get_balance,
-    mark_payment_applied,
+    commit_hold,
+    get_payment,
     register_payment,
-    set_payment_status,
+    release_hold,
+    reserve_credits,
 )
 from storage.files import TEMP_DIR, ensure_dirs
 from utils.config import cfg
@@ -25,7 +38,8 @@ from utils.keyboards import buy_keyboard, main_menu_kb, scenes_keyboard
 
 log = logging.getLogger("common")
 router = Router()
-GLOBAL_LAST_PHOTO: dict[int, str] = {}
+# user_id -> (tg_file_path, file_unique_id, file_id) последнего фото без подписи
+GLOBAL_LAST_PHOTO: dict[int, tuple[str, str, str]] = {}
 
 
 def _clip(text: str, limit: int = 220) -> str:
@@ -33,13 +47,93 @@ def _clip(text: str, limit: int = 220) -> str:
     return t if len(t) <= limit else t[: limit - 1] + "…"
 
 
+def _as_input_file(res: ResultFile) -> InputFile | str:
+    """ResultFile -> то, что принимает answer_photo (файл, буфер или URL)."""
+    if res.path is not None:
+        return FSInputFile(str(res.path))
+    if res.data is not None:
+        return BufferedInputFile(res.data, filename=res.filename)
+    return res.url
+
+
+def _result_cost(res: ResultFile) -> int:
+    """Сколько кредитов списать за результат: попадание в кэш — по CACHE_HIT_COST."""
+    return cfg.cache_hit_cost if res.cached else 1
+
+
+async def _timed(backend: str, aw: Awaitable[ResultFile]) -> ResultFile:
+    """
+    Генерация у backend с учётом длительности в ADMISSION (оценка ETA очереди).
+    Попадание в кэш результатов провайдера не занимало — его не учитываем.
+    """
+    started = time.monotonic()
+    try:
+        result = await aw
+    except Exception:
+        ADMISSION.observe(backend, time.monotonic() - started)
+        raise
+    if not result.cached:
+        ADMISSION.observe(backend, time.monotonic() - started)
+    return result
+
+
+def _unit_cost() -> int:
+    """Сколько резервировать под один кадр: максимум из цены генерации и попадания в кэш."""
+    return max(1, cfg.cache_hit_cost)
+
+
+def _upload_timeout(deadline: Deadline) -> int:
+    """Таймаут отправки результата в Telegram: остаток бюджета, но не меньше 30 с."""
+    # why: результат уже оплачен у провайдера — не теряем его из-за почти истёкшего бюджета
+    return int(max(30.0, deadline.timeout(120)))
+
+
+async def _send_result(
+    bot: Bot, chat_id: int, result: ResultFile, deadline: Deadline, caption: str | None
+) -> None:
+    """
+    Отправляет результат в чат. URL провайдера (RESULT_DELIVERY=url), который Telegram
+    не смог забрать сам (не публичный, больше 5 МБ для фото по URL), — ещё раз из памяти.
+    """
+    try:
+        await bot.send_photo(
+            chat_id,
+            photo=_as_input_file(result),
+            caption=caption,
+            request_timeout=_upload_timeout(deadline),
+        )
+        return
+    except TelegramBadRequest as e:
+        if result.url is None:
+            raise
+        log.warning("Telegram не забрал результат по URL (%s) — отправляем файлом", e)
+    # why: результат уже оплачен у провайдера — на докачку тот же запас, что и на отправку
+    result = await download_result(result, Deadline.after(_upload_timeout(deadline)))
+    await bot.send_photo(
+        chat_id,
+        photo=_as_input_file(result),
+        caption=caption,
+        request_timeout=_upload_timeout(deadline),
+    )
+
+
+def _busy_text(verdict: Verdict) -> str:
+    return f"Сервис сейчас перегружен (ожидание {verdict.text()}). Попробуй через несколько минут."
+
+
+def _queue_text(verdict: Verdict) -> str:
+    """Пояснение к принятой задаче, если очередь длинная; иначе пусто."""
+    return (
+        f"\nОчередь большая, результат примерно через {verdict.text()}." if verdict.notice else ""
+    )
+
+
 def _chunk_scenes(presets: list[tuple[str, str, str]]) -> list[list[tuple[str, str, str]]]:
     return [presets[i : i + 3] for i in range(0, len(presets), 3)]
 
 
 @router.message(F.text == "/start")
-async def cmd_start(message: Message):
-    is_new, balance = ensure_user(message.from_user.id, cfg.welcome_credits)
+async def cmd_start(message: Message, user: UserContext):
     welcome = (
         "👋 Привет! Я помогу быстро собрать набор кадров по сценам.\n\n"
         "1) Пришли одно фото.\n"
@@ -48,10 +142,10 @@ async def cmd_start(message: Message):
     )
     bonus = (
         f"\n\n🎁 Новым пользователям начисляем {cfg.welcome_credits} бонусных кредитов."
-        if is_new and cfg.welcome_credits > 0
+        if user.is_new and cfg.welcome_credits > 0
         else ""
     )
-    tail = f"\n\nТвой баланс: {balance} кредитов."
+    tail = f"\n\nТвой баланс: {user.balance} кредитов."
     await message.answer(welcome + bonus + tail, reply_markup=main_menu_kb())
 
 
@@ -62,20 +156,23 @@ async def cmd_help(message: Message):
         "• Фото без подписи — выберешь сцену (3 кадра).\n"
         "• Фото с подписью — 1 кадр по промпту.\n"
         "• /balance — баланс\n"
+        "• /history — история операций\n"
         "• /buy — купить кредиты\n"
         "• 1 кадр = 1 кредит\n"
     )
     if message.from_user.id in cfg.admin_ids:
         txt += (
             "\nАдмин:\n• /grant <user_id> <amount> — начислить кредиты (или ответьте на сообщение пользователя: "
-            "`/grant <amount>`)."
+            "`/grant <amount>`).\n"
+            "• /history <user_id> — история пользователя\n• /pending — неприменённые платежи\n"
+            "• /queue — очередь генераций"
         )
     await message.answer(txt)
 
 
 @router.message(F.text == "/balance")
-async def cmd_balance(message: Message):
-    await message.answer(f"Баланс: {get_balance(message.from_user.id)} кредитов.")
+async def cmd_balance(message: Message, user: UserContext):
+    await message.answer(f"Баланс: {user.balance} кредитов.")
 
 
 @router.message(F.text == "/buy")
@@ -102,9 +199,9 @@ async def cmd_ykdiag(message: Message):
 
 
 @router.callback_query(F.data == "menu:balance")
-async def menu_balance(callback: CallbackQuery):
+async def menu_balance(callback: CallbackQuery, user: UserContext):
     await callback.answer()
-    await callback.message.answer(f"Баланс: {get_balance(callback.from_user.id)} кредитов.")
+    await callback.message.answer(f"Баланс: {user.balance} кредитов.")
 
 
 @router.callback_query(F.data == "menu:buy")
@@ -136,7 +233,7 @@ async def on_buy_pack(callback: CallbackQuery):
         await callback.message.answer(f"Ошибка платёжного провайдера: {str(e)[:400]}")
         return
 
-    register_payment(pid, callback.from_user.id, credits, rub * 100, cfg.currency)
+    await register_payment(pid, callback.from_user.id, credits, rub * 100, cfg.currency)
     from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
     kb = InlineKeyboardMarkup(
@@ -146,7 +243,8 @@ async def on_buy_pack(callback: CallbackQuery):
         ]
     )
     await callback.message.answer(
-        f"Пакет: {credits} кредитов за {rub}₽.\nПосле оплаты нажми «Проверить оплату».",
+        f"Пакет: {credits} кредитов за {rub}₽.\n"
+        "После оплаты кредиты начислятся автоматически (или нажми «Проверить оплату»).",
         reply_markup=kb,
     )
     await callback.answer()
@@ -155,46 +253,150 @@ async def on_buy_pack(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("buy:check:"))
 async def on_buy_check(callback: CallbackQuery):
     pid = callback.data.split(":")[-1]
+    payment = await get_payment(pid)
+    if payment is None or payment["user_id"] != callback.from_user.id:
+        await callback.answer("Платёж не найден.", show_alert=True)
+        return
+    # why: итоговый статус уже в БД — провайдера не спрашиваем
+    if payment["status"] == "applied":
+        await callback.answer("Этот платёж уже применён ✅", show_alert=True)
+        return
+    if payment["status"] == "canceled":
+        await callback.answer("Платёж отменён.", show_alert=True)
+        return
     try:
-        status = get_payment_status(pid)
+        status, settled = await RECONCILER.reconcile(pid)
     except Exception as e:
         log.exception("YooKassa status failed: %s", e)
         await callback.message.answer(f"Не удалось проверить статус платежа: {str(e)[:400]}")
         await callback.answer()
         return
 
-    if status in ("succeeded", "waiting_for_capture"):
-        applied = mark_payment_applied(pid)
-        if applied:
-            user_id, credits = applied
-            add_credits(user_id, credits, reason=f"yookassa:{pid}")
-            await callback.message.answer(
-                f"Оплата подтверждена ✅. Начислено {credits} кредитов.\nБаланс: {get_balance(user_id)}."
-            )
-        else:
-            await callback.message.answer("Этот платёж уже применён ✅")
+    if settled is not None:
+        _, credits, balance = settled
+        await callback.message.answer(
+            f"Оплата подтверждена ✅. Начислено {credits} кредитов.\nБаланс: {balance}."
+        )
+    elif status in PAID:
+        await callback.message.answer("Этот платёж уже применён ✅")
     elif status == "pending":
         await callback.message.answer(
-            "Платёж ещё не завершён. Заверши оплату и нажми «Проверить оплату»."
+            "Платёж ещё не завершён. Заверши оплату — кредиты придут автоматически."
         )
     elif status == "canceled":
-        set_payment_status(pid, "canceled")
         await callback.message.answer("Платёж отменён.")
     else:
         await callback.message.answer(f"Статус платежа: {status}")
     await callback.answer()
 
 
+async def _handle_tnb(
+    message: Message, user_id: int, photo: PhotoSize, tg_file_path: str, caption: str
+) -> None:
+    """VARIATION / ALT_VIEWS: синхронная генерация TNB прямо в хэндлере."""
+    # why: TNB отвечает синхронно в хэндлере — без лимита корутины копятся при тормозах
+    with ADMISSION.inline() as verdict:
+        if not verdict.ok:
+            await message.answer(_busy_text(verdict))
+            return
+        hold_id = await reserve_credits(user_id, _unit_cost())
+        if hold_id is None:
+            await message.answer("Не хватает кредитов. Команда /buy — пополнить.")
+            return
+        from services.video_pipeline import (
+            run_altviews_from_telegram_file,
+            run_variation_from_telegram_file,
+        )
+
+        prompt = caption if (cfg.use_caption_as_prompt and caption) else cfg.tnb_default_prompt
+        runner = (
+            run_variation_from_telegram_file
+            if cfg.feature == "VARIATION"
+            else run_altviews_from_telegram_file
+        )
+        deadline = Deadline.after()
+        try:
+            result = await _timed(
+                "tnb",
+                runner(
+                    bot_token=cfg.bot_token,
+                    tg_file_path=tg_file_path,
+                    out_dir=TEMP_DIR,
+                    prompt=prompt,
+                    file_unique_id=photo.file_unique_id,
+                    deadline=deadline,
+                ),
+            )
+            await _send_result(
+                message.bot,
+                message.chat.id,
+                result,
+                deadline,
+                (
+                    f"Готово ✅\nprompt: {_clip(prompt)}"
+                    if cfg.show_prompt_in_caption
+                    else "Готово ✅"
+                ),
+            )
+            await commit_hold(hold_id, _result_cost(result))
+        finally:
+            await release_hold(hold_id)
+
+
+async def _enqueue_edit(
+    message: Message, user_id: int, photo: PhotoSize, tg_file_path: str, caption: str
+) -> None:
+    """KIE_IMAGE с подписью: одиночная правка по промпту через очередь задач."""
+    # why: одиночную правку может сделать и TNB — роутер выберет живой бэкенд
+    routed = backend_router.enabled()
+    verdict = ADMISSION.check(1, routed=routed)
+    if not verdict.ok:
+        await message.answer(_busy_text(verdict))
+        return
+    hold_id = await reserve_credits(user_id, _unit_cost())
+    if hold_id is None:
+        await message.answer("Нужен 1 кредит для генерации. /buy — пополнить.")
+        return
+    # why: генерация идёт через постоянную очередь — переживает рестарт бота
+    try:
+        await WORKERS.enqueue(
+            "edit" if routed else "kie_image",
+            user_id,
+            message.chat.id,
+            [
+                {
+                    "paths": [tg_file_path],
+                    "file_ids": [photo.file_id],
+                    "file_unique_id": photo.file_unique_id,
+                    "prompt": caption,
+                    "caption": (
+                        f"Готово ✅\nprompt: {_clip(caption)}"
+                        if cfg.show_prompt_in_caption
+                        else "Готово ✅"
+                    ),
+                    "fail": "Ошибка генерации",
+                }
+            ],
+            hold_id=hold_id,
+        )
+    except Exception as e:
+        log.exception("Edit enqueue failed: %s", e)
+        await release_hold(hold_id)
+        await message.answer(f"Ошибка генерации: {e}")
+        return
+    if verdict.notice:
+        await message.answer("Принято в очередь." + _queue_text(verdict))
+
+
 @router.message(F.photo)
-async def handle_photo(message: Message):
-    ensure_user(message.from_user.id, cfg.welcome_credits)
+async def handle_photo(message: Message, user: UserContext):
     try:
         ensure_dirs()
         photo = message.photo[-1]
         tg_file = await message.bot.get_file(photo.file_id)
         tg_file_path = tg_file.file_path
         caption = (message.caption or "").strip()
-        user_id = message.from_user.id
+        user_id = user.user_id
 
         # MOCK
         if cfg.mode == "MOCK":
@@ -204,64 +406,18 @@ async def handle_photo(message: Message):
 
         # TNB режимы — ленивые импорты, чтобы избежать ImportError при KIE_ONLY
         if cfg.feature in ("VARIATION", "ALT_VIEWS"):
-            if get_balance(user_id) < 1:
-                await message.answer("Не хватает кредитов. Команда /buy — пополнить.")
-                return
-            from services.video_pipeline import (
-                run_altviews_from_telegram_file,
-                run_variation_from_telegram_file,
-            )
-
-            prompt = caption if (cfg.use_caption_as_prompt and caption) else cfg.tnb_default_prompt
-            runner = (
-                run_variation_from_telegram_file
-                if cfg.feature == "VARIATION"
-                else run_altviews_from_telegram_file
-            )
-            out_path = await runner(
-                bot_token=cfg.bot_token, tg_file_path=tg_file_path, out_dir=TEMP_DIR, prompt=prompt
-            )
-            await message.answer_photo(
-                photo=FSInputFile(str(out_path)),
-                caption=(
-                    f"Готово ✅\nprompt: {_clip(prompt)}"
-                    if cfg.show_prompt_in_caption
-                    else "Готово ✅"
-                ),
-            )
-            from storage.credits import spend_credits
-
-            spend_credits(user_id, 1)
+            await _handle_tnb(message, user_id, photo, tg_file_path, caption)
             return
 
         # KIE режим
         if cfg.feature == "KIE_IMAGE":
             if caption and cfg.use_caption_as_prompt:
-                from storage.credits import spend_credits
-
-                if get_balance(user_id) < 1:
-                    await message.answer("Нужен 1 кредит для генерации. /buy — пополнить.")
-                    return
-                out_path = await run_kie_from_telegram_file(
-                    bot_token=cfg.bot_token,
-                    tg_file_path=tg_file_path,
-                    out_dir=TEMP_DIR,
-                    prompt=caption,
-                )
-                await message.answer_photo(
-                    photo=FSInputFile(str(out_path)),
-                    caption=(
-                        f"Готово ✅\nprompt: {_clip(caption)}"
-                        if cfg.show_prompt_in_caption
-                        else "Готово ✅"
-                    ),
-                )
-                spend_credits(user_id, 1)
+                await _enqueue_edit(message, user_id, photo, tg_file_path, caption)
                 return
 
             presets: list[tuple[str, str, str]] = build_presets()
             scenes = _chunk_scenes(presets)
-            GLOBAL_LAST_PHOTO[user_id] = tg_file_path
+            GLOBAL_LAST_PHOTO[user_id] = (tg_file_path, photo.file_unique_id, photo.file_id)
             await message.answer(
                 "Выбери группу сцен для генерации (каждая сцена содержит 3 ракурса):",
                 reply_markup=scenes_keyboard(scenes),
@@ -272,6 +428,8 @@ async def handle_photo(message: Message):
             "Неизвестная фича. Укажи TNB_FEATURE=VARIATION / ALT_VIEWS / KIE_IMAGE в .env"
         )
 
+    except ProviderUnavailable as e:
+        await message.answer(str(e))
     except Exception as e:
         log.exception("Ошибка при обработке фото: %s", e)
         await message.answer("Ошибка. Проверь конфиг и логи.")
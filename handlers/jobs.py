@@ -0,0 +1,213 @@
+"""
+Исполнители задач генерации из постоянной очереди (storage.jobs).
+
+Хэндлеры только резервируют кредиты и ставят задачи через WORKERS.enqueue;
+генерация, отправка результата в чат, списание из резерва и итог по пачке —
+здесь. Задачи kind:
+- kie_image: один кадр по фото + промпт (сцены, фото с подписью);
+- kie_album: одна задача KIE по нескольким фото альбома;
+- edit: правка фото по подписи — KIE или TNB variation, бэкенд выбирает
+  services.backend_router (при сбое — следующий по плану).
+
+payload: paths / file_ids (входные фото), file_unique_id, prompt, caption
+(подпись к результату), fail (текст ошибки для пользователя).
+
+Параллельность (KIE_MAX_INFLIGHT / KIE_MAX_INFLIGHT_PER_USER) и порядок задач
+между пользователями задаёт планировщик WORKERS (services.fair_queue).
+"""
+
+import logging
+import time
+
+from aiogram import Bot
+
+from handlers.common import _result_cost, _send_result, _timed
+from services.backend_router import ROUTER
+from services.deadline import Deadline, DeadlineExceeded
+from services.job_worker import WORKERS
+from services.resilience import ProviderUnavailable, endpoint
+from services.video_pipeline import (
+    run_kie_from_telegram_file,
+    run_kie_from_telegram_files,
+    run_variation_from_telegram_file,
+)
+from storage import jobs
+from storage.credits import (
+    commit_hold,
+    extend_holds,
+    get_balance,
+    release_hold,
+    spend_credits,
+)
+from storage.files import TEMP_DIR, ensure_dirs
+from storage.jobs import Batch, Job
+from utils.config import cfg
+
+log = logging.getLogger("jobs")
+
+_BOT: dict[str, Bot] = {}
+
+
+def setup(bot: Bot) -> None:
+    _BOT["bot"] = bot
+    WORKERS.register("kie_image", _run_job)
+    WORKERS.register("kie_album", _run_job)
+    WORKERS.register("edit", _run_job)
+    WORKERS.on_drop(_drop_job)
+    # why: SCENES_PARALLEL=0 — кадры пользователя идут строго по одному
+    per_user = cfg.kie_max_inflight_per_user if cfg.scenes_parallel else 1
+    WORKERS.set_limits(global_limit=cfg.kie_max_inflight, per_user_limit=per_user)
+
+
+async def _input_paths(bot: Bot, job: Job) -> list[str]:
+    """Пути файлов Telegram; при повторной попытке — заново через get_file (пути протухают)."""
+    paths = job.payload["paths"]
+    file_ids = job.payload.get("file_ids") or []
+    if job.attempts > 1 and len(file_ids) == len(paths):
+        paths = [(await bot.get_file(fid)).file_path for fid in file_ids]
+    return paths
+
+
+async def _generate(bot: Bot, job: Job, paths: list[str], deadline: Deadline):
+    p = job.payload
+
+    async def remember_task(task_id: str, kie_key: str) -> None:
+        await jobs.set_task(job.id, task_id, kie_key)
+
+    if job.kind == "kie_album":
+        return await run_kie_from_telegram_files(
+            bot_token=cfg.bot_token,
+            tg_file_paths=paths,
+            out_dir=TEMP_DIR,
+            prompt=p.get("prompt"),
+            task_id=job.task_id,
+            kie_key=job.kie_key,
+            on_task=remember_task,
+            deadline=deadline,
+        )
+    return await run_kie_from_telegram_file(
+        bot_token=cfg.bot_token,
+        tg_file_path=paths[0],
+        out_dir=TEMP_DIR,
+        prompt=p.get("prompt"),
+        file_unique_id=p.get("file_unique_id"),
+        task_id=job.task_id,
+        kie_key=job.kie_key,
+        on_task=remember_task,
+        deadline=deadline,
+    )
+
+
+async def _generate_tnb(job: Job, paths: list[str], deadline: Deadline):
+    return await run_variation_from_telegram_file(
+        bot_token=cfg.bot_token,
+        tg_file_path=paths[0],
+        out_dir=TEMP_DIR,
+        prompt=job.payload.get("prompt"),
+        file_unique_id=job.payload.get("file_unique_id"),
+        deadline=deadline,
+    )
+
+
+async def _route(bot: Bot, job: Job, deadline: Deadline):
+    """
+    Правка по подписи: бэкенды по плану роутера, пока какой-то не справится.
+    Запасной бэкенд получает остаток того же бюджета, а не новый.
+    """
+    paths = await _input_paths(bot, job)
+    # why: задача KIE уже создана (рестарт) — доводим её, а не платим второму провайдеру
+    plan = ["kie"] if job.task_id else ROUTER.plan()
+    if not plan:
+        raise ProviderUnavailable("kie.create", endpoint("kie.create").retry_after() or 60)
+    for backend in plan:
+        started = time.monotonic()
+        try:
+            if backend == "kie":
+                result = await _timed("kie", _generate(bot, job, paths, deadline))
+            else:
+                result = await _timed("tnb", _generate_tnb(job, paths, deadline))
+        except Exception as e:
+            ROUTER.record(backend, ok=False, seconds=time.monotonic() - started)
+            last = backend == plan[-1] or isinstance(e, DeadlineExceeded)
+            if last or not ROUTER.should_fallback(e):
+                raise
+            log.warning("job %s: %s failed, trying next backend: %s", job.id, backend, e)
+        else:
+            ROUTER.record(backend, ok=True, seconds=time.monotonic() - started)
+            return result
+
+
+async def renew_holds() -> int:
+    """
+    Продлевает резервы пачек, пока их задачи в очереди или в работе: при честной
+    очереди пачка может ждать дольше CREDIT_HOLD_TTL, и резерв истёк бы раньше списания.
+    """
+    return await extend_holds(await jobs.open_hold_ids())
+
+
+async def _charge(job: Job, cost: int) -> None:
+    # why: резерв мог истечь (долгий простой после рестарта) — тогда списываем с баланса
+    if job.hold_id is not None and await commit_hold(job.hold_id, cost):
+        return
+    if not await spend_credits(job.user_id, cost):
+        log.warning("job %s delivered but user %s could not be charged", job.id, job.user_id)
+
+
+async def _run_job(job: Job) -> None:
+    bot = _BOT["bot"]
+    ensure_dirs()
+    error = None
+    # why: бюджет на попытку целиком — create, ожидание, скачивание и отправка (GEN_DEADLINE_S)
+    deadline = Deadline.after()
+    try:
+        if job.kind == "edit":
+            result = await _route(bot, job, deadline)
+        else:
+            paths = await _input_paths(bot, job)
+            result = await _timed("kie", _generate(bot, job, paths, deadline))
+        await _send_result(bot, job.chat_id, result, deadline, job.payload.get("caption"))
+        await _charge(job, 1 if job.kind == "kie_album" else _result_cost(result))
+    except Exception as e:
+        log.exception("job %s failed: %s", job.id, e)
+        error = str(e)[:500]
+        try:
+            await bot.send_message(
+                job.chat_id, f"{job.payload.get('fail', 'Сбой генерации')}\n— {e}"
+            )
+        except Exception as send_error:
+            log.warning("job %s: failure notice not sent: %s", job.id, send_error)
+    await _complete(bot, job, error)
+
+
+async def _drop_job(job: Job) -> None:
+    """Задача снята воркером (процесс падал на ней раз за разом) — закрываем её как сбой."""
+    bot = _BOT["bot"]
+    try:
+        await bot.send_message(
+            job.chat_id,
+            f"{job.payload.get('fail', 'Сбой генерации')}\n— задача снята после повторных сбоев",
+        )
+    except Exception as e:
+        log.warning("job %s: drop notice not sent: %s", job.id, e)
+    await _complete(bot, job, "dropped")
+
+
+async def _complete(bot: Bot, job: Job, error: str | None) -> None:
+    batch = await jobs.finish(job.id, ok=error is None, error=error)
+    if batch is not None and batch.done:
+        # why: последняя задача пачки возвращает остаток резерва и присылает итог
+        await _close_batch(bot, batch)
+
+
+async def _close_batch(bot: Bot, batch: Batch) -> None:
+    if batch.hold_id is not None:
+        await release_hold(batch.hold_id)
+    if not batch.summary:
+        return
+    if batch.sent == 0:
+        await bot.send_message(batch.chat_id, "Не удалось сгенерировать ни один вариант.")
+    else:
+        await bot.send_message(
+            batch.chat_id,
+            f"Готово ✅ Отправлено: {batch.sent}. Баланс: {await get_balance(batch.user_id)}",
+        )
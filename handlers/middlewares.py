@@ -0,0 +1,39 @@
+"""
+Middleware контекста пользователя.
+
+Один раз на апдейт выполняет ensure_user (баланс горячих пользователей берётся
+из кэша в памяти, см. storage.credits.BALANCES) и передаёт результат хэндлерам
+параметром `user`. Хэндлеру не нужно отдельно звать ensure_user/get_balance
+перед проверкой кредитов.
+"""
+
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from typing import Any
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from storage.credits import ensure_user
+from utils.config import cfg
+
+
+@dataclass(slots=True)
+class UserContext:
+    user_id: int
+    is_new: bool
+    balance: int  # на момент начала обработки апдейта
+
+
+class UserContextMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        from_user = getattr(event, "from_user", None)
+        if from_user is not None:
+            is_new, balance = await ensure_user(from_user.id, cfg.welcome_credits)
+            data["user"] = UserContext(from_user.id, is_new, balance)
+        return await handler(event, data)
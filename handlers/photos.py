@@ -3,24 +3,28 @@ import logging
 
 from aiogram import F, Router
 from aiogram.exceptions import TelegramBadRequest
-from aiogram.types import CallbackQuery, FSInputFile, Message
+from aiogram.types import CallbackQuery, Message
 
 from handlers.common import (
     GLOBAL_LAST_PHOTO,  # общий кэш последнего фото
+    _busy_text,
     _chunk_scenes,
     _clip,
+    _queue_text,
+    _unit_cost,
 )
+from handlers.middlewares import UserContext
+from services.admission import ADMISSION
+from services.job_worker import WORKERS
 from services.presets import build_presets
-from services.video_pipeline import run_kie_from_telegram_file, run_kie_from_telegram_files
-from storage.credits import get_balance, spend_credits
-from storage.files import TEMP_DIR
+from storage.credits import get_balance, release_hold, reserve_credits
 from utils.config import cfg
 
 router = Router()
 log = logging.getLogger("photos")
 
-# Кэш для альбомов: media_group_id -> list[file_path]
-_ALBUM_CACHE: dict[str, list[str]] = {}
+# Кэш для альбомов: media_group_id -> list[(file_path, file_id)]
+_ALBUM_CACHE: dict[str, list[tuple[str, str]]] = {}
 
 
 @router.message(F.photo & F.media_group_id.as_("gid"))
@@ -32,38 +36,45 @@ async def handle_album_part(message: Message, gid: str):
     try:
         photo = message.photo[-1]
         tg_file = await message.bot.get_file(photo.file_id)
-        _ALBUM_CACHE.setdefault(gid, []).append(tg_file.file_path)
+        _ALBUM_CACHE.setdefault(gid, []).append((tg_file.file_path, photo.file_id))
 
         # Первый элемент — планируем обработку через ~1 секунду
         if len(_ALBUM_CACHE[gid]) == 1:
 
             async def _flush_after_delay():
                 await asyncio.sleep(1.2)  # простая эвристика завершения группы
-                paths = _ALBUM_CACHE.pop(gid, [])
-                if not paths:
+                parts = _ALBUM_CACHE.pop(gid, [])
+                if not parts:
                     return
                 user_id = message.from_user.id
-                if get_balance(user_id) < 1:
+                verdict = ADMISSION.check(1)
+                if not verdict.ok:
+                    await message.answer(_busy_text(verdict))
+                    return
+                hold_id = await reserve_credits(user_id, 1)  # 1 задача = 1 кредит
+                if hold_id is None:
                     await message.answer("Нужен 1 кредит для генерации альбома. /buy — пополнить.")
                     return
+                payload = {
+                    "paths": [path for path, _ in parts],
+                    "file_ids": [file_id for _, file_id in parts],
+                    "prompt": (message.caption or "").strip() or None,
+                    "caption": (
+                        ("Готово ✅\nальбом + промпт: " + _clip((message.caption or ""), 200))
+                        if cfg.show_prompt_in_caption and message.caption
+                        else "Готово ✅"
+                    ),
+                    "fail": "Ошибка генерации по альбому",
+                }
                 try:
-                    out_path = await run_kie_from_telegram_files(
-                        bot_token=cfg.bot_token,
-                        tg_file_paths=paths,
-                        out_dir=TEMP_DIR,
-                        prompt=(message.caption or "").strip() or None,
-                    )
-                    await message.answer_photo(
-                        photo=FSInputFile(str(out_path)),
-                        caption=(
-                            ("Готово ✅\nальбом + промпт: " + _clip((message.caption or ""), 200))
-                            if cfg.show_prompt_in_caption and message.caption
-                            else "Готово ✅"
-                        ),
+                    await WORKERS.enqueue(
+                        "kie_album", user_id, message.chat.id, [payload], hold_id=hold_id
                     )
-                    spend_credits(user_id, 1)  # 1 задача = 1 кредит
+                    if verdict.notice:
+                        await message.answer("Альбом принят в очередь." + _queue_text(verdict))
                 except Exception as e:
-                    log.exception("Album failed: %s", e)
+                    log.exception("Album enqueue failed: %s", e)
+                    await release_hold(hold_id)
                     await message.answer(f"Ошибка генерации по альбому: {e}")
 
             asyncio.create_task(_flush_after_delay())
@@ -71,12 +82,30 @@ async def handle_album_part(message: Message, gid: str):
         log.exception("Album collect error: %s", e)
 
 
+def _shot_payload(photo: tuple[str, str, str], item: tuple[str, str, str]) -> dict:
+    """Задача очереди на один кадр сцены (см. handlers/jobs.py)."""
+    scene, shot, ptxt = item
+    tg_file_path, file_unique_id, file_id = photo
+    return {
+        "paths": [tg_file_path],
+        "file_ids": [file_id],
+        "file_unique_id": file_unique_id,
+        "prompt": ptxt,
+        "caption": (
+            f"{scene} • {shot}\n{_clip(ptxt, 300)}"
+            if cfg.show_prompt_in_caption
+            else f"{scene} • {shot}"
+        ),
+        "fail": f"Сбой: {scene} • {shot}",
+    }
+
+
 @router.callback_query(F.data.startswith("scene:"))
-async def on_scene_choice(callback: CallbackQuery):
+async def on_scene_choice(callback: CallbackQuery, user: UserContext):
     try:
-        user_id = callback.from_user.id
-        tg_file_path = GLOBAL_LAST_PHOTO.get(user_id)
-        if not tg_file_path:
+        user_id = user.user_id
+        photo = GLOBAL_LAST_PHOTO.get(user_id)
+        if not photo:
             await callback.answer("Сначала пришли фото.", show_alert=True)
             return
 
@@ -101,51 +130,43 @@ async def on_scene_choice(callback: CallbackQuery):
             title = f"Сцена: {scenes[idx][0][0]}"
 
         total_needed = 3 * len(chosen)
-        bal = get_balance(user_id)
-        if bal < total_needed:
+        verdict = ADMISSION.check(total_needed)
+        if not verdict.ok:
+            # why: меню и фото остаются — пользователь может повторить выбор позже
+            await callback.answer(_busy_text(verdict), show_alert=True)
+            return
+        # why: резерв на всю пачку сразу — параллельные кадры не уведут баланс в минус
+        hold_id = await reserve_credits(user_id, total_needed * _unit_cost())
+        if hold_id is None:
             await callback.message.edit_text(
-                f"Нужно {total_needed} кредитов, у тебя {bal}. Нажми /buy, чтобы пополнить."
+                f"Нужно {total_needed} кредитов, у тебя {await get_balance(user_id)}. "
+                "Нажми /buy, чтобы пополнить."
             )
             return
 
+        shots = [item for triplet in chosen for item in triplet]
         try:
-            await callback.message.edit_text(f"Генерация: {title}…")
-        except TelegramBadRequest:
-            pass
-        await callback.answer()
-
-        sent = 0
-        for triplet in chosen:
-            for scene, shot, ptxt in triplet:
-                try:
-                    out_path = await run_kie_from_telegram_file(
-                        bot_token=cfg.bot_token,
-                        tg_file_path=tg_file_path,
-                        out_dir=TEMP_DIR,
-                        prompt=ptxt,
-                    )
-                    cap = (
-                        f"{scene} • {shot}\n{_clip(ptxt, 300)}"
-                        if cfg.show_prompt_in_caption
-                        else f"{scene} • {shot}"
-                    )
-                    await callback.message.answer_photo(
-                        photo=FSInputFile(str(out_path)), caption=cap
-                    )
-                    spend_credits(user_id, 1)
-                    sent += 1
-                except Exception as e:
-                    log.exception("Preset failed: %s | %s: %s", scene, shot, e)
-                    await callback.message.answer(f"Сбой: {scene} • {shot}\n— {e}")
-
+            # why: кадры пишутся в постоянную очередь — переживают рестарт; итог пришлёт воркер
+            await WORKERS.enqueue(
+                "kie_image",
+                user_id,
+                callback.message.chat.id,
+                [_shot_payload(photo, item) for item in shots],
+                hold_id=hold_id,
+                summary=True,
+            )
+        except Exception:
+            await release_hold(hold_id)
+            raise
         GLOBAL_LAST_PHOTO.pop(user_id, None)
 
-        if sent == 0:
-            await callback.message.answer("Не удалось сгенерировать ни один вариант.")
-        else:
-            await callback.message.answer(
-                f"Готово ✅ Отправлено: {sent}. Баланс: {get_balance(user_id)}"
+        try:
+            await callback.message.edit_text(
+                f"Генерация: {title}… ({len(shots)} кадров в очереди)" + _queue_text(verdict)
             )
+        except TelegramBadRequest:
+            pass
+        await callback.answer()
 
     except Exception as e:
         log.exception("Ошибка меню: %s", e)
@@ -6,10 +6,18 @@ from pathlib import Path
 from aiogram import Bot, Dispatcher
 from dotenv import load_dotenv
 
+from handlers import jobs as job_runners
 from handlers.admin import router as admin_router
 from handlers.common import router as common_router
+from handlers.middlewares import UserContextMiddleware
 from handlers.photos import router as photos_router
-from storage.credits import init_db
+from services import kie_callbacks, maintenance, payments_webhook
+from services.http_pool import shutdown as http_shutdown, startup as http_startup
+from services.job_worker import WORKERS
+from services.payments_reconciler import RECONCILER
+from services.webhook_server import start as webhook_start, stop as webhook_stop
+from storage import jobs, ledger
+from storage.credits import close_db, init_db, release_expired_holds, renew_interval
 from utils.config import cfg
 
 # ── Логи
@@ -33,18 +41,47 @@ async def main() -> None:
     if not cfg.bot_token:
         raise RuntimeError("В .env не указан BOT_TOKEN")
 
-    init_db()
-
+    await init_db()
+    await jobs.init_db()
+    # why: резервы пачек, переживших рестарт, продлеваем до возврата просроченных
+    await job_runners.renew_holds()
+    await release_expired_holds()
+    await http_startup()
     bot = Bot(token=cfg.bot_token)
+    # why: уведомления об оплате шлёт бот — он нужен до приёма первого webhook'а
+    RECONCILER.setup(bot)
+    kie_callbacks.setup()
+    payments_webhook.setup()
+    await webhook_start()
+    maintenance.add_job("ledger_compaction", ledger.compact_interval, ledger.compact)
+    maintenance.add_job("jobs_purge", lambda: 6 * 3600, jobs.purge)
+    maintenance.add_job("holds_renew", renew_interval, job_runners.renew_holds)
+    await maintenance.start()
+
     dp = Dispatcher()
+    # why: ensure_user/баланс — один раз на апдейт, хэндлеры получают параметр `user`
+    dp.message.outer_middleware(UserContextMiddleware())
+    dp.callback_query.outer_middleware(UserContextMiddleware())
 
     # Подключаем роутеры
     dp.include_router(common_router)
     dp.include_router(admin_router)
     dp.include_router(photos_router)
 
+    # why: воркеры поднимают и незавершённые задачи прошлого запуска
+    job_runners.setup(bot)
+    await WORKERS.start()
+
     log.info("Бот запущен. MODE=%s FEATURE=%s", cfg.mode, cfg.feature)
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await WORKERS.stop()
+        await maintenance.stop()
+        await webhook_stop()
+        await http_shutdown()
+        close_db()
+        jobs.close_db()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+"""
+Контроль допуска новых генераций (admission control).
+
+Когда провайдер тормозит, каждая принятая задача часами занимает слот
+очереди, сокеты и временные файлы. Перед постановкой работы хэндлер
+спрашивает check(): по глубине очереди WORKERS и недавней длительности
+генераций оценивается ожидание (ETA). Выше ADMISSION_NOTICE_WAIT_S задача
+принимается с предупреждением о времени, выше ADMISSION_MAX_WAIT_S или при
+переполнении очереди (ADMISSION_MAX_BACKLOG), а также пока KIE закрыт
+circuit breaker'ом (services.resilience) — отклоняется до резерва кредитов.
+
+Синхронные TNB-генерации в хэндлере считаются отдельно (inline()) и
+ограничены ADMISSION_MAX_INLINE одновременных запросов.
+"""
+
+import math
+import statistics
+from collections import deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from services.backend_router import ROUTER
+from services.job_worker import WORKERS
+from services.resilience import endpoint
+from utils.config import env_float
+
+
+@dataclass(slots=True)
+class Verdict:
+    ok: bool
+    eta: float  # оценка ожидания результата, с
+    notice: bool = False  # принять, но предупредить о долгом ожидании
+
+    def text(self) -> str:
+        """Оценка ожидания для пользователя: «~3 мин»."""
+        if self.eta < 90:
+            return f"~{max(1, round(self.eta))} с"
+        return f"~{math.ceil(self.eta / 60)} мин"
+
+
+class Admission:
+    def __init__(self) -> None:
+        self._latency: dict[str, deque[float]] = {}
+        self._inline = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    def observe(self, provider: str, seconds: float) -> None:
+        """Длительность генерации у провайдера (успешной или нет — слот был занят)."""
+        self._latency.setdefault(provider, deque(maxlen=50)).append(seconds)
+
+    def latency(self, provider: str) -> float:
+        samples = self._latency.get(provider)
+        if not samples:
+            return env_float("ADMISSION_DEFAULT_LATENCY_S", 60.0)
+        return statistics.median(samples)
+
+    def check(self, jobs: int, *, routed: bool = False) -> Verdict:
+        """
+        Можно ли поставить пачку из jobs задач в очередь KIE.
+        routed — задача уйдёт в живой бэкенд по выбору services.backend_router.
+        """
+        blocked = endpoint("kie.create").retry_after()
+        if routed and ROUTER.plan():
+            blocked = 0.0
+        if blocked > 0:
+            # why: breaker открыт — задача всё равно упадёт, честнее отказать сразу
+            return self._verdict(ok=False, eta=blocked)
+        st = WORKERS.stats()
+        queued, running = st.get("queued", 0), st.get("running", 0)
+        limit = max(1, st.get("limit", 1))
+        if queued + running + jobs > env_float("ADMISSION_MAX_BACKLOG", 200):
+            return self._verdict(ok=False, eta=self._eta(queued + jobs, limit))
+        # why: одиночная правка обгоняет пакеты (services.fair_queue) — ждёт только слот
+        ahead = 0 if jobs == 1 else queued
+        eta = self._eta(ahead + jobs + max(0, running - limit + 1), limit)
+        return self._verdict(ok=eta <= env_float("ADMISSION_MAX_WAIT_S", 900), eta=eta)
+
+    def _eta(self, jobs: int, limit: int) -> float:
+        return math.ceil(jobs / limit) * self.latency("kie")
+
+    def _verdict(self, *, ok: bool, eta: float) -> Verdict:
+        if ok:
+            self.accepted += 1
+        else:
+            self.rejected += 1
+        return Verdict(ok, eta, notice=ok and eta > env_float("ADMISSION_NOTICE_WAIT_S", 120))
+
+    @contextmanager
+    def inline(self) -> Iterator[Verdict]:
+        """Слот синхронной TNB-генерации; verdict.ok=False — мест нет, генерацию не начинать."""
+        if self._inline >= env_float("ADMISSION_MAX_INLINE", 16):
+            yield self._verdict(ok=False, eta=self.latency("tnb"))
+            return
+        self._inline += 1
+        try:
+            yield self._verdict(ok=True, eta=self.latency("tnb"))
+        finally:
+            self._inline -= 1
+
+    def stats(self) -> dict[str, float | int]:
+        return {
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "inline": self._inline,
+            "kie_latency": round(self.latency("kie"), 1),
+            "tnb_latency": round(self.latency("tnb"), 1),
+        }
+
+
+ADMISSION = Admission()
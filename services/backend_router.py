@@ -0,0 +1,110 @@
+"""
+Выбор бэкенда для одиночной правки фото по подписи: KIE или TNB (variation).
+
+По каждому бэкенду копится скользящее окно исходов за ROUTER_WINDOW_S секунд:
+длительность и успех. Стоимость бэкенда — p95 длительности × (1 +
+ROUTER_ERROR_PENALTY × доля ошибок) / ROUTER_WEIGHT_<KIE|TNB>; план —
+бэкенды по возрастанию стоимости. Бэкенд с открытым circuit breaker'ом
+(services.resilience), без здоровых ключей/учётки или с весом 0 в план не
+попадает. Доля ROUTER_EXPLORE запросов идёт во второй по стоимости бэкенд —
+чтобы заметить, что провайдер восстановился.
+
+Маршрутизация включается явно (ROUTE_CAPTION_EDITS=1): TNB делает вариацию,
+а не правку по подписи, и без неё все такие правки идут в KIE, как раньше.
+
+Если бэкенд не справился, ROUTER_FALLBACK решает, пробовать ли следующий:
+transient (по умолчанию) — только при сбое провайдера (сеть, 5xx, 429,
+breaker), any — при любой ошибке, off — никогда.
+"""
+
+import os
+import random
+import time
+from collections import deque
+from typing import Any
+
+from services.kie_keys import KEYS
+from services.resilience import ProviderUnavailable, endpoint, is_transient
+from utils.config import env_float
+
+BACKENDS = ("kie", "tnb")
+
+# бэкенд -> endpoint createTask/генерации, чей breaker проверяем
+_ENDPOINTS = {"kie": "kie.create", "tnb": "tnb.variation"}
+
+
+def enabled() -> bool:
+    """Маршрутизировать ли правки по подписи (ROUTE_CAPTION_EDITS, по умолчанию нет)."""
+    return os.getenv("ROUTE_CAPTION_EDITS", "0") == "1"
+
+
+def _usable(backend: str) -> bool:
+    if backend == "kie":
+        now = time.monotonic()
+        return any(k.healthy(now) for k in KEYS.keys())
+    return bool(os.getenv("TNB_EMAIL", "").strip() and os.getenv("TNB_PASSWORD", "").strip())
+
+
+class Router:
+    def __init__(self) -> None:
+        # бэкенд -> (момент, успех, длительность)
+        self._samples: dict[str, deque[tuple[float, bool, float]]] = {
+            b: deque(maxlen=200) for b in BACKENDS
+        }
+
+    def record(self, backend: str, *, ok: bool, seconds: float) -> None:
+        self._samples[backend].append((time.monotonic(), ok, seconds))
+
+    def _window(self, backend: str) -> list[tuple[float, bool, float]]:
+        since = time.monotonic() - env_float("ROUTER_WINDOW_S", 600)
+        return [s for s in self._samples[backend] if s[0] >= since]
+
+    def _p95(self, backend: str) -> float:
+        durations = sorted(seconds for _, _, seconds in self._window(backend))
+        if len(durations) < 5:
+            return env_float("ROUTER_DEFAULT_LATENCY_S", 60)
+        return durations[int(len(durations) * 0.95)]
+
+    def _error_rate(self, backend: str) -> float:
+        window = self._window(backend)
+        return sum(not ok for _, ok, _ in window) / len(window) if window else 0.0
+
+    def cost(self, backend: str) -> float | None:
+        """Стоимость бэкенда; None — сейчас недоступен."""
+        weight = env_float(f"ROUTER_WEIGHT_{backend.upper()}", 1.0)
+        if weight <= 0 or not _usable(backend):
+            return None
+        if endpoint(_ENDPOINTS[backend]).retry_after() > 0:
+            return None
+        penalty = env_float("ROUTER_ERROR_PENALTY", 4.0)
+        return self._p95(backend) * (1 + penalty * self._error_rate(backend)) / weight
+
+    def plan(self) -> list[str]:
+        """Бэкенды в порядке попыток."""
+        costs = {b: c for b in BACKENDS if (c := self.cost(b)) is not None}
+        order = sorted(costs, key=costs.__getitem__)
+        if len(order) > 1 and random.random() < env_float("ROUTER_EXPLORE", 0.05):
+            order[0], order[1] = order[1], order[0]
+        return order
+
+    def should_fallback(self, e: BaseException) -> bool:
+        policy = os.getenv("ROUTER_FALLBACK", "transient").lower()
+        if policy == "off":
+            return False
+        if policy == "transient":
+            return is_transient(e) or isinstance(e, ProviderUnavailable)
+        return True
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        return {
+            b: {
+                "samples": len(self._window(b)),
+                "p95": round(self._p95(b), 1),
+                "errors": round(self._error_rate(b), 2),
+                "cost": None if (c := self.cost(b)) is None else round(c, 1),
+            }
+            for b in BACKENDS
+        }
+
+
+ROUTER = Router()
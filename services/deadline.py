@@ -0,0 +1,65 @@
+"""
+Сквозной бюджет времени одной генерации.
+
+Deadline создаётся там, где начинается пользовательский запрос (исполнитель
+задачи, TNB-хэндлер), и передаётся дальше: createTask -> ожидание
+результата -> скачивание -> отправка в Telegram. Каждый этап берёт таймаут
+не больше остатка (timeout(cap)), повторы прекращаются, когда бюджет
+кончился, а просроченный этап падает с DeadlineExceeded — вместо того чтобы
+каждый этап по отдельности ждал свой максимум.
+
+Бюджет по умолчанию — GEN_DEADLINE_S (600 с).
+"""
+
+import asyncio
+import os
+import time
+from collections.abc import Awaitable
+from dataclasses import dataclass
+from typing import TypeVar
+
+T = TypeVar("T")
+
+
+def budget() -> float:
+    try:
+        return max(1.0, float(os.getenv("GEN_DEADLINE_S", "600")))
+    except ValueError:
+        return 600.0
+
+
+class DeadlineExceeded(TimeoutError):
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+        super().__init__(f"Генерация не уложилась во время (этап: {stage})")
+
+
+@dataclass(slots=True)
+class Deadline:
+    expires_at: float  # time.monotonic()
+
+    @classmethod
+    def after(cls, seconds: float | None = None) -> "Deadline":
+        return cls(time.monotonic() + (budget() if seconds is None else seconds))
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def check(self, stage: str) -> None:
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(stage)
+
+    def timeout(self, cap: float) -> float:
+        """Таймаут этапа: его собственный предел cap, но не дольше остатка бюджета."""
+        return max(0.001, min(cap, self.remaining()))
+
+    async def run(self, stage: str, aw: Awaitable[T]) -> T:
+        """Ждёт aw не дольше остатка бюджета."""
+        if self.remaining() <= 0:
+            if asyncio.iscoroutine(aw):
+                aw.close()  # why: иначе «coroutine was never awaited»
+            raise DeadlineExceeded(stage)
+        try:
+            return await asyncio.wait_for(aw, self.remaining())
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(stage) from None
@@ -0,0 +1,129 @@
+"""
+Справедливый планировщик задач генерации (взвешенная честная очередь).
+
+У каждого пользователя своя FIFO-очередь; между пользователями — Start-time
+Fair Queuing: задача получает виртуальные метки start/finish, finish = start +
+1/вес, и на выполнение идёт голова с минимальным finish среди тех, кто не
+упёрся в лимиты. Так 21 кадр «Все сцены» одного пользователя не задерживает
+одиночные правки остальных: у них метки меньше, и они проходят первыми.
+
+Вес задаёт класс задачи «<paid|bonus>/<single|batch>»:
+платящие пользователи — ×SCHED_WEIGHT_PAID, одиночная правка —
+×SCHED_WEIGHT_SINGLE. Лимиты: per_user_limit задач одного пользователя и
+global_limit всего одновременно.
+"""
+
+import asyncio
+import os
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from typing import Any
+
+
+def _weight_env(name: str, default: float) -> float:
+    try:
+        return max(0.01, float(os.getenv(name, str(default))))
+    except ValueError:
+        return default
+
+
+def class_weight(klass: str) -> float:
+    paid, _, size = klass.partition("/")
+    weight = 1.0
+    if paid == "paid":
+        weight *= _weight_env("SCHED_WEIGHT_PAID", 2.0)
+    if size == "single":
+        weight *= _weight_env("SCHED_WEIGHT_SINGLE", 4.0)
+    return weight
+
+
+@dataclass
+class Entry:
+    job_id: int
+    user_id: int
+    klass: str
+    start: float = 0.0
+    finish: float = 0.0
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class FairQueue:
+    def __init__(self, *, global_limit: int = 8, per_user_limit: int = 3) -> None:
+        self.global_limit = global_limit
+        self.per_user_limit = per_user_limit
+        self._queues: dict[int, deque[Entry]] = {}
+        self._last_finish: dict[int, float] = {}
+        self._running: dict[int, int] = defaultdict(int)
+        self._total_running = 0
+        self._vtime = 0.0
+        self._changed = asyncio.Event()
+        self._waits: deque[float] = deque(maxlen=500)  # сколько задачи ждали в очереди, с
+
+    def push(self, job_id: int, user_id: int, klass: str) -> None:
+        entry = Entry(job_id, user_id, klass)
+        entry.start = max(self._vtime, self._last_finish.get(user_id, 0.0))
+        entry.finish = entry.start + 1.0 / class_weight(klass)
+        self._last_finish[user_id] = entry.finish
+        self._queues.setdefault(user_id, deque()).append(entry)
+        self._changed.set()
+
+    def _pick(self) -> Entry | None:
+        if self._total_running >= max(1, self.global_limit):
+            return None
+        best: Entry | None = None
+        for user_id, queue in self._queues.items():
+            if self._running.get(user_id, 0) >= max(1, self.per_user_limit):
+                continue
+            head = queue[0]
+            if best is None or head.finish < best.finish:
+                best = head
+        return best
+
+    async def get(self) -> Entry:
+        """Ждёт следующую задачу, которую можно запустить не нарушая лимитов."""
+        while True:
+            entry = self._pick()
+            if entry is not None:
+                break
+            self._changed.clear()
+            await self._changed.wait()
+        queue = self._queues[entry.user_id]
+        queue.popleft()
+        if not queue:
+            del self._queues[entry.user_id]
+        self._vtime = max(self._vtime, entry.start)
+        self._running[entry.user_id] += 1
+        self._total_running += 1
+        self._waits.append(time.monotonic() - entry.enqueued_at)
+        return entry
+
+    def done(self, entry: Entry) -> None:
+        self._running[entry.user_id] -= 1
+        if self._running[entry.user_id] <= 0:
+            del self._running[entry.user_id]
+            if entry.user_id not in self._queues:
+                # why: простаивающий пользователь не копит «долг» — метка сбросится к vtime
+                self._last_finish.pop(entry.user_id, None)
+        self._total_running -= 1
+        self._changed.set()
+
+    def stats(self) -> dict[str, Any]:
+        by_class: dict[str, int] = defaultdict(int)
+        oldest = 0.0
+        now = time.monotonic()
+        for queue in self._queues.values():
+            for entry in queue:
+                by_class[entry.klass] += 1
+            oldest = max(oldest, now - queue[0].enqueued_at)
+        waits = sorted(self._waits)
+        return {
+            "queued": sum(by_class.values()),
+            "by_class": dict(by_class),
+            "users_waiting": len(self._queues),
+            "running": self._total_running,
+            "limit": self.global_limit,
+            "oldest_wait": round(oldest, 1),
+            "wait_p50": round(waits[len(waits) // 2], 1) if waits else None,
+            "wait_p95": round(waits[int(len(waits) * 0.95)], 1) if waits else None,
+        }
@@ -0,0 +1,64 @@
+"""
+Общие httpx-клиенты на процесс: по одному пулу соединений на провайдера.
+
+why: раньше каждый запрос (и каждый ретрай) открывал новый AsyncClient,
+то есть новый TCP+TLS handshake. Теперь соединения переиспользуются.
+Пулы раздельные, чтобы медленные скачивания не выедали лимит соединений KIE.
+"""
+
+import logging
+import os
+
+import httpx
+
+from utils.config import env_float, env_int
+
+log = logging.getLogger("http_pool")
+
+# Известные пулы: открываются в startup(), остальные — лениво при первом обращении
+POOLS: tuple[str, ...] = ("kie", "tnb", "download")
+
+_CLIENTS: dict[str, httpx.AsyncClient] = {}
+
+
+def _http2_enabled() -> bool:
+    if os.getenv("HTTP_HTTP2", "0") != "1":
+        return False
+    try:
+        import h2  # noqa: F401, PLC0415
+    except ImportError:
+        log.warning("HTTP_HTTP2=1, но пакет h2 не установлен — работаем по HTTP/1.1")
+        return False
+    return True
+
+
+def _build_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=env_int("HTTP_MAX_CONNECTIONS", 50),
+        max_keepalive_connections=env_int("HTTP_MAX_KEEPALIVE", 20),
+        keepalive_expiry=env_float("HTTP_KEEPALIVE_EXPIRY", 30.0),
+    )
+    # Таймауты по умолчанию; конкретные вызовы задают свой timeout= на запрос
+    timeout = httpx.Timeout(60.0, connect=env_float("HTTP_CONNECT_TIMEOUT", 10.0))
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=_http2_enabled())
+
+
+def get_client(pool: str) -> httpx.AsyncClient:
+    """Возвращает общий клиент пула (создаёт при первом обращении)."""
+    client = _CLIENTS.get(pool)
+    if client is None or client.is_closed:
+        client = _CLIENTS[pool] = _build_client()
+    return client
+
+
+async def startup() -> None:
+    for pool in POOLS:
+        get_client(pool)
+    log.info("HTTP pools opened: %s", ", ".join(POOLS))
+
+
+async def shutdown() -> None:
+    clients = list(_CLIENTS.values())
+    _CLIENTS.clear()
+    for client in clients:
+        await client.aclose()
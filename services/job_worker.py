@@ -0,0 +1,147 @@
+"""
+Пул воркеров поверх постоянной очереди storage.jobs.
+
+Исполнители задач регистрируются по kind (register), воркеры берут задачи
+из справедливого планировщика (services.fair_queue: честная очередь между
+пользователями, классы приоритета, лимиты параллельности) и вызывают
+исполнителя с записью из БД. При старте все незавершённые задачи из БД
+ставятся в очередь заново (возобновление после рестарта/деплоя). Остановка отменяет воркеров — их задачи остаются в БД
+незавершёнными и продолжатся при следующем запуске.
+"""
+
+import asyncio
+import logging
+import os
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from services.fair_queue import FairQueue
+from storage import jobs
+from storage.credits import is_paying
+from storage.jobs import Job
+
+log = logging.getLogger("job_worker")
+
+Runner = Callable[[Job], Awaitable[None]]
+
+
+def _workers_count() -> int:
+    try:
+        return max(1, int(os.getenv("JOB_WORKERS", "16")))
+    except ValueError:
+        return 16
+
+
+def _max_attempts() -> int:
+    try:
+        return max(1, int(os.getenv("JOB_MAX_ATTEMPTS", "3")))
+    except ValueError:
+        return 3
+
+
+class JobWorkers:
+    def __init__(self) -> None:
+        self._runners: dict[str, Runner] = {}
+        self._on_drop: Runner | None = None
+        self._queue: FairQueue | None = None
+        self._limits = {"global_limit": 8, "per_user_limit": 3}
+        self._tasks: list[asyncio.Task] = []
+
+    def register(self, kind: str, runner: Runner) -> None:
+        self._runners[kind] = runner
+
+    def on_drop(self, handler: Runner) -> None:
+        """
+        Кто закрывает снятую задачу (неизвестный kind или JOB_MAX_ATTEMPTS попыток):
+        вернуть резерв пачки, сообщить пользователю, подвести итог.
+        """
+        self._on_drop = handler
+
+    def set_limits(self, *, global_limit: int, per_user_limit: int) -> None:
+        """Сколько задач выполняется одновременно: всего и у одного пользователя."""
+        self._limits = {"global_limit": global_limit, "per_user_limit": per_user_limit}
+        if self._queue is not None:
+            self._queue.global_limit = global_limit
+            self._queue.per_user_limit = per_user_limit
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._queue = FairQueue(**self._limits)
+        pending = await jobs.unfinished()
+        for job in pending:
+            self._queue.push(job.id, job.user_id, job.klass)
+        if pending:
+            log.info("resuming %d unfinished jobs", len(pending))
+        self._tasks = [
+            asyncio.create_task(self._work(), name=f"job-worker-{i}")
+            for i in range(_workers_count())
+        ]
+
+    async def enqueue(  # noqa: PLR0913
+        self,
+        kind: str,
+        user_id: int,
+        chat_id: int,
+        payloads: list[dict[str, Any]],
+        *,
+        hold_id: int | None = None,
+        summary: bool = False,
+    ) -> list[int]:
+        """Записывает пачку задач в БД и ставит их в планировщик."""
+        if self._queue is None:
+            raise RuntimeError("job workers are not started")
+        paid = "paid" if await is_paying(user_id) else "bonus"
+        klass = f"{paid}/{'single' if len(payloads) == 1 else 'batch'}"
+        job_ids = await jobs.enqueue(
+            kind, user_id, chat_id, payloads, hold_id=hold_id, summary=summary, klass=klass
+        )
+        for job_id in job_ids:
+            self._queue.push(job_id, user_id, klass)
+        return job_ids
+
+    def stats(self) -> dict[str, Any]:
+        return self._queue.stats() if self._queue is not None else {}
+
+    async def stop(self) -> None:
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._queue = None
+
+    async def _work(self) -> None:
+        queue = self._queue
+        while True:
+            entry = await queue.get()
+            try:
+                await self._run(entry.job_id)
+            except Exception as e:
+                log.exception("job %s crashed: %s", entry.job_id, e)
+            finally:
+                queue.done(entry)
+
+    async def _run(self, job_id: int) -> None:
+        job = await jobs.get(job_id)
+        if job is None or job.state not in ("queued", "submitted"):
+            return
+        job.attempts = await jobs.mark_started(job_id)
+        runner = self._runners.get(job.kind)
+        if runner is None or job.attempts > _max_attempts():
+            # why: неизвестный тип или задача, на которой процесс падал раз за разом
+            log.error("job %s (%s) dropped after %d attempts", job_id, job.kind, job.attempts)
+            if self._on_drop is not None:
+                await self._on_drop(job)
+            else:
+                await jobs.finish(job_id, ok=False, error="dropped")
+            return
+        try:
+            await runner(job)
+        except asyncio.CancelledError:
+            # why: остановка/деплой — не сбой; иначе долгая задача, пережившая
+            # JOB_MAX_ATTEMPTS деплоев, снималась бы как «падающая»
+            await jobs.unmark_started(job_id)
+            raise
+
+
+WORKERS = JobWorkers()
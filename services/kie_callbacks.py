@@ -0,0 +1,68 @@
+"""
+Приём callback'ов KIE о завершении задач.
+
+Если задан KIE_CALLBACK_URL (публичный адрес встроенного webhook-сервера),
+create_task отправляет callBackUrl, а callback будит общий опросчик
+(services/kie_poller): задача сразу проверяется recordInfo ключом, которым
+создана. Результат берём только из recordInfo — тело callback'а не
+подтверждено и могло прийти от кого угодно. Плановый опрос остаётся редким
+запасным вариантом (KIE_CALLBACK_FALLBACK_INTERVAL, по умолчанию раз в 30 с).
+"""
+
+import json
+import logging
+import os
+
+from aiohttp import web
+
+from services import webhook_server
+from services.kie_poller import POLLER
+
+log = logging.getLogger("kie_callbacks")
+
+
+def _path() -> str:
+    return os.getenv("KIE_CALLBACK_PATH", "/kie/callback")
+
+
+def is_enabled() -> bool:
+    return webhook_server.is_enabled() and bool(os.getenv("KIE_CALLBACK_URL", "").strip())
+
+
+def callback_url() -> str | None:
+    """URL для callBackUrl в createTask (или None, если callback'и выключены)."""
+    if not is_enabled():
+        return None
+    url = os.getenv("KIE_CALLBACK_URL", "").strip().rstrip("/") + _path()
+    secret = os.getenv("KIE_CALLBACK_SECRET", "").strip()
+    return f"{url}?token={secret}" if secret else url
+
+
+def fallback_interval() -> float:
+    try:
+        return float(os.getenv("KIE_CALLBACK_FALLBACK_INTERVAL", "30"))
+    except ValueError:
+        return 30.0
+
+
+async def _handle_callback(request: web.Request) -> web.Response:
+    secret = os.getenv("KIE_CALLBACK_SECRET", "").strip()
+    if secret and request.query.get("token") != secret:
+        log.warning("KIE callback с неверным token от %s", request.remote)
+        return web.Response(status=403)
+    try:
+        payload = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return web.Response(status=400)
+    data = payload.get("data") if isinstance(payload, dict) else None
+    task_id = data.get("taskId") if isinstance(data, dict) else None
+    if not isinstance(task_id, str) or not task_id or len(task_id) > 128:
+        return web.Response(status=400)
+    POLLER.deliver(task_id)
+    return web.json_response({"code": 200})
+
+
+def setup() -> None:
+    """Регистрирует маршрут callback'а во встроенном webhook-сервере."""
+    if is_enabled():
+        webhook_server.add_route("POST", _path(), _handle_callback)
@@ -1,29 +1,42 @@
-import asyncio
 import json
 import os
 from typing import Any
 
-import httpx
+from services.deadline import Deadline
+from services.http_pool import get_client
+from services.kie_keys import KEYS, ApiKey
+from services.resilience import endpoint
 
 
 class KIEError(RuntimeError):
-    pass
+    def __init__(self, message: str, status: int | None = None) -> None:
+        super().__init__(message)
+        self.status = status  # HTTP-статус или code из ответа KIE
+
+
+class KIEKeyError(KIEError):
+    """Ключ отклонён (авторизация/квота) и ушёл в карантин — повторить с другим ключом."""
+
+    def __init__(self, message: str, key_status: int) -> None:
+        # why: status=None — это не сбой провайдера, breaker kie.create его не считает
+        super().__init__(message)
+        self.key_status = key_status
 
 
 def _get_base() -> str:
     return os.getenv("KIE_API_BASE", "https://api.kie.ai").rstrip("/")
 
 
-def _get_key() -> str:
-    key = os.getenv("KIE_API_KEY", "").strip()
-    if not key:
-        raise KIEError("В .env не указан KIE_API_KEY")
+def _default_key() -> ApiKey:
+    key = KEYS.get(None)
+    if key is None:
+        raise KIEError("В .env не указан KIE_API_KEY (или KIE_API_KEYS)")
     return key
 
 
-def _headers_json() -> dict[str, str]:
+def _headers_json(key: ApiKey) -> dict[str, str]:
     return {
-        "Authorization": f"Bearer {_get_key()}",
+        "Authorization": f"Bearer {key.secret}",
         "Content-Type": "application/json",
         "Accept": "application/json",
     }
@@ -38,15 +51,35 @@ def _get_defaults() -> dict[str, Any]:
     }
 
 
-async def create_task(
+def current_model() -> str:
+    return _get_defaults()["model"]
+
+
+def request_fingerprint(prompt: str | None, extra_input: dict[str, Any] | None) -> dict[str, Any]:
+    """Всё, от чего зависит результат create_task (кроме входных картинок) — для ключа кэша."""
+    d = _get_defaults()
+    return {
+        "model": d["model"],
+        "prompt": (prompt or d["default_prompt"]).strip(),
+        "output_format": d["output_format"],
+        "image_size": d["image_size"],
+        "extra_input": extra_input or {},
+    }
+
+
+async def create_task(  # noqa: PLR0913
     *,
     prompt: str | None,
     image_url: str | None = None,
     image_urls: list[str] | None = None,
     extra_input: dict[str, Any] | None = None,
     callback_url: str | None = None,
+    key: ApiKey | None = None,
+    deadline: Deadline | None = None,
 ) -> str:
     """
+    key — ключ из пула (KEYS.lease()); без него берётся первый ключ.
+    deadline — бюджет запроса: таймаут и повторы createTask не выходят за него.
     Backward-compatible:
     - раньше было image_url: str -> теперь можно image_urls: List[str] (до 10).
     - если передан image_urls, используем его; иначе упакуем одиночный image_url.
@@ -80,58 +113,79 @@ async def create_task(
         payload["callBackUrl"] = callback_url
 
     url_create = f"{base}/api/v1/jobs/createTask"
+    key = key or _default_key()
 
-    last_err: Exception | None = None
-    for attempt in range(3):
-        try:
-            async with httpx.AsyncClient(timeout=60) as client:
-                r = await client.post(url_create, headers=_headers_json(), json=payload)
-                if r.status_code >= 400:
-                    raise KIEError(f"createTask [{r.status_code}]: {r.text}")
-                data = r.json()
-                if data.get("code") != 200:
-                    raise KIEError(
-                        f"createTask вернул ошибку: {json.dumps(data, ensure_ascii=False)}"
-                    )
-                task_id = (data.get("data") or {}).get("taskId") or ""
-                if not task_id:
-                    raise KIEError(
-                        f"createTask: нет taskId в ответе: {json.dumps(data, ensure_ascii=False)}"
-                    )
-                return task_id
-        except Exception as e:
-            last_err = e
-            await asyncio.sleep(1.5 * (attempt + 1))
-    raise KIEError(f"Не удалось создать задачу после ретраев: {last_err}")
-
-
-async def poll_result(task_id: str, *, timeout: int = 600, interval: float = 3.0) -> dict[str, Any]:
-    base = _get_base()
-    url = f"{base}/api/v1/jobs/recordInfo"
-    deadline = asyncio.get_event_loop().time() + timeout
-    last = {}
-
-    async with httpx.AsyncClient(timeout=30) as client:
-        while True:
-            r = await client.get(
-                url, headers={"Authorization": f"Bearer {_get_key()}"}, params={"taskId": task_id}
+    def check(status: int | None, text: str) -> None:
+        if KEYS.report(key, status):
+            raise KIEKeyError(
+                f"createTask: ключ {key.fingerprint} отклонён [{status}]: {text}", status
+            )
+
+    async def attempt() -> str:
+        r = await get_client("kie").post(
+            url_create,
+            headers=_headers_json(key),
+            json=payload,
+            timeout=deadline.timeout(60) if deadline else 60,
+        )
+        check(r.status_code, r.text)
+        if r.status_code >= 400:
+            raise KIEError(f"createTask [{r.status_code}]: {r.text}", r.status_code)
+        data = r.json()
+        check(data.get("code"), json.dumps(data, ensure_ascii=False))
+        if data.get("code") != 200:
+            raise KIEError(
+                f"createTask вернул ошибку: {json.dumps(data, ensure_ascii=False)}",
+                data.get("code"),
             )
-            if r.status_code >= 400:
-                raise KIEError(f"recordInfo [{r.status_code}]: {r.text}")
-            data = r.json()
-            last = data
-            if data.get("code") == 200:
-                d = data.get("data") or {}
-                state = (d.get("state") or "").lower()
-                if state == "success":
-                    return data
-                if state == "fail":
-                    fail_code = d.get("failCode")
-                    fail_msg = d.get("failMsg")
-                    param_seen = d.get("param")
-                    raise KIEError(f"KIE fail ({fail_code}): {fail_msg}. param={param_seen}")
-            if asyncio.get_event_loop().time() > deadline:
-                raise KIEError(
-                    f"Таймаут ожидания результата: {json.dumps(last, ensure_ascii=False)}"
-                )
-            await asyncio.sleep(interval)
+        task_id = (data.get("data") or {}).get("taskId") or ""
+        if not task_id:
+            raise KIEError(
+                f"createTask: нет taskId в ответе: {json.dumps(data, ensure_ascii=False)}"
+            )
+        return task_id
+
+    # why: повтор createTask — только если запрос не дошёл, иначе KIE спишет за две задачи
+    return await endpoint("kie.create").call(
+        attempt, retries=3, idempotent=False, deadline=deadline
+    )
+
+
+def record_done(data: dict[str, Any]) -> bool:
+    """
+    Разбирает ответ recordInfo (или тело callback'а KIE — формат тот же).
+    True — задача успешно завершена, False — ещё в работе, KIEError — state=fail.
+    """
+    if data.get("code") != 200:
+        return False
+    d = data.get("data") or {}
+    state = (d.get("state") or "").lower()
+    if state == "success":
+        return True
+    if state == "fail":
+        fail_code = d.get("failCode")
+        fail_msg = d.get("failMsg")
+        param_seen = d.get("param")
+        raise KIEError(f"KIE fail ({fail_code}): {fail_msg}. param={param_seen}")
+    return False
+
+
+async def fetch_record(task_id: str, key: ApiKey | None = None) -> dict[str, Any]:
+    """
+    Один запрос recordInfo без ожидания (повторы — забота опросчика).
+    key — ключ, которым создана задача: чужой ключ её не видит.
+    """
+    key = key or _default_key()
+
+    async def attempt() -> dict[str, Any]:
+        r = await get_client("kie").get(
+            f"{_get_base()}/api/v1/jobs/recordInfo",
+            headers={"Authorization": f"Bearer {key.secret}"},
+            params={"taskId": task_id},
+            timeout=30,
+        )
+        if r.status_code >= 400:
+            raise KIEError(f"recordInfo [{r.status_code}]: {r.text}", r.status_code)
+        return r.json()
+
+    return await endpoint("kie.record").call(attempt)
@@ -0,0 +1,149 @@
+"""
+Пул API-ключей KIE.
+
+Ключи — KIE_API_KEYS (через запятую) или один KIE_API_KEY. У каждого ключа
+свой лимит задач в работе (KIE_KEY_MAX_INFLIGHT: от createTask до
+результата) и частоты createTask (KIE_KEY_RPS / KIE_KEY_BURST). lease()
+выбирает наименее загруженный здоровый ключ и ждёт, если все заняты.
+
+Ключ, на который KIE ответил 401/403 (авторизация), 402 (кончились
+кредиты) или 429 (лимит аккаунта), уходит в карантин и не выбирается до
+его окончания. Задача опрашивается тем же ключом, которым создана: в БД
+хранится отпечаток ключа (fingerprint), не сам ключ.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from typing import Any
+
+from services.resilience import ProviderUnavailable, TokenBucket
+from utils.config import env_float
+
+log = logging.getLogger("kie_keys")
+
+# статус ответа -> (переменная окружения, карантин по умолчанию, с)
+_QUARANTINE: dict[int, tuple[str, float]] = {
+    401: ("KIE_KEY_QUARANTINE_AUTH_S", 3600.0),
+    403: ("KIE_KEY_QUARANTINE_AUTH_S", 3600.0),
+    402: ("KIE_KEY_QUARANTINE_QUOTA_S", 1800.0),
+    429: ("KIE_KEY_QUARANTINE_RATE_S", 60.0),
+}
+
+
+def fingerprint(secret: str) -> str:
+    return hashlib.sha256(secret.encode("utf-8")).hexdigest()[:12]
+
+
+class ApiKey:
+    def __init__(self, secret: str) -> None:
+        self.secret = secret
+        self.fingerprint = fingerprint(secret)
+        self.bucket = TokenBucket(env_float("KIE_KEY_RPS", 2), env_float("KIE_KEY_BURST", 5))
+        self.inflight = 0
+        self.quarantined_until = 0.0
+        self.reason = ""
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.quarantined_until
+
+
+class KeyPool:
+    def __init__(self) -> None:
+        self._keys: dict[str, ApiKey] = {}
+        self._loaded_from: str | None = None
+        self._released: asyncio.Event | None = None
+
+    def keys(self) -> list[ApiKey]:
+        """Ключи из окружения; пул пересобирается, если переменные поменялись."""
+        raw = os.getenv("KIE_API_KEYS", "").strip() or os.getenv("KIE_API_KEY", "").strip()
+        if raw != self._loaded_from:
+            secrets = [s.strip() for s in raw.split(",") if s.strip()]
+            # why: счётчики уже известных ключей сохраняем — на них висят задачи
+            self._keys = {
+                fp: self._keys.get(fp) or ApiKey(s)
+                for fp, s in ((fingerprint(s), s) for s in secrets)
+            }
+            self._loaded_from = raw
+        return list(self._keys.values())
+
+    def get(self, fp: str | None) -> ApiKey | None:
+        """Ключ по отпечатку; без отпечатка (старые задачи) — первый ключ пула."""
+        keys = self.keys()
+        if not fp:
+            return keys[0] if keys else None
+        return self._keys.get(fp)
+
+    def _pick(self, now: float) -> ApiKey | None:
+        limit = max(1, env_float("KIE_KEY_MAX_INFLIGHT", 8))
+        free = [k for k in self.keys() if k.healthy(now) and k.inflight < limit]
+        if not free:
+            return None
+        return min(free, key=lambda k: (k.inflight, -k.bucket.tokens()))
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator[ApiKey]:
+        """Наименее загруженный здоровый ключ на время createTask + ожидания результата."""
+        if not self.keys():
+            raise RuntimeError("В .env не указан KIE_API_KEY (или KIE_API_KEYS)")
+        while True:
+            now = time.monotonic()
+            healthy = [k for k in self.keys() if k.healthy(now)]
+            if not healthy:
+                left = min((k.quarantined_until for k in self.keys()), default=now + 60) - now
+                raise ProviderUnavailable("kie.keys", left)
+            key = self._pick(now)
+            if key is not None:
+                break
+            if self._released is None:
+                self._released = asyncio.Event()
+            self._released.clear()
+            await self._released.wait()
+        async with self.hold(key):
+            await asyncio.sleep(key.bucket.reserve())
+            yield key
+
+    @asynccontextmanager
+    async def hold(self, key: ApiKey) -> AsyncIterator[ApiKey]:
+        """Учитывает задачу на ключе (возобновлённую после рестарта — без выбора ключа)."""
+        key.inflight += 1
+        try:
+            yield key
+        finally:
+            key.inflight -= 1
+            if self._released is not None:
+                self._released.set()
+
+    def report(self, key: ApiKey, status: int | None) -> bool:
+        """Ответ KIE по ключу; -> True, если ключ отправлен в карантин."""
+        rule = _QUARANTINE.get(status or 0)
+        if rule is None:
+            return False
+        seconds = env_float(*rule)
+        key.quarantined_until = time.monotonic() + seconds
+        key.reason = str(status)
+        log.warning(
+            "KIE key %s quarantined for %.0fs (status %s)", key.fingerprint, seconds, status
+        )
+        if self._released is not None:
+            self._released.set()  # why: ждущие lease() должны заметить, что ключей не осталось
+        return True
+
+    def stats(self) -> list[dict[str, Any]]:
+        now = time.monotonic()
+        return [
+            {
+                "key": k.fingerprint,
+                "inflight": k.inflight,
+                "quarantine": round(max(0.0, k.quarantined_until - now)),
+                "reason": k.reason if not k.healthy(now) else "",
+            }
+            for k in self.keys()
+        ]
+
+
+KEYS = KeyPool()
@@ -0,0 +1,359 @@
+"""
+Единый опросчик KIE recordInfo для всех задач в работе.
+
+Задачи регистрируются по taskId и ждут future. Один цикл решает, какую задачу
+проверять следующей, держит общий лимит запросов к KIE (KIE_POLL_RPS) и раздаёт
+результаты ожидающим. Callback KIE (services/kie_callbacks) — только сигнал
+deliver(): задача проверяется recordInfo вне очереди своим ключом, а телу
+callback'а не доверяем (его может прислать кто угодно, знающий taskId).
+state=fail -> KIEError из record_done; не успела к сроку wait() -> KIEError с
+последним ответом recordInfo.
+
+Интервалы адаптивные (KIE_POLL_ADAPTIVE=1): по скользящей истории времени
+выполнения каждой модели проверяем редко в начале, в окне ожидаемого
+завершения (p10..p90) — шагом по ширине окна, плотнее всего около p50, а
+после p90 — экспоненциальный backoff с jitter.
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any
+
+from services.kie_client import KIEError, fetch_record, record_done
+from services.kie_keys import ApiKey
+from services.resilience import ProviderUnavailable, is_transient
+
+log = logging.getLogger("kie_poller")
+
+_EARLY_TTL = 600.0
+_EARLY_MAX = 1000
+_STATS_WINDOW = 200
+_STATS_MIN_SAMPLES = 5
+_WINDOW_POLLS = 8  # проверок на окно p10..p90 (не чаще базового интервала)
+
+
+def _poll_rps() -> float:
+    try:
+        return max(0.1, float(os.getenv("KIE_POLL_RPS", "5")))
+    except ValueError:
+        return 5.0
+
+
+def _adaptive_enabled() -> bool:
+    return os.getenv("KIE_POLL_ADAPTIVE", "1") == "1"
+
+
+def _max_interval() -> float:
+    try:
+        return float(os.getenv("KIE_POLL_MAX_INTERVAL", "30"))
+    except ValueError:
+        return 30.0
+
+
+class CompletionStats:
+    """Скользящее окно длительностей выполнения задач по моделям."""
+
+    def __init__(self, window: int = _STATS_WINDOW) -> None:
+        self._window = window
+        self._samples: dict[str, deque[float]] = {}
+
+    def record(self, model: str, seconds: float) -> None:
+        if seconds > 0:
+            self._samples.setdefault(model, deque(maxlen=self._window)).append(seconds)
+
+    def quantiles(self, model: str) -> tuple[float, float, float] | None:
+        """(p10, p50, p90) или None, если истории пока мало."""
+        samples = self._samples.get(model)
+        if not samples or len(samples) < _STATS_MIN_SAMPLES:
+            return None
+        q = statistics.quantiles(samples, n=10, method="inclusive")
+        return q[0], q[4], q[8]
+
+
+def next_delay(
+    elapsed: float,
+    quantiles: tuple[float, float, float] | None,
+    *,
+    interval: float,
+    late_polls: int,
+    max_interval: float,
+) -> float:
+    """
+    Задержка до следующей проверки задачи.
+    elapsed — сколько задача уже в работе; late_polls — проверок после p90.
+    """
+    if quantiles is None:
+        return interval
+    p10, p50, p90 = quantiles
+    if elapsed < p10:
+        # Рано: почти наверняка не готово — одна проверка сразу после p10 (не раньше)
+        return max(interval, p10 - elapsed) * random.uniform(1.0, 1.1)
+    if elapsed <= p90:
+        # Окно ожидаемого завершения: шаг по ширине окна, около p50 — вдвое плотнее,
+        # но не чаще базового интервала (широкое окно не должно плодить запросы)
+        step = max(interval, (p90 - p10) / _WINDOW_POLLS)
+        if abs(elapsed - p50) <= step:
+            step = max(interval, step / 2)
+        return step * random.uniform(0.8, 1.2)
+    # Хвост распределения — экспоненциальный backoff с jitter
+    delay = min(max_interval, interval * (2 ** min(late_polls, 10)))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _duration_from_record(data: dict[str, Any]) -> float | None:
+    """Время выполнения по данным KIE (costTime или completeTime-createTime, мс)."""
+    d = data.get("data") or {}
+    cost = d.get("costTime")
+    if isinstance(cost, (int, float)) and cost > 0:
+        return cost / 1000.0
+    created, completed = d.get("createTime"), d.get("completeTime")
+    if isinstance(created, (int, float)) and isinstance(completed, (int, float)):
+        return max(0.0, (completed - created) / 1000.0)
+    return None
+
+
+@dataclass
+class _Task:
+    task_id: str
+    future: asyncio.Future
+    deadline: float
+    interval: float
+    started: float
+    model: str = ""
+    adaptive: bool = False
+    key: ApiKey | None = None  # ключ, которым создана задача
+    waiters: int = 1
+    polls: int = 0
+    seq: int = 0  # последняя запись в куче; более старые — устаревшие
+    polling: bool = False
+    nudged: bool = False  # пришёл callback — проверить сразу
+    late_polls: int = 0
+
+
+class KiePoller:
+    def __init__(self) -> None:
+        self._tasks: dict[str, _Task] = {}
+        self._heap: list[tuple[float, int, str]] = []
+        self._seq = itertools.count()
+        self._wakeup: asyncio.Event | None = None
+        self._runner: asyncio.Task | None = None
+        # why: без ссылки задачу опроса может собрать GC — и её ожидающий повиснет навсегда
+        self._polls: set[asyncio.Task] = set()
+        self._next_slot = 0.0
+        # why: callback может прийти раньше, чем мы подписались на taskId (taskId -> момент)
+        self._early: dict[str, float] = {}
+        self.completion = CompletionStats()
+        self.requests = 0
+        self.completed = 0
+        self.completed_polls = 0
+
+    # ── публичный API
+    async def wait(  # noqa: PLR0913
+        self,
+        task_id: str,
+        *,
+        timeout: float = 600,
+        interval: float = 3.0,
+        first_delay: float = 0.0,
+        model: str = "",
+        key: ApiKey | None = None,
+    ) -> dict[str, Any]:
+        """
+        Ждёт завершения задачи; возвращает ответ recordInfo (state=success).
+        model — ключ истории; без него интервал фиксированный (например, при callback'ах).
+        key — ключ KIE, которым задача создана (опрос только им).
+        """
+        loop = asyncio.get_running_loop()
+        task = self._tasks.get(task_id)
+        if task is not None:
+            task.waiters += 1
+        else:
+            task = _Task(
+                task_id=task_id,
+                future=loop.create_future(),
+                deadline=loop.time() + timeout,
+                interval=interval,
+                started=loop.time(),
+                model=model,
+                adaptive=bool(model) and _adaptive_enabled(),
+                key=key,
+            )
+            self._tasks[task_id] = task
+            if self._early.pop(task_id, None) is not None:
+                self._schedule(task, loop.time())
+            else:
+                self._schedule(task, loop.time() + max(first_delay, self._delay(task, 0.0)))
+            self._ensure_runner()
+        try:
+            return await asyncio.shield(task.future)
+        finally:
+            task.waiters -= 1
+            if task.waiters <= 0:
+                self._tasks.pop(task_id, None)
+                if task.future.done() and not task.future.cancelled():
+                    task.future.exception()  # why: гасим «exception was never retrieved»
+
+    def deliver(self, task_id: str) -> None:
+        """Callback KIE по задаче: проверить её сейчас, не дожидаясь расписания."""
+        task = self._tasks.get(task_id)
+        if task is None:
+            now = time.monotonic()
+            for tid in [t for t, ts in self._early.items() if now - ts > _EARLY_TTL]:
+                self._early.pop(tid, None)
+            self._early.pop(task_id, None)
+            if len(self._early) >= _EARLY_MAX:
+                # why: taskId присылает кто угодно — память под них ограничена
+                self._early.pop(next(iter(self._early)))
+            self._early[task_id] = now
+            return
+        if task.future.done() or task.nudged:
+            return
+        task.nudged = True
+        if not task.polling:
+            self._schedule(task, asyncio.get_running_loop().time())
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "in_flight": len(self._tasks),
+            "requests": self.requests,
+            "completed": self.completed,
+            "polls_per_job": (
+                round(self.completed_polls / self.completed, 2) if self.completed else None
+            ),
+        }
+
+    # ── внутреннее
+    def _apply(self, task: _Task, payload: dict[str, Any]) -> None:
+        if task.future.done():
+            return
+        try:
+            done = record_done(payload)
+        except KIEError as e:
+            task.future.set_exception(e)
+            return
+        if done:
+            task.future.set_result(payload)
+            self._record_completion(task, payload)
+
+    def _record_completion(self, task: _Task, payload: dict[str, Any]) -> None:
+        self.completed += 1
+        self.completed_polls += task.polls
+        if task.model:
+            seconds = _duration_from_record(payload)
+            if seconds is None:
+                seconds = asyncio.get_running_loop().time() - task.started
+            self.completion.record(task.model, seconds)
+
+    def _delay(self, task: _Task, elapsed: float) -> float:
+        if not task.adaptive:
+            return 0.0 if elapsed == 0.0 else task.interval
+        quantiles = self.completion.quantiles(task.model) if task.model else None
+        if quantiles is None and elapsed == 0.0:
+            return 0.0
+        if quantiles is not None and elapsed > quantiles[2]:
+            task.late_polls += 1
+        return next_delay(
+            elapsed,
+            quantiles,
+            interval=task.interval,
+            late_polls=task.late_polls,
+            max_interval=_max_interval(),
+        )
+
+    def _schedule(self, task: _Task, when: float) -> None:
+        task.seq = next(self._seq)
+        heapq.heappush(self._heap, (when, task.seq, task.task_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _ensure_runner(self) -> None:
+        if self._runner is None or self._runner.done():
+            self._wakeup = asyncio.Event()
+            self._runner = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._tasks:
+            self._wakeup.clear()
+            now = loop.time()
+            if not self._heap:
+                await self._sleep(None)
+                continue
+            due, seq, task_id = self._heap[0]
+            if due > now:
+                await self._sleep(due - now)
+                continue
+            heapq.heappop(self._heap)
+            task = self._tasks.get(task_id)
+            if task is None or task.future.done() or seq != task.seq:
+                continue
+            # Общий лимит частоты запросов к KIE
+            gap = self._next_slot - now
+            if gap > 0:
+                await asyncio.sleep(gap)
+            self._next_slot = max(now, self._next_slot) + 1.0 / _poll_rps()
+            task.polling = True
+            poll = asyncio.create_task(self._poll_one(task))
+            self._polls.add(poll)
+            poll.add_done_callback(self._polls.discard)
+
+    async def _sleep(self, delay: float | None) -> None:
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _poll_one(self, task: _Task) -> None:
+        try:
+            await self._poll(task)
+        except Exception as e:
+            # why: иначе упавший опрос не перепланирует задачу и wait() не дождётся
+            log.exception("poll of %s crashed: %s", task.task_id, e)
+            task.polling = False
+            if not task.future.done():
+                task.future.set_exception(e)
+
+    async def _poll(self, task: _Task) -> None:
+        loop = asyncio.get_running_loop()
+        self.requests += 1
+        task.polls += 1
+        task.nudged = False
+        try:
+            data = await fetch_record(task.task_id, task.key)
+        except Exception as e:
+            task.polling = False
+            log.warning("recordInfo %s failed: %s", task.task_id, e)
+            now = loop.time()
+            if (is_transient(e) or isinstance(e, ProviderUnavailable)) and now < task.deadline:
+                # why: задача у KIE продолжается — сбой опроса не повод бросать её
+                retry = getattr(e, "retry_after", 0.0)
+                self._schedule(task, min(now + max(task.interval, retry), task.deadline))
+                return
+            if not task.future.done():
+                task.future.set_exception(e)
+            return
+        task.polling = False
+        self._apply(task, data)
+        if task.future.done():
+            return
+        now = loop.time()
+        if now > task.deadline:
+            task.future.set_exception(
+                KIEError(f"Таймаут ожидания результата: {json.dumps(data, ensure_ascii=False)}")
+            )
+            return
+        # why: callback пришёл, пока шёл этот запрос, — его ответ мог быть ещё «в работе»
+        delay = 0.0 if task.nudged else self._delay(task, now - task.started)
+        self._schedule(task, min(now + delay, task.deadline))
+
+
+POLLER = KiePoller()
@@ -0,0 +1,54 @@
+"""
+Фоновые периодические задачи обслуживания (компакция журнала и т.п.).
+
+Модули регистрируют задачи через add_job() до start(). Интервал читается при
+каждом цикле, 0 — задача выключена. Ошибка задачи логируется и не роняет цикл.
+"""
+
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+log = logging.getLogger("maintenance")
+
+Job = Callable[[], Awaitable[Any]]
+
+_JOBS: dict[str, tuple[Callable[[], float], Job, float]] = {}
+_TASKS: dict[str, asyncio.Task] = {}
+
+
+def add_job(
+    name: str, interval: Callable[[], float], job: Job, *, first_delay: float = 60.0
+) -> None:
+    """interval() — секунды между запусками; first_delay — пауза после старта бота."""
+    _JOBS[name] = (interval, job, first_delay)
+
+
+async def _loop(name: str, interval: Callable[[], float], job: Job, first_delay: float) -> None:
+    await asyncio.sleep(first_delay)
+    while True:
+        every = interval()
+        if every <= 0:
+            log.info("maintenance job %s disabled", name)
+            return
+        try:
+            result = await job()
+            log.info("maintenance job %s done: %s", name, result)
+        except Exception as e:
+            log.exception("maintenance job %s failed: %s", name, e)
+        await asyncio.sleep(every)
+
+
+async def start() -> None:
+    for name, (interval, job, first_delay) in _JOBS.items():
+        if name not in _TASKS:
+            _TASKS[name] = asyncio.create_task(_loop(name, interval, job, first_delay))
+
+
+async def stop() -> None:
+    tasks = list(_TASKS.values())
+    _TASKS.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
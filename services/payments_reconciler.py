@@ -0,0 +1,170 @@
+"""
+Фоновая сверка платежей YooKassa.
+
+Раз в YK_RECONCILE_INTERVAL_S секунд (0 — выключено) все неприменённые
+платежи из таблицы payments проверяются у провайдера пачками по
+YK_RECONCILE_BATCH, не больше YK_RECONCILE_CONCURRENCY запросов
+одновременно. Оплаченный платёж применяется через settle_payment (статус
+applied и начисление кредитов — одна транзакция), пользователю приходит
+сообщение; отменённый помечается canceled и из сверки уходит.
+
+Кнопка «Проверить оплату» идёт через тот же status(): одновременные
+проверки одного платежа склеиваются в один запрос, а свежий ответ
+(моложе YK_CHECK_MIN_INTERVAL_S) берётся из памяти — сколько ни нажимай,
+к провайдеру уходит не больше одного запроса за интервал.
+
+Уведомление YooKassa (services.payments_webhook) — повод сверить платёж
+сразу (reconcile с fresh=True), а фоновая сверка остаётся страховкой на
+случай потерянного уведомления.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+
+from services import maintenance
+from services.payments_yookassa import get_payment_status, is_enabled
+from services.resilience import endpoint
+from storage.credits import pending_payments, set_payment_status, settle_payment
+from utils.config import env_float
+
+log = logging.getLogger("payments_reconciler")
+
+# статусы YooKassa, при которых деньги получены (capture=True — подтверждение автоматическое)
+PAID = ("succeeded", "waiting_for_capture")
+
+
+def interval() -> float:
+    """Период сверки в секундах; без настроек YooKassa сверка выключена."""
+    return env_float("YK_RECONCILE_INTERVAL_S", 60) if is_enabled() else 0.0
+
+
+class Reconciler:
+    def __init__(self) -> None:
+        self._bot: Bot | None = None
+        # provider_id -> (момент ответа, статус)
+        self._seen: dict[str, tuple[float, str]] = {}
+        self._inflight: dict[str, asyncio.Future[str]] = {}
+        self.checks = 0
+        self.settled = 0
+        self.errors = 0
+        self.last_run: dict[str, int] = {}
+
+    def setup(self, bot: Bot) -> None:
+        """Регистрирует сверку в services.maintenance; bot — для уведомлений."""
+        self._bot = bot
+        maintenance.add_job("payments_reconcile", interval, self.run, first_delay=15)
+
+    # ── статус у провайдера
+    async def status(self, provider_id: str, *, fresh: bool = False) -> str:
+        """
+        Статус платежа в YooKassa: не чаще раза в YK_CHECK_MIN_INTERVAL_S на платёж.
+        fresh — не брать ответ из памяти (статус заведомо мог смениться).
+        """
+        seen = None if fresh else self._seen.get(provider_id)
+        if seen and time.monotonic() - seen[0] < env_float("YK_CHECK_MIN_INTERVAL_S", 10):
+            return seen[1]
+        fut = self._inflight.get(provider_id)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[provider_id] = fut
+        try:
+            self.checks += 1
+            # why: SDK YooKassa синхронный (requests) — в поток, чтобы не стоял event loop
+            status = await endpoint("yk.status").call(
+                lambda: asyncio.to_thread(get_payment_status, provider_id)
+            )
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # why: ошибку уже получает вызвавший; ждущих могло и не быть
+            raise
+        else:
+            fut.set_result(status)
+            self._seen[provider_id] = (time.monotonic(), status)
+            return status
+        finally:
+            self._inflight.pop(provider_id, None)
+
+    # ── применение
+    async def reconcile(
+        self, provider_id: str, *, fresh: bool = False
+    ) -> tuple[str, tuple[int, int, int | None] | None]:
+        """
+        Сверяет один платёж и применяет его, если он оплачен.
+        -> (статус у провайдера, (user_id, credits, баланс) — если начислили именно сейчас).
+        """
+        status = await self.status(provider_id, fresh=fresh)
+        if status in PAID:
+            settled = await settle_payment(provider_id)
+            if settled is not None:
+                self.settled += 1
+                log.info("payment %s settled: user %s +%s", provider_id, settled[0], settled[1])
+            self._seen.pop(provider_id, None)
+            return status, settled
+        if status == "canceled":
+            await set_payment_status(provider_id, "canceled")
+            self._seen.pop(provider_id, None)
+        return status, None
+
+    async def notify(self, user_id: int, credits: int, balance: int | None) -> None:
+        if self._bot is None:
+            return
+        text = f"Оплата подтверждена ✅. Начислено {credits} кредитов."
+        if balance is not None:
+            text += f"\nБаланс: {balance}."
+        try:
+            await self._bot.send_message(user_id, text)
+        except TelegramAPIError as e:
+            log.warning("payment notice to %s failed: %s", user_id, e)
+
+    async def _one(self, row: dict, sem: asyncio.Semaphore, counts: dict[str, int]) -> None:
+        async with sem:
+            try:
+                status, settled = await self.reconcile(row["provider_id"])
+            except Exception as e:
+                self.errors += 1
+                counts["errors"] += 1
+                log.warning("payment %s check failed: %s", row["provider_id"], e)
+                return
+        counts[status] = counts.get(status, 0) + 1
+        if settled is not None:
+            counts["settled"] += 1
+            await self.notify(*settled)
+
+    async def run(self) -> dict[str, int]:
+        """Один проход сверки по всем неприменённым платежам (задача maintenance)."""
+        batch = max(1, int(env_float("YK_RECONCILE_BATCH", 50)))
+        sem = asyncio.Semaphore(max(1, int(env_float("YK_RECONCILE_CONCURRENCY", 4))))
+        counts = {"checked": 0, "settled": 0, "errors": 0}
+        after_id = 0
+        while True:
+            rows = await pending_payments(after_id=after_id, limit=batch)
+            if not rows:
+                break
+            await asyncio.gather(*(self._one(r, sem, counts) for r in rows))
+            counts["checked"] += len(rows)
+            after_id = rows[-1]["id"]
+        # why: ответы по платежам, ушедшим из сверки, больше не нужны
+        stale = time.monotonic() - 3600
+        self._seen = {pid: v for pid, v in self._seen.items() if v[0] >= stale}
+        self.last_run = counts
+        return counts
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "checks": self.checks,
+            "settled": self.settled,
+            "errors": self.errors,
+            "last_run": self.last_run,
+        }
+
+
+RECONCILER = Reconciler()
@@ -0,0 +1,160 @@
+"""
+Приём HTTP-уведомлений YooKassa (payment.succeeded / payment.canceled).
+
+Маршрут YK_WEBHOOK_PATH (по умолчанию /yookassa/notify) регистрируется во
+встроенном webhook-сервере, если он включён (WEBHOOK_PORT) и настроена
+YooKassa. В личном кабинете YooKassa указывается публичный адрес этого
+маршрута; с YK_WEBHOOK_SECRET — с ?token=<секрет>.
+
+Уведомлению не верим на слово: отправитель должен быть из сетей YooKassa
+(YK_WEBHOOK_IP_CHECK=1, по умолчанию), а платёж — совпадать со строкой в
+payments (есть у нас, та же сумма и валюта, тот же user_id в metadata).
+И даже тогда уведомление — только повод сверить платёж: статус берётся из API
+YooKassa (RECONCILER.reconcile в обход кэша ответов), начисление — той же
+транзакцией settle_payment, что у фоновой сверки и кнопки «Проверить оплату»,
+поэтому ни поддельное, ни повторное уведомление ничего лишнего не начислит.
+Ответ 200 — уведомление обработано (или обрабатывать нечего); на другой код
+(в т.ч. 503, если API YooKassa не ответил) YooKassa повторит доставку.
+"""
+
+import ipaddress
+import json
+import logging
+import os
+from decimal import Decimal, InvalidOperation
+
+from aiohttp import web
+
+from services import webhook_server
+from services.payments_reconciler import PAID, RECONCILER
+from services.payments_yookassa import is_enabled as yk_enabled
+from storage.credits import get_payment
+
+log = logging.getLogger("payments_webhook")
+
+# адреса, с которых YooKassa шлёт уведомления (документация YooKassa)
+_YK_NETWORKS = tuple(
+    ipaddress.ip_network(n)
+    for n in (
+        "185.71.76.0/27",
+        "185.71.77.0/27",
+        "77.75.153.0/25",
+        "77.75.156.11/32",
+        "77.75.156.35/32",
+        "77.75.154.128/25",
+        "2a02:5180::/32",
+    )
+)
+
+# событие -> статус платежа, который должен быть в object.status
+_EVENTS = {"payment.succeeded": "succeeded", "payment.canceled": "canceled"}
+
+
+def _path() -> str:
+    return os.getenv("YK_WEBHOOK_PATH", "/yookassa/notify")
+
+
+def is_enabled() -> bool:
+    return webhook_server.is_enabled() and yk_enabled()
+
+
+def _trusted(remote: str | None) -> bool:
+    if os.getenv("YK_WEBHOOK_IP_CHECK", "1") != "1":
+        return True
+    try:
+        addr = ipaddress.ip_address(remote or "")
+    except ValueError:
+        return False
+    return any(addr in net for net in _YK_NETWORKS)
+
+
+def _minor(amount: dict) -> int | None:
+    """{"value": "199.00"} -> 19900 (копейки) или None, если сумма кривая."""
+    try:
+        return int(Decimal(str(amount.get("value"))) * 100)
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+
+
+def _mismatch(obj: dict, row: dict) -> str | None:
+    """Чем уведомление расходится с нашей строкой payments (None — совпадает)."""
+    amount = obj.get("amount") or {}
+    if _minor(amount) != row["amount"] or amount.get("currency") != row["currency"]:
+        return f"amount {amount} != {row['amount'] / 100:.2f} {row['currency']}"
+    user_id = (obj.get("metadata") or {}).get("user_id")
+    if user_id is not None and str(user_id) != str(row["user_id"]):
+        return f"user_id {user_id} != {row['user_id']}"
+    return None
+
+
+def _authorized(request: web.Request) -> bool:
+    secret = os.getenv("YK_WEBHOOK_SECRET", "").strip()
+    if secret and request.query.get("token") != secret:
+        log.warning("YooKassa notification с неверным token от %s", request.remote)
+        return False
+    if not _trusted(request.remote):
+        log.warning("YooKassa notification с чужого адреса %s", request.remote)
+        return False
+    return True
+
+
+async def _parse(request: web.Request) -> tuple[str | None, dict] | None:
+    """-> (ожидаемый статус платежа или None для ненужного события, object) или None — мусор."""
+    try:
+        payload = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+    if not isinstance(payload, dict) or not isinstance(payload.get("object"), dict):
+        return None
+    expected, obj = _EVENTS.get(payload.get("event")), payload["object"]
+    if expected is not None and (not obj.get("id") or obj.get("status") != expected):
+        return None
+    return expected, obj
+
+
+async def _handle_notification(request: web.Request) -> web.Response:
+    if not _authorized(request):
+        return web.Response(status=403)
+    parsed = await _parse(request)
+    if parsed is None:
+        return web.Response(status=400)
+    expected, obj = parsed
+    if expected is None:
+        return web.Response(status=200)  # why: прочие события нам не нужны, повторять незачем
+    provider_id = obj["id"]
+
+    row = await get_payment(provider_id)
+    if row is None:
+        # why: платёж создан не этим ботом — повторы YooKassa ничего не изменят
+        log.warning("YooKassa payment.%s по неизвестному платежу %s", expected, provider_id)
+        return web.Response(status=200)
+    problem = _mismatch(obj, row)
+    if problem is not None:
+        log.warning("YooKassa payment.%s по %s не совпадает: %s", expected, provider_id, problem)
+        return web.Response(status=400)
+
+    return web.Response(status=await _reconcile(row, expected))
+
+
+async def _reconcile(row: dict, expected: str) -> int:
+    """Сверяет платёж по API YooKassa -> HTTP-код ответа на уведомление."""
+    if row["status"] in ("applied", "canceled"):
+        return 200  # why: платёж уже закрыт — спрашивать API незачем
+    provider_id = row["provider_id"]
+    try:
+        status, settled = await RECONCILER.reconcile(provider_id, fresh=True)
+    except Exception as e:
+        log.warning("YooKassa payment.%s по %s: статус не получен: %s", expected, provider_id, e)
+        return 503
+    if settled is not None:
+        log.info("payment %s settled by webhook: user %s +%s", provider_id, *settled[:2])
+        await RECONCILER.notify(*settled)
+    elif status != expected and status not in PAID:
+        log.warning("YooKassa payment.%s по %s, а в API — %s", expected, provider_id, status)
+    return 200
+
+
+def setup() -> None:
+    """Регистрирует маршрут уведомлений YooKassa во встроенном webhook-сервере."""
+    if is_enabled():
+        webhook_server.add_route("POST", _path(), _handle_notification)
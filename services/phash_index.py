@@ -0,0 +1,157 @@
+"""
+Индекс перцептивных хэшей входных фото для поиска почти-дубликатов.
+
+Telegram перекодирует фото, поэтому пересланный/перезалитый кадр получает
+новый file_unique_id и точный кэш результатов промахивается. Здесь считаем
+64-битный dHash исходника и ищем ближайший по Хэммингу (BK-дерево) среди
+ранее сгенерированных с тем же промптом/параметрами.
+
+Опционально: PHASH_INDEX=1 и установленный Pillow (pip install pillow).
+Расчёт хэша идёт в пуле потоков, не блокируя event loop.
+"""
+
+import asyncio
+import io
+import logging
+import os
+
+from storage import result_cache
+
+log = logging.getLogger("phash_index")
+
+_MASK64 = (1 << 64) - 1
+
+
+def _pillow():
+    try:
+        from PIL import Image  # noqa: PLC0415
+    except ImportError:
+        return None
+    return Image
+
+
+def is_enabled() -> bool:
+    return os.getenv("PHASH_INDEX", "0") == "1" and _pillow() is not None
+
+
+def _max_distance() -> int:
+    try:
+        return int(os.getenv("PHASH_MAX_DISTANCE", "6"))
+    except ValueError:
+        return 6
+
+
+def dhash(data: bytes) -> int:
+    """64-битный difference hash: 9×8 в градациях серого, сравнение соседей по строке."""
+    image_mod = _pillow()
+    with image_mod.open(io.BytesIO(data)) as img:
+        small = img.convert("L").resize((9, 8), image_mod.Resampling.LANCZOS)
+        px = list(small.getdata())
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            h = (h << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return h
+
+
+def hamming(a: int, b: int) -> int:
+    return ((a ^ b) & _MASK64).bit_count()
+
+
+class BKTree:
+    """BK-дерево по расстоянию Хэмминга: поиск ближайшего в радиусе без полного перебора."""
+
+    def __init__(self) -> None:
+        # узел: [hash, value, {distance: child}]
+        self._root: list | None = None
+        self.size = 0
+
+    def add(self, h: int, value: str) -> None:
+        self.size += 1
+        if self._root is None:
+            self._root = [h, value, {}]
+            return
+        node = self._root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                node[1] = value  # тот же хэш — берём свежий результат
+                self.size -= 1
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, value, {}]
+                return
+            node = child
+
+    def find(self, h: int, max_dist: int) -> tuple[int, str] | None:
+        """Ближайший (distance, value) в радиусе max_dist или None."""
+        if self._root is None:
+            return None
+        best: tuple[int, str] | None = None
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= max_dist and (best is None or d < best[0]):
+                best = (d, node[1])
+            for dist, child in node[2].items():
+                if d - max_dist <= dist <= d + max_dist:
+                    stack.append(child)
+        return best
+
+
+class PhashIndex:
+    """
+    prompt_key -> BKTree(dHash -> cache_key). Персистентность — в storage.result_cache.
+    Из BK-дерева узел не удалить, поэтому после вытеснений из кэша деревья
+    перестраиваются из таблицы phash при следующем обращении.
+    """
+
+    def __init__(self) -> None:
+        self._trees: dict[str, BKTree] = {}
+        self._epoch: int | None = None  # result_cache.STATS["evictions"] на момент загрузки
+        self._load_lock: asyncio.Lock | None = None
+
+    def _fresh(self) -> bool:
+        return self._epoch == result_cache.STATS["evictions"]
+
+    async def _load(self) -> None:
+        if self._fresh():
+            return
+        if self._load_lock is None:
+            self._load_lock = asyncio.Lock()
+        async with self._load_lock:
+            if self._fresh():
+                return
+            epoch = result_cache.STATS["evictions"]
+            rows = await asyncio.to_thread(result_cache.phash_rows)
+            trees: dict[str, BKTree] = {}
+            for h, prompt_key, cache_key in rows:
+                trees.setdefault(prompt_key, BKTree()).add(h, cache_key)
+            self._trees = trees
+            self._epoch = epoch
+
+    async def hash_image(self, data: bytes) -> int | None:
+        try:
+            return await asyncio.to_thread(dhash, data)
+        except Exception as e:
+            log.warning("dHash failed: %s", e)
+            return None
+
+    async def lookup(self, h: int, prompt_key: str) -> str | None:
+        """cache_key ближайшего почти-дубликата с тем же prompt_key или None."""
+        await self._load()
+        tree = self._trees.get(prompt_key)
+        if tree is None:
+            return None
+        found = tree.find(h, _max_distance())
+        return found[1] if found else None
+
+    async def add(self, h: int, prompt_key: str, cache_key: str) -> None:
+        await self._load()
+        self._trees.setdefault(prompt_key, BKTree()).add(h, cache_key)
+        await asyncio.to_thread(result_cache.add_phash, h, prompt_key, cache_key)
+
+
+INDEX = PhashIndex()
@@ -0,0 +1,201 @@
+"""
+Защита вызовов провайдеров (KIE, TNB): лимит частоты и circuit breaker.
+
+У каждого endpoint'а (endpoint("kie.create") и т.п.) свой token bucket —
+RL_<ИМЯ>_RPS / RL_<ИМЯ>_BURST (kie.create -> RL_KIE_CREATE_RPS) — и свой
+breaker. После BREAKER_FAILURES временных сбоев подряд (сеть, таймаут, 429,
+5xx) endpoint открывается на BREAKER_COOLDOWN_S секунд: вызовы сразу падают
+с ProviderUnavailable, ничего не отправляя. Потом пропускается один пробный
+запрос (half-open): успех закрывает breaker, сбой открывает снова.
+
+Ошибки клиента (4xx, ошибка в теле ответа) не повторяются и breaker не трогают:
+провайдер жив, дело в запросе.
+"""
+
+import asyncio
+import math
+import random
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any, TypeVar
+
+import httpx
+
+from services.deadline import Deadline
+from utils.config import env_float
+
+T = TypeVar("T")
+
+# rps, burst по умолчанию
+_BUDGETS: dict[str, tuple[float, float]] = {
+    "kie.create": (10.0, 20.0),  # общий потолок; бюджет аккаунта — у ключей (kie_keys)
+    "kie.record": (10.0, 20.0),
+    "tnb.variation": (1.0, 3.0),
+    "tnb.altviews": (1.0, 3.0),
+}
+
+# why: запрос точно не дошёл до провайдера — повтор не создаст платную задачу дважды
+_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class ProviderUnavailable(RuntimeError):
+    """Endpoint закрыт breaker'ом или исчерпан лимит частоты; запрос не отправлялся."""
+
+    def __init__(self, endpoint: str, retry_after: float) -> None:
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        provider = endpoint.split(".", 1)[0].upper()
+        super().__init__(
+            f"{provider} временно недоступен, повторите через ~{max(1, math.ceil(retry_after))} с"
+        )
+
+
+def is_transient(e: BaseException) -> bool:
+    """Временный сбой: сеть, таймаут, 429 или 5xx (status — у KIEError/TNBError)."""
+    if isinstance(e, httpx.TransportError):
+        return True
+    status = getattr(e, "status", None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+def _not_sent(e: BaseException) -> bool:
+    return isinstance(e, _NOT_SENT) or getattr(e, "status", None) in (429, 503)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = max(0.01, rate)
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def reserve(self) -> float:
+        """Забирает токен; -> сколько подождать до отправки (0 — сразу)."""
+        self._refill()
+        self._tokens -= 1
+        # why: токены уходят в минус — следующие вызовы выстраиваются в очередь по времени
+        return max(0.0, -self._tokens / self.rate)
+
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+    def refund(self) -> None:
+        self._tokens = min(self.burst, self._tokens + 1)
+
+
+class Endpoint:
+    def __init__(self, name: str) -> None:
+        rate, burst = _BUDGETS.get(name, (5.0, 10.0))
+        env = "RL_" + name.upper().replace(".", "_")
+        self.name = name
+        self.bucket = TokenBucket(env_float(env + "_RPS", rate), env_float(env + "_BURST", burst))
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._probing = False
+        self.calls = 0
+        self.rejected = 0
+
+    # ── breaker
+    def retry_after(self) -> float:
+        """Сколько ещё endpoint закрыт (0 — можно звать)."""
+        if self._opened_at is None:
+            return 0.0
+        left = self._opened_at + env_float("BREAKER_COOLDOWN_S", 30) - time.monotonic()
+        if left > 0:
+            return left
+        return 1.0 if self._probing else 0.0
+
+    def _admit(self) -> None:
+        left = self.retry_after()
+        if left > 0:
+            self.rejected += 1
+            raise ProviderUnavailable(self.name, left)
+        if self._opened_at is not None:
+            self._probing = True  # half-open: этот вызов — пробный
+
+    def _record(self, *, ok: bool) -> None:
+        self._probing = False
+        if ok:
+            self._failures = 0
+            self._opened_at = None
+            return
+        self._failures += 1
+        if self._opened_at is not None or self._failures >= env_float("BREAKER_FAILURES", 5):
+            self._opened_at = time.monotonic()
+
+    # ── вызов
+    async def call(
+        self,
+        fn: Callable[[], Awaitable[T]],
+        *,
+        retries: int = 1,
+        idempotent: bool = True,
+        deadline: Deadline | None = None,
+    ) -> T:
+        """
+        Вызывает fn() с учётом лимита и breaker'а. Временные сбои повторяются до retries
+        раз с экспоненциальной паузой и jitter; неидемпотентный вызов (создание платной
+        задачи) — только если запрос точно не дошёл до провайдера. С deadline повтор
+        не начинается, если пауза и попытка уже не уложатся в остаток бюджета.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            if deadline is not None:
+                deadline.check(self.name)
+            self._admit()
+            wait = self.bucket.reserve()
+            if wait > env_float("RL_MAX_WAIT_S", 10):
+                self.bucket.refund()
+                self._probing = False
+                self.rejected += 1
+                raise ProviderUnavailable(self.name, wait)
+            try:
+                if wait:
+                    await asyncio.sleep(wait)
+                self.calls += 1
+                result = await fn()
+            except Exception as e:
+                transient = is_transient(e)
+                self._record(ok=not transient)
+                pause = min(10.0, 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+                out_of_time = deadline is not None and deadline.remaining() < pause + 1
+                retryable = transient and (idempotent or _not_sent(e))
+                if not retryable or attempt >= retries or out_of_time:
+                    raise
+            except BaseException:
+                self._probing = False  # отмена пробного вызова не должна заклинить half-open
+                raise
+            else:
+                self._record(ok=True)
+                return result
+            await asyncio.sleep(pause)
+
+    def stats(self) -> dict[str, Any]:
+        left = self.retry_after()
+        return {
+            "state": "open" if left > 0 else ("half-open" if self._opened_at else "closed"),
+            "retry_after": round(left, 1),
+            "calls": self.calls,
+            "rejected": self.rejected,
+        }
+
+
+_ENDPOINTS: dict[str, Endpoint] = {}
+
+
+def endpoint(name: str) -> Endpoint:
+    ep = _ENDPOINTS.get(name)
+    if ep is None:
+        ep = _ENDPOINTS[name] = Endpoint(name)
+    return ep
+
+
+def stats() -> dict[str, dict[str, Any]]:
+    return {name: ep.stats() for name, ep in sorted(_ENDPOINTS.items())}
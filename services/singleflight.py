@@ -0,0 +1,114 @@
+"""
+Single-flight: одинаковые одновременные запросы выполняются один раз.
+
+Первый вызов с ключом запускает работу отдельной задачей, остальные с тем же
+ключом подключаются к ней и получают тот же результат (или ту же ошибку).
+Отмена одного из ожидающих не отменяет общую работу, пока её ждёт хоть кто-то;
+когда уходит последний — работа отменяется (держать ключ провайдера и опрос
+ради результата, который никто не заберёт, незачем).
+
+Бюджет времени работы (flight.deadline) — самый поздний из deadline ожидающих:
+подключившийся позже продлевает его, но работа не живёт дольше, чем её ждут.
+
+Работа получает Flight и может сообщать о ходе дела через emit() (например,
+taskId созданной у провайдера задачи): событие получает listener каждого
+ожидающего — и тех, кто подключился уже после него.
+"""
+
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from typing import Any, TypeVar
+
+from services.deadline import Deadline
+
+T = TypeVar("T")
+
+Listener = Callable[..., Awaitable[None]]
+
+log = logging.getLogger("singleflight")
+
+
+class Flight:
+    def __init__(self, deadline: Deadline | None) -> None:
+        self.task: asyncio.Task | None = None
+        # why: копия — продление не должно менять deadline первого вызывающего
+        self.deadline = Deadline(deadline.expires_at) if deadline else Deadline.after()
+        self.waiters = 0
+        self._events: list[tuple] = []
+        self._listeners: list[Listener] = []
+
+    def _join(self, deadline: Deadline | None) -> None:
+        self.waiters += 1
+        if deadline is not None and deadline.expires_at > self.deadline.expires_at:
+            self.deadline.expires_at = deadline.expires_at
+
+    async def emit(self, *args: Any) -> None:
+        """Событие работы — всем подключённым ожидающим (ошибка одного не мешает другим)."""
+        self._events.append(args)
+        for listener in list(self._listeners):
+            await _notify(listener, args)
+
+    async def _listen(self, listener: Listener) -> None:
+        events = list(self._events)
+        self._listeners.append(listener)
+        for args in events:
+            await _notify(listener, args)
+
+
+async def _notify(listener: Listener, args: tuple) -> None:
+    try:
+        await listener(*args)
+    except Exception as e:
+        log.exception("flight listener failed: %s", e)
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self._calls: dict[str, Flight] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(
+        self,
+        key: str,
+        fn: Callable[[Flight], Awaitable[T]],
+        *,
+        listener: Listener | None = None,
+        deadline: Deadline | None = None,
+    ) -> T:
+        """
+        Результат fn(flight) для ключа key. listener — получает события flight.emit();
+        deadline — бюджет вызывающего: работа берёт flight.deadline (самый поздний из
+        ожидающих). Ждать дольше своего deadline вызывающий не должен (wait_for снаружи).
+        """
+        flight = self._calls.get(key)
+        if flight is None:
+            flight = self._calls[key] = Flight(deadline)
+            self.started += 1
+            flight.task = asyncio.create_task(fn(flight))
+            flight.task.add_done_callback(lambda t, k=key, f=flight: self._forget(k, f, t))
+        else:
+            self.coalesced += 1
+        flight._join(deadline)
+        try:
+            if listener is not None:
+                # why: события, случившиеся до подключения, проигрываются сразу
+                await flight._listen(listener)
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if listener is not None and listener in flight._listeners:
+                flight._listeners.remove(listener)
+            if flight.waiters == 0 and not flight.task.done():
+                self._forget(key, flight, None)
+                flight.task.cancel()
+
+    def _forget(self, key: str, flight: Flight, task: asyncio.Task | None) -> None:
+        if self._calls.get(key) is flight:
+            self._calls.pop(key, None)
+        if task is not None and not task.cancelled():
+            task.exception()  # why: гасим «exception was never retrieved», если все ушли
+
+    def stats(self) -> dict[str, Any]:
+        return {"in_flight": len(self._calls), "started": self.started, "coalesced": self.coalesced}
@@ -1,13 +1,17 @@
 import os
 from typing import Final
 
-import httpx
+from services.deadline import Deadline
+from services.http_pool import get_client
+from services.resilience import endpoint
 
 API_BASE: Final[str] = "https://thenewblack.ai/api/1.1/wf"
 
 
 class TNBError(RuntimeError):
-    pass
+    def __init__(self, message: str, status: int | None = None) -> None:
+        super().__init__(message)
+        self.status = status  # HTTP-статус ответа TNB
 
 
 def _get_auth() -> tuple[str, str]:
@@ -18,6 +22,11 @@ def _get_default_prompt() -> str:
     return os.getenv("TNB_DEFAULT_PROMPT", "fashion model walking")
 
 
+def request_fingerprint(prompt: str | None) -> dict[str, str]:
+    """Всё, от чего зависит результат TNB (кроме картинки) — для ключа кэша."""
+    return {"prompt": prompt or _get_default_prompt()}
+
+
 def _ensure_auth() -> None:
     email, password = _get_auth()
     if not email or not password:
@@ -29,43 +38,44 @@ def _ensure_url(url: str) -> None:
         raise TNBError(f"Некорректный URL: {url}")
 
 
-async def create_variation(image_url: str, prompt: str | None = None) -> str:
+async def _generate(
+    name: str, path: str, image_url: str, prompt: str | None, deadline: Deadline | None
+) -> str:
+    """
+    POST формы в TNB; -> URL результата. name — endpoint для лимита/breaker'а,
+    deadline — бюджет запроса (таймаут и повторы не выходят за него).
+    """
     _ensure_auth()
     _ensure_url(image_url)
     email, password = _get_auth()
-    prompt = prompt or _get_default_prompt()
     files = {
         "email": (None, email),
         "password": (None, password),
         "image": (None, image_url),
-        "prompt": (None, prompt),
+        "prompt": (None, prompt or _get_default_prompt()),
     }
-    async with httpx.AsyncClient(timeout=120) as client:
-        r = await client.post(f"{API_BASE}/variation", files=files)
+
+    async def attempt() -> str:
+        timeout = deadline.timeout(120) if deadline else 120
+        r = await get_client("tnb").post(f"{API_BASE}/{path}", files=files, timeout=timeout)
         if r.status_code >= 400:
-            raise TNBError(f"variation [{r.status_code}]: {r.text}")
+            raise TNBError(f"{path} [{r.status_code}]: {r.text}", r.status_code)
         result_url = r.text.strip().strip('"').strip()
         if not (result_url.startswith("http://") or result_url.startswith("https://")):
             raise TNBError(f"Не получили URL результата: {r.text}")
         return result_url
 
+    # why: генерация TNB платная — повторяем, только если запрос не дошёл до сервера
+    return await endpoint(name).call(attempt, retries=3, idempotent=False, deadline=deadline)
 
-async def create_alternative_views(image_url: str, prompt: str | None = None) -> str:
-    _ensure_auth()
-    _ensure_url(image_url)
-    email, password = _get_auth()
-    prompt = prompt or _get_default_prompt()
-    files = {
-        "email": (None, email),
-        "password": (None, password),
-        "image": (None, image_url),
-        "prompt": (None, prompt),
-    }
-    async with httpx.AsyncClient(timeout=120) as client:
-        r = await client.post(f"{API_BASE}/create-alternative-views", files=files)
-        if r.status_code >= 400:
-            raise TNBError(f"create-alternative-views [{r.status_code}]: {r.text}")
-        result_url = r.text.strip().strip('"').strip()
-        if not (result_url.startswith("http://") or result_url.startswith("https://")):
-            raise TNBError(f"Не получили URL результата: {r.text}")
-        return result_url  # <-- фикс: был отсутствующий return
+
+async def create_variation(
+    image_url: str, prompt: str | None = None, deadline: Deadline | None = None
+) -> str:
+    return await _generate("tnb.variation", "variation", image_url, prompt, deadline)
+
+
+async def create_alternative_views(
+    image_url: str, prompt: str | None = None, deadline: Deadline | None = None
+) -> str:
+    return await _generate("tnb.altviews", "create-alternative-views", image_url, prompt, deadline)
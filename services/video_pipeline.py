@@ -1,15 +1,74 @@
 from __future__ import annotations
 
 import asyncio
+import hashlib
 import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
 from pathlib import Path
 
 import httpx
 
-from services.kie_client import KIEError, create_task, poll_result
+from services import kie_callbacks, phash_index
+from services.deadline import Deadline
+from services.http_pool import get_client
+from services.kie_client import (
+    KIEError,
+    KIEKeyError,
+    create_task,
+    current_model,
+    request_fingerprint,
+)
+from services.kie_keys import KEYS, ApiKey
+from services.kie_poller import POLLER
+from services.singleflight import SingleFlight
 
 # why: TNB функции требуются handlers/common.py при FEATURE=VARIATION/ALT_VIEWS
-from services.the_new_black_client import create_alternative_views, create_variation
+from services.the_new_black_client import (
+    create_alternative_views,
+    create_variation,
+    request_fingerprint as tnb_fingerprint,
+)
+from storage import result_cache
+
+log = logging.getLogger("video_pipeline")
+
+# why: двойной тап по сцене / одинаковые фото+промпт не должны создавать дубли задач у провайдера
+FLIGHT = SingleFlight()
+
+_CHUNK = 64 * 1024
+
+# Сигнатуры форматов: (смещение, magic, расширение)
+_MAGIC: list[tuple[int, bytes, str]] = [
+    (0, b"\x89PNG\r\n\x1a\n", ".png"),
+    (0, b"\xff\xd8\xff", ".jpg"),
+    (8, b"WEBP", ".webp"),
+    (0, b"GIF8", ".gif"),
+    (4, b"ftyp", ".mp4"),
+]
+
+
+class DownloadError(RuntimeError):
+    pass
+
+
+@dataclass
+class ResultFile:
+    """
+    Результат генерации для отправки в Telegram — ровно одно из:
+    path (файл на диске), data (буфер в памяти) или url (публичный URL провайдера).
+    """
+
+    filename: str
+    path: Path | None = None
+    data: bytes | None = None
+    url: str | None = None
+    cached: bool = False  # отдан из кэша результатов, провайдер не вызывался
 
 
 def build_telegram_file_url(bot_token: str, file_path: str) -> str:
@@ -17,14 +76,168 @@ def build_telegram_file_url(bot_token: str, file_path: str) -> str:
     return f"https://api.telegram.org/file/bot{bot_token}/{file_path}"
 
 
+def _max_download_bytes() -> int:
+    try:
+        return int(os.getenv("DOWNLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+    except ValueError:
+        return 50 * 1024 * 1024
+
+
+def _sniff_ext(head: bytes) -> str | None:
+    """Расширение по magic bytes первых байтов файла (None — формат не распознан)."""
+    for offset, magic, ext in _MAGIC:
+        if head[offset : offset + len(magic)] == magic:
+            return ext
+    return None
+
+
+def _delivery_mode() -> str:
+    """disk (по умолчанию) | memory | url — см. _fetch_result."""
+    mode = os.getenv("RESULT_DELIVERY", "disk").strip().lower()
+    return mode if mode in ("disk", "memory", "url") else "disk"
+
+
+async def _stream(url: str, write: Callable[[bytes], object]) -> tuple[int, bytes]:
+    """Потоково качает url в write(chunk) с лимитом размера. Возвращает (size, head)."""
+    limit = _max_download_bytes()
+    size = 0
+    head = b""
+    async with get_client("download").stream("GET", url, timeout=300) as r:
+        r.raise_for_status()
+        declared = int(r.headers.get("content-length") or 0)
+        if declared > limit:
+            raise DownloadError(f"Результат слишком большой: {declared} > {limit} байт")
+        async for chunk in r.aiter_bytes(_CHUNK):
+            size += len(chunk)
+            if size > limit:
+                raise DownloadError(f"Результат больше лимита {limit} байт: {url}")
+            if len(head) < 16:
+                head += chunk[: 16 - len(head)]
+            write(chunk)
+    return size, head
+
+
+def _log_download(name: str, size: int, started: float) -> None:
+    elapsed = max(time.monotonic() - started, 1e-6)
+    log.info(
+        "download %s: %d bytes in %.2fs (%.1f KiB/s)", name, size, elapsed, size / 1024 / elapsed
+    )
+
+
 async def _download(url: str, out_path: Path) -> Path:
-    """Download result to disk; create parent dirs if needed."""
+    """
+    Скачивает результат потоково во временный файл и атомарно переименовывает.
+    Расширение out_path заменяется на определённое по содержимому (если распознано).
+    """
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    async with httpx.AsyncClient(timeout=300) as client:
-        r = await client.get(url)
-        r.raise_for_status()
-        out_path.write_bytes(r.content)
-    return out_path
+    tmp = out_path.with_name(f".{out_path.name}.{uuid.uuid4().hex}.part")
+    started = time.monotonic()
+    try:
+        with tmp.open("wb") as f:
+            size, head = await _stream(url, f.write)
+        final = out_path.with_suffix(_sniff_ext(head) or out_path.suffix)
+        os.replace(tmp, final)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    _log_download(final.name, size, started)
+    return final
+
+
+async def _download_bytes(url: str, filename: str) -> ResultFile:
+    """Как _download, но без диска: результат остаётся буфером в памяти."""
+    started = time.monotonic()
+    buf = bytearray()
+    size, head = await _stream(url, buf.extend)
+    name = str(Path(filename).with_suffix(_sniff_ext(head) or Path(filename).suffix))
+    _log_download(name, size, started)
+    return ResultFile(filename=name, data=bytes(buf))
+
+
+async def _fetch_result(url: str, out_path: Path, deadline: Deadline) -> ResultFile:
+    """
+    Забирает результат провайдера согласно RESULT_DELIVERY:
+    - disk   — файл в out_path (прежнее поведение);
+    - memory — буфер в памяти, без временных файлов;
+    - url    — отдаём Telegram сам URL провайдера (он должен быть публичным; если
+               Telegram его не заберёт — download_result докачает в память).
+    Скачивание укладывается в остаток deadline.
+    """
+    mode = _delivery_mode()
+    if mode == "url":
+        return ResultFile(filename=out_path.name, url=url)
+    if mode == "memory":
+        return await deadline.run("download", _download_bytes(url, out_path.name))
+    path = await deadline.run("download", _download(url, out_path))
+    return ResultFile(filename=path.name, path=path)
+
+
+async def download_result(res: ResultFile, deadline: Deadline) -> ResultFile:
+    """URL-результат (RESULT_DELIVERY=url) -> буфер в памяти: если Telegram не забрал URL сам."""
+    return await deadline.run("download", _download_bytes(res.url, res.filename))
+
+
+# -----------------------------
+# Кэш результатов
+# -----------------------------
+class _CacheSlot:
+    """
+    Ключи кэша одного запроса: точный (по file_unique_id) и, при PHASH_INDEX=1,
+    перцептивный (dHash исходника + тот же промпт/параметры) для почти-дубликатов.
+    """
+
+    def __init__(self, backend: str, file_unique_id: str | None, parts: dict) -> None:
+        enabled = bool(file_unique_id) and result_cache.is_enabled()
+        self.key = (
+            result_cache.make_key(backend=backend, src=file_unique_id, **parts) if enabled else None
+        )
+        self.prompt_key = result_cache.make_key(backend=backend, **parts)
+        self.phash: int | None = None
+
+    async def lookup(self, image_url: str) -> ResultFile | None:
+        if self.key is None:
+            return None
+        path = await result_cache.get(self.key)
+        if path is None and phash_index.is_enabled():
+            path = await self._lookup_near(image_url)
+        if path is None:
+            return None
+        return ResultFile(filename=path.name, path=path, cached=True)
+
+    async def _lookup_near(self, image_url: str) -> Path | None:
+        try:
+            buf = bytearray()
+            await _stream(image_url, buf.extend)
+        except (httpx.HTTPError, DownloadError) as e:
+            log.warning("phash: не удалось скачать исходник: %s", e)
+            return None
+        self.phash = await phash_index.INDEX.hash_image(bytes(buf))
+        if self.phash is None:
+            return None
+        near_key = await phash_index.INDEX.lookup(self.phash, self.prompt_key)
+        if near_key is None:
+            return None
+        path = await result_cache.get(near_key, count=False)
+        if path is not None:
+            result_cache.note_phash_hit()
+        return path
+
+    async def remember(self, res: ResultFile) -> ResultFile:
+        """Кладёт свежий результат в кэш (URL-режим не кэшируется: файла у нас нет)."""
+        if self.key is None:
+            return res
+        try:
+            if res.path is not None:
+                await result_cache.put_file(self.key, res.path)
+            elif res.data is not None:
+                await result_cache.put(self.key, res.data, Path(res.filename).suffix)
+            else:
+                return res
+            if self.phash is not None:
+                await phash_index.INDEX.add(self.phash, self.prompt_key, self.key)
+        except (OSError, sqlite3.Error) as e:
+            log.warning("result cache store failed: %s", e)
+        return res
 
 
 # -----------------------------
@@ -41,38 +254,78 @@ async def run_mock_pipeline(input_path: Path, out_dir: Path) -> Path:
 # -----------------------------
 # TNB (thenewblack.ai) helpers
 # -----------------------------
-async def run_variation_from_telegram_file(
+async def run_variation_from_telegram_file(  # noqa: PLR0913
     *,
     bot_token: str,
     tg_file_path: str,
     out_dir: Path,
     prompt: str | None = None,
-) -> Path:
-    """Generate single-image variation via TNB."""
+    file_unique_id: str | None = None,
+    deadline: Deadline | None = None,
+) -> ResultFile:
+    """Generate single-image variation via TNB. deadline — бюджет запроса (GEN_DEADLINE_S)."""
+    deadline = deadline or Deadline.after()
     image_url = build_telegram_file_url(bot_token, tg_file_path)
-    result_url = await create_variation(image_url=image_url, prompt=prompt)
+    cache = _CacheSlot("tnb_variation", file_unique_id, tnb_fingerprint(prompt))
+    hit = await cache.lookup(image_url)
+    if hit is not None:
+        return hit
+
+    flight_key = result_cache.make_key(
+        backend="tnb_variation", src=file_unique_id or image_url, **tnb_fingerprint(prompt)
+    )
+    result_url = await deadline.run(
+        "tnb",
+        FLIGHT.do(
+            flight_key,
+            lambda flight: create_variation(
+                image_url=image_url, prompt=prompt, deadline=flight.deadline
+            ),
+            deadline=deadline,
+        ),
+    )
 
     low = result_url.lower()
     ext = ".png" if low.endswith(".png") else (".jpeg" if low.endswith(".jpeg") else ".jpg")
     out_path = out_dir / f"tnb_variation_{Path(tg_file_path).stem}{ext}"
-    return await _download(result_url, out_path)
+    return await cache.remember(await _fetch_result(result_url, out_path, deadline))
 
 
-async def run_altviews_from_telegram_file(
+async def run_altviews_from_telegram_file(  # noqa: PLR0913
     *,
     bot_token: str,
     tg_file_path: str,
     out_dir: Path,
     prompt: str | None = None,
-) -> Path:
-    """Generate alternative views via TNB."""
+    file_unique_id: str | None = None,
+    deadline: Deadline | None = None,
+) -> ResultFile:
+    """Generate alternative views via TNB. deadline — бюджет запроса (GEN_DEADLINE_S)."""
+    deadline = deadline or Deadline.after()
     image_url = build_telegram_file_url(bot_token, tg_file_path)
-    result_url = await create_alternative_views(image_url=image_url, prompt=prompt)
+    cache = _CacheSlot("tnb_altviews", file_unique_id, tnb_fingerprint(prompt))
+    hit = await cache.lookup(image_url)
+    if hit is not None:
+        return hit
+
+    flight_key = result_cache.make_key(
+        backend="tnb_altviews", src=file_unique_id or image_url, **tnb_fingerprint(prompt)
+    )
+    result_url = await deadline.run(
+        "tnb",
+        FLIGHT.do(
+            flight_key,
+            lambda flight: create_alternative_views(
+                image_url=image_url, prompt=prompt, deadline=flight.deadline
+            ),
+            deadline=deadline,
+        ),
+    )
 
     low = result_url.lower()
     ext = ".png" if low.endswith(".png") else (".jpeg" if low.endswith(".jpeg") else ".jpg")
     out_path = out_dir / f"tnb_altviews_{Path(tg_file_path).stem}{ext}"
-    return await _download(result_url, out_path)
+    return await cache.remember(await _fetch_result(result_url, out_path, deadline))
 
 
 # -----------------------------
@@ -87,19 +340,23 @@ async def _choose_ext(url: str) -> str:
     return ".png"
 
 
-async def run_kie_from_telegram_file(
-    *,
-    bot_token: str,
-    tg_file_path: str,
-    out_dir: Path,
-    prompt: str | None = None,
-    extra_input: dict | None = None,
-) -> Path:
-    """KIE single-image edit."""
-    image_url = build_telegram_file_url(bot_token, tg_file_path)
-    task_id = await create_task(prompt=prompt, image_url=image_url, extra_input=extra_input)
-    rec = await poll_result(task_id, timeout=600, interval=3.0)
+async def _wait_kie(task_id: str, key: ApiKey | None, deadline: Deadline) -> dict:
+    """
+    Ждём результат в общем опросчике; при callback'ах опрос лишь страховочный.
+    Ждём не дольше 600 с и не дольше остатка deadline.
+    """
+    deadline.check("poll")
+    timeout = deadline.timeout(600)
+    if kie_callbacks.is_enabled():
+        interval = kie_callbacks.fallback_interval()
+        return await POLLER.wait(
+            task_id, timeout=timeout, interval=interval, first_delay=interval, key=key
+        )
+    return await POLLER.wait(task_id, timeout=timeout, interval=3.0, model=current_model(), key=key)
+
 
+def _result_url(rec: dict) -> str:
+    """Первый URL результата из ответа recordInfo."""
     data = rec.get("data") or {}
     result_json_str = data.get("resultJson") or ""
     if not result_json_str:
@@ -113,43 +370,166 @@ async def run_kie_from_telegram_file(
     urls = result_obj.get("resultUrls") or []
     if not urls:
         raise KIEError(f"recordInfo: no resultUrls in {result_obj}")
+    return urls[0]
+
+
+# Вызывается с (taskId, отпечаток ключа KIE) сразу после createTask — чтобы сохранить их
+# до долгого ожидания
+OnTask = Callable[[str, str], Awaitable[None]]
+
+
+async def _kie_create_and_wait(
+    image_urls: list[str],
+    prompt: str | None,
+    extra_input: dict | None,
+    on_task: OnTask | None,
+    *,
+    deadline: Deadline,
+) -> str:
+    last: KIEKeyError | None = None
+    for _ in range(len(KEYS.keys())):
+        async with KEYS.lease() as key:
+            try:
+                task_id = await create_task(
+                    prompt=prompt,
+                    image_urls=image_urls,
+                    extra_input=extra_input,
+                    callback_url=kie_callbacks.callback_url(),
+                    key=key,
+                    deadline=deadline,
+                )
+            except KIEKeyError as e:
+                # why: ключ ушёл в карантин — та же задача уходит на следующий ключ пула
+                last = e
+                continue
+            if on_task is not None:
+                await on_task(task_id, key.fingerprint)
+            return _result_url(await _wait_kie(task_id, key, deadline))
+    raise last or KIEError("Нет доступных ключей KIE")
+
+
+async def _kie_generate(  # noqa: PLR0913
+    *,
+    image_urls: list[str],
+    prompt: str | None,
+    extra_input: dict | None,
+    source: str,
+    task_id: str | None = None,
+    kie_key: str | None = None,
+    on_task: OnTask | None = None,
+    deadline: Deadline,
+) -> str:
+    """
+    create_task + ожидание результата; возвращает URL результата.
+    Одинаковые одновременные запросы (source + промпт + параметры) склеиваются в одну задачу;
+    on_task получает каждый из них. Общая задача живёт по самому позднему deadline из
+    ждущих её запросов и отменяется, когда не ждёт никто; каждый запрос ждёт не дольше
+    своего deadline.
+    task_id — уже созданная задача (возобновление после рестарта): только ждём её,
+    опрашивая ключом с отпечатком kie_key.
+    """
+    if task_id:
+        return await deadline.run(
+            "kie",
+            FLIGHT.do(
+                f"kie-task:{task_id}",
+                lambda flight: _resume_kie(task_id, kie_key, flight.deadline),
+                deadline=deadline,
+            ),
+        )
+    flight_key = result_cache.make_key(
+        backend="kie", src=source, **request_fingerprint(prompt, extra_input)
+    )
+    return await deadline.run(
+        "kie",
+        FLIGHT.do(
+            flight_key,
+            lambda flight: _kie_create_and_wait(
+                image_urls, prompt, extra_input, flight.emit, deadline=flight.deadline
+            ),
+            listener=on_task,
+            deadline=deadline,
+        ),
+    )
 
-    result_url = urls[0]
-    out_path = out_dir / f"kie_{Path(tg_file_path).stem}{await _choose_ext(result_url)}"
-    return await _download(result_url, out_path)
 
+async def _resume_kie(task_id: str, kie_key: str | None, deadline: Deadline) -> str:
+    key = KEYS.get(kie_key)
+    if key is None:
+        raise KIEError(f"Ключ KIE {kie_key} задачи {task_id} убран из KIE_API_KEYS")
+    async with KEYS.hold(key):
+        return _result_url(await _wait_kie(task_id, key, deadline))
 
-async def run_kie_from_telegram_files(
+
+async def run_kie_from_telegram_file(  # noqa: PLR0913
+    *,
+    bot_token: str,
+    tg_file_path: str,
+    out_dir: Path,
+    prompt: str | None = None,
+    extra_input: dict | None = None,
+    file_unique_id: str | None = None,
+    task_id: str | None = None,
+    kie_key: str | None = None,
+    on_task: OnTask | None = None,
+    deadline: Deadline | None = None,
+) -> ResultFile:
+    """
+    KIE single-image edit. file_unique_id включает кэш результатов.
+    task_id/kie_key/on_task — для очереди задач (storage.jobs): продолжить задачу KIE
+    или запомнить её taskId и ключ. deadline — бюджет запроса (по умолчанию GEN_DEADLINE_S).
+    """
+    deadline = deadline or Deadline.after()
+    image_url = build_telegram_file_url(bot_token, tg_file_path)
+    cache = _CacheSlot("kie", file_unique_id, request_fingerprint(prompt, extra_input))
+    hit = await cache.lookup(image_url)
+    if hit is not None:
+        return hit
+
+    result_url = await _kie_generate(
+        image_urls=[image_url],
+        prompt=prompt,
+        extra_input=extra_input,
+        source=file_unique_id or image_url,
+        task_id=task_id,
+        kie_key=kie_key,
+        on_task=on_task,
+        deadline=deadline,
+    )
+    # why: сцены одной фотографии идут параллельно — имя файла должно различаться по промпту
+    tag = hashlib.sha1((prompt or "").encode("utf-8")).hexdigest()[:8]
+    out_path = out_dir / f"kie_{Path(tg_file_path).stem}_{tag}{await _choose_ext(result_url)}"
+    return await cache.remember(await _fetch_result(result_url, out_path, deadline))
+
+
+async def run_kie_from_telegram_files(  # noqa: PLR0913
     *,
     bot_token: str,
     tg_file_paths: list[str],
     out_dir: Path,
     prompt: str | None = None,
     extra_input: dict | None = None,
-) -> Path:
+    task_id: str | None = None,
+    kie_key: str | None = None,
+    on_task: OnTask | None = None,
+    deadline: Deadline | None = None,
+) -> ResultFile:
     """KIE multi-image edit (up to 10 input images in one task)."""
+    deadline = deadline or Deadline.after()
     if not tg_file_paths:
         throw = KIEError("Empty input list")
         raise throw
 
     urls_in = [build_telegram_file_url(bot_token, p) for p in tg_file_paths][:10]
-    task_id = await create_task(prompt=prompt, image_urls=urls_in, extra_input=extra_input)
-    rec = await poll_result(task_id, timeout=600, interval=3.0)
-
-    data = rec.get("data") or {}
-    result_json_str = data.get("resultJson") or ""
-    if not result_json_str:
-        raise KIEError(f"recordInfo: empty resultJson: {rec}")
-
-    try:
-        result_obj = json.loads(result_json_str)
-    except Exception as e:
-        raise KIEError(f"recordInfo: bad resultJson: {result_json_str}") from e
-
-    urls_out = result_obj.get("resultUrls") or []
-    if not urls_out:
-        raise KIEError(f"recordInfo: no resultUrls in {result_obj}")
-
-    result_url = urls_out[0]
+    result_url = await _kie_generate(
+        image_urls=urls_in,
+        prompt=prompt,
+        extra_input=extra_input,
+        source="|".join(urls_in),
+        task_id=task_id,
+        kie_key=kie_key,
+        on_task=on_task,
+        deadline=deadline,
+    )
     out_path = out_dir / f"kie_album_{Path(tg_file_paths[0]).stem}{await _choose_ext(result_url)}"
-    return await _download(result_url, out_path)
+    return await _fetch_result(result_url, out_path, deadline)
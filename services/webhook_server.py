@@ -0,0 +1,52 @@
+"""
+Встроенный HTTP-сервер (aiohttp) для входящих уведомлений провайдеров.
+
+Модули регистрируют маршруты через add_route() до start().
+Сервер поднимается, только если задан WEBHOOK_PORT.
+"""
+
+import logging
+import os
+from collections.abc import Awaitable, Callable
+
+from aiohttp import web
+
+log = logging.getLogger("webhook_server")
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+_ROUTES: dict[tuple[str, str], Handler] = {}
+_RUNNER: dict[str, web.AppRunner] = {}
+
+
+def is_enabled() -> bool:
+    return bool(os.getenv("WEBHOOK_PORT", "").strip())
+
+
+def add_route(method: str, path: str, handler: Handler) -> None:
+    _ROUTES[(method.upper(), path)] = handler
+
+
+def build_app() -> web.Application:
+    app = web.Application(client_max_size=1024 * 1024)
+    for (method, path), handler in _ROUTES.items():
+        app.router.add_route(method, path, handler)
+    return app
+
+
+async def start() -> None:
+    if not is_enabled() or "app" in _RUNNER:
+        return
+    host = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    port = int(os.getenv("WEBHOOK_PORT", "8080"))
+    runner = web.AppRunner(build_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    _RUNNER["app"] = runner
+    log.info("Webhook server listening on %s:%s (%d routes)", host, port, len(_ROUTES))
+
+
+async def stop() -> None:
+    runner = _RUNNER.pop("app", None)
+    if runner is not None:
+        await runner.cleanup()
@@ -1,157 +1,545 @@
+import logging
+import os
 import sqlite3
-import threading
 import time
+from collections import OrderedDict
 from pathlib import Path
 
+from storage.db import Database, migrate
+
+log = logging.getLogger("credits")
+
 _DB_PATH = Path("storage") / "credits.sqlite3"
-_LOCK = threading.RLock()
+# why: соединения открываются лениво при первом запросе, а не при импорте модуля
+DB = Database(_DB_PATH)
+
+
+def _cache_size() -> int:
+    try:
+        return int(os.getenv("BALANCE_CACHE_SIZE", "10000"))
+    except ValueError:
+        return 10000
+
+
+class _BalanceCache:
+    """
+    user_id -> баланс в памяти процесса (LRU на BALANCE_CACHE_SIZE записей).
+
+    Мутаторы пишут сюда баланс после COMMIT (write-through); чтения из БД
+    кладут значение, только если за время чтения не было ни одной записи —
+    иначе устаревший SELECT мог бы затереть свежий баланс.
+    """
+
+    def __init__(self) -> None:
+        self._data: OrderedDict[int, int] = OrderedDict()
+        self.epoch = 0
+
+    def get(self, user_id: int) -> int | None:
+        value = self._data.get(user_id)
+        if value is not None:
+            self._data.move_to_end(user_id)
+        return value
+
+    def put(self, user_id: int, balance: int) -> None:
+        self.epoch += 1
+        self._set(user_id, balance)
+
+    def fill(self, user_id: int, balance: int, epoch: int) -> None:
+        if epoch == self.epoch:
+            self._set(user_id, balance)
+
+    def drop(self, user_id: int) -> None:
+        self.epoch += 1
+        self._data.pop(user_id, None)
+
+    def _set(self, user_id: int, balance: int) -> None:
+        limit = _cache_size()
+        if limit <= 0:
+            return
+        self._data[user_id] = balance
+        self._data.move_to_end(user_id)
+        while len(self._data) > limit:
+            self._data.popitem(last=False)
+
+
+BALANCES = _BalanceCache()
+
+
+# ── Схема: версионные миграции по PRAGMA user_version
+def _schema_v1(conn: sqlite3.Connection) -> None:
+    """Исходные таблицы (IF NOT EXISTS — базы до версионирования проходят без изменений)."""
+    conn.execute(
+        """
+    CREATE TABLE IF NOT EXISTS users(
+        user_id INTEGER PRIMARY KEY,
+        credits INTEGER NOT NULL DEFAULT 0,
+        welcomed INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER NOT NULL
+    );"""
+    )
+    conn.execute(
+        """
+    CREATE TABLE IF NOT EXISTS transactions(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        type TEXT NOT NULL,                -- 'bonus'|'spend'|'purchase'|'adjust'
+        amount INTEGER NOT NULL,           -- + / - в кредитах
+        meta TEXT,
+        created_at INTEGER NOT NULL,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    );"""
+    )
+    conn.execute(
+        """
+    CREATE TABLE IF NOT EXISTS payments(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        provider TEXT NOT NULL,            -- 'yookassa'
+        provider_id TEXT NOT NULL UNIQUE,  -- payment_id
+        user_id INTEGER NOT NULL,
+        credits INTEGER NOT NULL,
+        amount INTEGER NOT NULL,           -- в минорных единицах (копейки)
+        currency TEXT NOT NULL,
+        status TEXT NOT NULL,              -- 'new'|'succeeded'|'applied'|'canceled'
+        created_at INTEGER NOT NULL,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    );"""
+    )
+    # Резервы кредитов под идущую генерацию: списаны с users.credits, но ещё не потрачены
+    conn.execute(
+        """
+    CREATE TABLE IF NOT EXISTS holds(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,           -- сколько ещё удерживается
+        created_at INTEGER NOT NULL,
+        expires_at INTEGER NOT NULL,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    );"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS holds_expires ON holds(expires_at);")
+
+
+def _schema_v2(conn: sqlite3.Connection) -> None:
+    """Индексы под выборки журнала: история пользователя, платежи по статусу, окна по времени."""
+    conn.execute("CREATE INDEX IF NOT EXISTS tx_user_id ON transactions(user_id, id);")
+    conn.execute("CREATE INDEX IF NOT EXISTS tx_type_created ON transactions(type, created_at);")
+    conn.execute("CREATE INDEX IF NOT EXISTS pay_status_id ON payments(status, id);")
+    conn.execute("CREATE INDEX IF NOT EXISTS pay_user_id ON payments(user_id, id);")
+
+
+def _schema_v3(conn: sqlite3.Connection) -> None:
+    """История по времени: снимки компакции (storage.ledger) новые по id, но старые по дате."""
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS tx_user_created ON transactions(user_id, created_at, id);"
+    )
+
+
+# Только дописывать в конец: номер миграции = её позиция + 1
+_MIGRATIONS = [_schema_v1, _schema_v2, _schema_v3]
+
+
+def _init_db(conn: sqlite3.Connection) -> None:
+    migrate(conn, _MIGRATIONS)
 
 
-def _connect() -> sqlite3.Connection:
-    _DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(_DB_PATH, check_same_thread=False, isolation_level=None)
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA foreign_keys=ON;")
-    return conn
+def _enable_incremental_vacuum(conn: sqlite3.Connection) -> None:
+    # why: без auto_vacuum=INCREMENTAL место после компакции журнала не вернуть по частям
+    if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+        conn.execute("VACUUM;")  # однократно: переводит существующий файл в новый режим
+        log.info("credits db switched to incremental auto_vacuum")
 
 
-_CONN = _connect()
+async def init_db() -> None:
+    await DB.write(_init_db)
+    await DB.maintenance(_enable_incremental_vacuum)
 
 
-def init_db() -> None:
-    with _LOCK, _CONN:
-        _CONN.execute(
-            """
-        CREATE TABLE IF NOT EXISTS users(
-            user_id INTEGER PRIMARY KEY,
-            credits INTEGER NOT NULL DEFAULT 0,
-            welcomed INTEGER NOT NULL DEFAULT 0,
-            created_at INTEGER NOT NULL
-        );"""
+def close_db() -> None:
+    DB.close()
+
+
+def _ensure_user(conn: sqlite3.Connection, user_id: int, welcome_credits: int) -> tuple[bool, int]:
+    now = int(time.time())
+    cur = conn.execute("SELECT credits, welcomed FROM users WHERE user_id=?", (user_id,))
+    row = cur.fetchone()
+    if row is None:
+        conn.execute(
+            "INSERT INTO users(user_id, credits, welcomed, created_at) VALUES(?,?,?,?)",
+            (user_id, 0, 0, now),
         )
-        _CONN.execute(
-            """
-        CREATE TABLE IF NOT EXISTS transactions(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            type TEXT NOT NULL,                -- 'bonus'|'spend'|'purchase'|'adjust'
-            amount INTEGER NOT NULL,           -- + / - в кредитах
-            meta TEXT,
-            created_at INTEGER NOT NULL,
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        );"""
+        is_new = True
+        credits = 0
+    else:
+        credits, welcomed = row
+        is_new = False
+
+    if is_new and welcome_credits > 0:
+        conn.execute(
+            "UPDATE users SET credits=?, welcomed=1 WHERE user_id=?", (welcome_credits, user_id)
         )
-        _CONN.execute(
-            """
-        CREATE TABLE IF NOT EXISTS payments(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            provider TEXT NOT NULL,            -- 'yookassa'
-            provider_id TEXT NOT NULL UNIQUE,  -- payment_id
-            user_id INTEGER NOT NULL,
-            credits INTEGER NOT NULL,
-            amount INTEGER NOT NULL,           -- в минорных единицах (копейки)
-            currency TEXT NOT NULL,
-            status TEXT NOT NULL,              -- 'new'|'succeeded'|'applied'|'canceled'
-            created_at INTEGER NOT NULL,
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
-        );"""
+        conn.execute(
+            "INSERT INTO transactions(user_id, type, amount, meta, created_at) VALUES(?,?,?,?,?)",
+            (user_id, "bonus", welcome_credits, "welcome", now),
         )
+        credits = welcome_credits
+    return is_new, credits
+
 
+def _read_balance(conn: sqlite3.Connection, user_id: int) -> int | None:
+    row = conn.execute("SELECT credits FROM users WHERE user_id=?", (user_id,)).fetchone()
+    return int(row[0]) if row else None
 
-def ensure_user(user_id: int, welcome_credits: int = 0) -> tuple[bool, int]:
+
+async def ensure_user(user_id: int, welcome_credits: int = 0) -> tuple[bool, int]:
     """Возвращает (is_new, current_credits). Начисляет welcome один раз."""
-    now = int(time.time())
-    with _LOCK, _CONN:
-        cur = _CONN.execute("SELECT credits, welcomed FROM users WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        if row is None:
-            _CONN.execute(
-                "INSERT INTO users(user_id, credits, welcomed, created_at) VALUES(?,?,?,?)",
-                (user_id, 0, 0, now),
-            )
-            is_new = True
-            credits = 0
-        else:
-            credits, welcomed = row
-            is_new = False
-
-        if is_new and welcome_credits > 0:
-            _CONN.execute(
-                "UPDATE users SET credits=?, welcomed=1 WHERE user_id=?", (welcome_credits, user_id)
-            )
-            _CONN.execute(
-                "INSERT INTO transactions(user_id, type, amount, meta, created_at) VALUES(?,?,?,?,?)",
-                (user_id, "bonus", welcome_credits, "welcome", now),
-            )
-            credits = welcome_credits
-    return is_new, credits
+    cached = BALANCES.get(user_id)
+    if cached is not None:
+        return False, cached
+    epoch = BALANCES.epoch
+    balance = await DB.read(lambda c: _read_balance(c, user_id))
+    if balance is not None:
+        # why: известный пользователь — хватает чтения, без захвата писателя
+        BALANCES.fill(user_id, balance, epoch)
+        return False, balance
+    is_new, balance = await DB.write(lambda c: _ensure_user(c, user_id, welcome_credits))
+    BALANCES.put(user_id, balance)
+    return is_new, balance
 
 
-def get_balance(user_id: int) -> int:
-    with _LOCK, _CONN:
-        cur = _CONN.execute("SELECT credits FROM users WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        return int(row[0]) if row else 0
+async def get_balance(user_id: int) -> int:
+    cached = BALANCES.get(user_id)
+    if cached is not None:
+        return cached
+    epoch = BALANCES.epoch
+    balance = await DB.read(lambda c: _read_balance(c, user_id))
+    if balance is None:
+        return 0
+    BALANCES.fill(user_id, balance, epoch)
+    return balance
 
 
-def add_credits(user_id: int, amount: int, reason: str) -> None:
-    now = int(time.time())
+async def is_paying(user_id: int) -> bool:
+    """Была ли у пользователя хоть одна покупка/начисление (для класса приоритета)."""
+    row = await DB.read(
+        lambda c: c.execute(
+            "SELECT 1 FROM transactions WHERE user_id=? AND type='purchase' LIMIT 1", (user_id,)
+        ).fetchone()
+    )
+    return row is not None
+
+
+def _add_credits(conn: sqlite3.Connection, user_id: int, amount: int, reason: str) -> int | None:
+    conn.execute(
+        "UPDATE users SET credits=COALESCE(credits,0)+? WHERE user_id=?", (amount, user_id)
+    )
+    conn.execute(
+        "INSERT INTO transactions(user_id, type, amount, meta, created_at) VALUES(?,?,?,?,?)",
+        (user_id, "purchase", amount, reason, int(time.time())),
+    )
+    return _read_balance(conn, user_id)
+
+
+async def add_credits(user_id: int, amount: int, reason: str) -> None:
     if amount <= 0:
         return
-    with _LOCK, _CONN:
-        _CONN.execute(
-            "UPDATE users SET credits=COALESCE(credits,0)+? WHERE user_id=?", (amount, user_id)
-        )
-        _CONN.execute(
-            "INSERT INTO transactions(user_id, type, amount, meta, created_at) VALUES(?,?,?,?,?)",
-            (user_id, "purchase", amount, reason, now),
-        )
+    try:
+        balance = await DB.write(lambda c: _add_credits(c, user_id, amount, reason))
+    except Exception:
+        BALANCES.drop(user_id)  # why: исход неизвестен — следующее чтение пойдёт в БД
+        raise
+    if balance is not None:
+        BALANCES.put(user_id, balance)
+
 
+def _spend_credits(conn: sqlite3.Connection, user_id: int, amount: int) -> tuple[bool, int] | None:
+    have = _read_balance(conn, user_id)
+    if have is None:
+        return None
+    if have < amount:
+        return False, have
+    conn.execute("UPDATE users SET credits=credits-? WHERE user_id=?", (amount, user_id))
+    conn.execute(
+        "INSERT INTO transactions(user_id, type, amount, meta, created_at) VALUES(?,?,?,?,?)",
+        (user_id, "spend", -amount, "image", int(time.time())),
+    )
+    return True, have - amount
 
-def spend_credits(user_id: int, amount: int) -> bool:
+
+async def spend_credits(user_id: int, amount: int) -> bool:
     if amount <= 0:
         return True
-    with _LOCK, _CONN:
-        cur = _CONN.execute("SELECT credits FROM users WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        have = int(row[0]) if row else 0
-        if have < amount:
-            return False
-        _CONN.execute("UPDATE users SET credits=credits-? WHERE user_id=?", (amount, user_id))
-        _CONN.execute(
-            "INSERT INTO transactions(user_id, type, amount, meta, created_at) VALUES(?,?,?,?,?)",
-            (user_id, "spend", -amount, "image", int(time.time())),
-        )
+    try:
+        outcome = await DB.write(lambda c: _spend_credits(c, user_id, amount))
+    except Exception:
+        BALANCES.drop(user_id)
+        raise
+    if outcome is None:
+        return False
+    ok, balance = outcome
+    BALANCES.put(user_id, balance)
+    return ok
+
+
+def _hold_ttl() -> int:
+    try:
+        return int(os.getenv("CREDIT_HOLD_TTL", "1800"))
+    except ValueError:
+        return 1800
+
+
+def _release_expired(conn: sqlite3.Connection, now: int) -> list[tuple[int, int]]:
+    """Возвращает просроченные резервы на баланс; -> [(user_id, новый баланс)]."""
+    rows = conn.execute(
+        "SELECT id, user_id, amount FROM holds WHERE expires_at <= ?", (now,)
+    ).fetchall()
+    for hold_id, user_id, amount in rows:
+        conn.execute("UPDATE users SET credits=credits+? WHERE user_id=?", (amount, user_id))
+        conn.execute("DELETE FROM holds WHERE id=?", (hold_id,))
+    users = {user_id for _, user_id, _ in rows}
+    return [(user_id, _read_balance(conn, user_id) or 0) for user_id in users]
+
+
+async def release_expired_holds() -> int:
+    released = await DB.write(lambda c: _release_expired(c, int(time.time())))
+    for user_id, balance in released:
+        BALANCES.put(user_id, balance)
+    return len(released)
+
+
+def renew_interval() -> float:
+    """Как часто продлевать резервы задач в очереди: трижды за CREDIT_HOLD_TTL."""
+    return max(1.0, _hold_ttl() / 3)
+
+
+def _extend_holds(conn: sqlite3.Connection, hold_ids: list[int], until: int) -> int:
+    marks = ",".join("?" * len(hold_ids))
+    return conn.execute(
+        f"UPDATE holds SET expires_at=MAX(expires_at, ?) WHERE id IN ({marks})",
+        (until, *hold_ids),
+    ).rowcount
+
+
+async def extend_holds(hold_ids: list[int]) -> int:
+    """Продлевает резервы ещё на CREDIT_HOLD_TTL от текущего момента; -> сколько продлено."""
+    if not hold_ids:
+        return 0
+    until = int(time.time()) + _hold_ttl()
+    return await DB.write(lambda c: _extend_holds(c, hold_ids, until))
+
+
+def _reserve(
+    conn: sqlite3.Connection, user_id: int, amount: int
+) -> tuple[int | None, list[tuple[int, int]]]:
+    now = int(time.time())
+    balances = _release_expired(conn, now)
+    cur = conn.execute(
+        "UPDATE users SET credits=credits-? WHERE user_id=? AND credits>=?",
+        (amount, user_id, amount),
+    )
+    hold_id = None
+    if cur.rowcount:
+        hold_id = conn.execute(
+            "INSERT INTO holds(user_id, amount, created_at, expires_at) VALUES(?,?,?,?)",
+            (user_id, amount, now, now + _hold_ttl()),
+        ).lastrowid
+    balance = _read_balance(conn, user_id)
+    if balance is not None:
+        balances.append((user_id, balance))
+    return hold_id, balances
+
+
+async def reserve_credits(user_id: int, amount: int) -> int | None:
+    """
+    Резервирует amount кредитов одним условным UPDATE; -> hold_id или None,
+    если кредитов не хватает. Дальше: commit_hold за каждый результат,
+    release_hold в конце (неизрасходованное вернётся на баланс). Забытый
+    резерв вернётся сам через CREDIT_HOLD_TTL секунд; резервы пачек, которые
+    ещё в очереди, продлевает handlers.jobs.renew_holds.
+    """
+    hold_id, balances = await DB.write(lambda c: _reserve(c, user_id, amount))
+    for uid, balance in balances:
+        BALANCES.put(uid, balance)
+    return hold_id
+
+
+def _commit_hold(conn: sqlite3.Connection, hold_id: int, amount: int, meta: str) -> bool:
+    row = conn.execute("SELECT user_id, amount FROM holds WHERE id=?", (hold_id,)).fetchone()
+    if row is None:
+        return False
+    user_id, held = row
+    if held < amount:
+        return False
+    conn.execute("UPDATE holds SET amount=amount-? WHERE id=?", (amount, hold_id))
+    conn.execute(
+        "INSERT INTO transactions(user_id, type, amount, meta, created_at) VALUES(?,?,?,?,?)",
+        (user_id, "spend", -amount, meta, int(time.time())),
+    )
     return True
 
 
-def register_payment(
+async def commit_hold(hold_id: int, amount: int = 1, meta: str = "image") -> bool:
+    """Тратит amount из резерва (баланс не меняется — он уже уменьшен при резерве)."""
+    if amount <= 0:
+        return True
+    return await DB.write(lambda c: _commit_hold(c, hold_id, amount, meta))
+
+
+def _release_hold(conn: sqlite3.Connection, hold_id: int) -> tuple[int, int] | None:
+    row = conn.execute("SELECT user_id, amount FROM holds WHERE id=?", (hold_id,)).fetchone()
+    if row is None:
+        return None
+    user_id, held = row
+    conn.execute("UPDATE users SET credits=credits+? WHERE user_id=?", (held, user_id))
+    conn.execute("DELETE FROM holds WHERE id=?", (hold_id,))
+    return user_id, _read_balance(conn, user_id) or 0
+
+
+async def release_hold(hold_id: int) -> None:
+    """Возвращает неизрасходованный остаток резерва на баланс и закрывает резерв."""
+    try:
+        released = await DB.write(lambda c: _release_hold(c, hold_id))
+    except Exception:
+        log.exception("release_hold %s failed, hold will expire", hold_id)
+        return
+    if released is not None:
+        BALANCES.put(*released)
+
+
+async def register_payment(
     provider_id: str, user_id: int, credits: int, amount_minor: int, currency: str
 ) -> None:
-    with _LOCK, _CONN:
-        _CONN.execute(
+    await DB.write(
+        lambda c: c.execute(
             """INSERT OR IGNORE INTO payments(provider, provider_id, user_id, credits, amount, currency, status, created_at)
                          VALUES('yookassa',?,?,?,?,?,'new',?)""",
             (provider_id, user_id, credits, amount_minor, currency, int(time.time())),
         )
+    )
 
 
-def set_payment_status(provider_id: str, status: str) -> None:
-    with _LOCK, _CONN:
-        _CONN.execute("UPDATE payments SET status=? WHERE provider_id=?", (status, provider_id))
+async def set_payment_status(provider_id: str, status: str) -> None:
+    await DB.write(
+        lambda c: c.execute(
+            "UPDATE payments SET status=? WHERE provider_id=?", (status, provider_id)
+        )
+    )
+
+
+def _mark_payment_applied(conn: sqlite3.Connection, provider_id: str) -> tuple[int, int] | None:
+    cur = conn.execute(
+        "SELECT user_id, credits, status FROM payments WHERE provider_id=?", (provider_id,)
+    )
+    row = cur.fetchone()
+    if not row:
+        return None
+    user_id, credits, status = row
+    if status == "applied":
+        return None
+    conn.execute("UPDATE payments SET status='applied' WHERE provider_id=?", (provider_id,))
+    return (user_id, credits)
 
 
-def mark_payment_applied(provider_id: str) -> tuple[int, int] | None:
+async def mark_payment_applied(provider_id: str) -> tuple[int, int] | None:
     """Возвращает (user_id, credits) если переведён в applied, иначе None."""
-    with _LOCK, _CONN:
-        cur = _CONN.execute(
-            "SELECT user_id, credits, status FROM payments WHERE provider_id=?", (provider_id,)
-        )
-        row = cur.fetchone()
-        if not row:
-            return None
-        user_id, credits, status = row
-        if status == "applied":
-            return None
-        _CONN.execute("UPDATE payments SET status='applied' WHERE provider_id=?", (provider_id,))
-        return (user_id, credits)
+    return await DB.write(lambda c: _mark_payment_applied(c, provider_id))
+
+
+def _settle_payment(
+    conn: sqlite3.Connection, provider_id: str
+) -> tuple[int, int, int | None] | None:
+    applied = _mark_payment_applied(conn, provider_id)
+    if applied is None:
+        return None
+    user_id, credits = applied
+    if credits <= 0:
+        return user_id, credits, _read_balance(conn, user_id)
+    return user_id, credits, _add_credits(conn, user_id, credits, f"yookassa:{provider_id}")
+
+
+async def settle_payment(provider_id: str) -> tuple[int, int, int | None] | None:
+    """
+    Оплаченный платёж -> applied и начисление кредитов одной транзакцией.
+    Возвращает (user_id, credits, баланс) тому, кто применил платёж; None — уже применён
+    (или такого платежа нет), так что повторный вызов ничего не начислит.
+    """
+    settled = await DB.write(lambda c: _settle_payment(c, provider_id))
+    if settled is not None and settled[2] is not None:
+        BALANCES.put(settled[0], settled[2])
+    return settled
+
+
+def _get_payment(conn: sqlite3.Connection, provider_id: str) -> dict | None:
+    row = conn.execute(
+        """SELECT id, provider_id, user_id, credits, amount, currency, status, created_at
+           FROM payments WHERE provider_id=?""",
+        (provider_id,),
+    ).fetchone()
+    keys = ("id", "provider_id", "user_id", "credits", "amount", "currency", "status", "created_at")
+    return dict(zip(keys, row, strict=True)) if row else None
+
+
+async def get_payment(provider_id: str) -> dict | None:
+    return await DB.read(lambda c: _get_payment(c, provider_id))
+
+
+# ── Выборки журнала (keyset-пагинация: курсор — ключ сортировки последней строки страницы)
+def _user_history(
+    conn: sqlite3.Connection, user_id: int, before: tuple[int, int] | None, limit: int
+) -> list[dict]:
+    created_at, id_ = before if before is not None else (1 << 62, 1 << 62)
+    rows = conn.execute(
+        """SELECT id, type, amount, meta, created_at FROM transactions
+           WHERE user_id=? AND (created_at, id) < (?, ?)
+           ORDER BY created_at DESC, id DESC LIMIT ?""",
+        (user_id, created_at, id_, limit),
+    ).fetchall()
+    keys = ("id", "type", "amount", "meta", "created_at")
+    return [dict(zip(keys, row, strict=True)) for row in rows]
+
+
+async def user_history(
+    user_id: int, *, before: tuple[int, int] | None = None, limit: int = 20
+) -> list[dict]:
+    """
+    Операции пользователя от новых к старым (по created_at, затем id);
+    следующая страница — before=(created_at, id) последней строки.
+    """
+    return await DB.read(lambda c: _user_history(c, user_id, before, limit))
+
+
+def _pending_payments(
+    conn: sqlite3.Connection, after_id: int, limit: int, statuses: tuple[str, ...]
+) -> list[dict]:
+    marks = ",".join("?" * len(statuses))
+    rows = conn.execute(
+        f"""SELECT id, provider_id, user_id, credits, amount, currency, status, created_at
+            FROM payments WHERE status IN ({marks}) AND id>? ORDER BY id LIMIT ?""",
+        (*statuses, after_id, limit),
+    ).fetchall()
+    keys = ("id", "provider_id", "user_id", "credits", "amount", "currency", "status", "created_at")
+    return [dict(zip(keys, row, strict=True)) for row in rows]
+
+
+async def pending_payments(
+    *, after_id: int = 0, limit: int = 50, statuses: tuple[str, ...] = ("new", "succeeded")
+) -> list[dict]:
+    """Неприменённые платежи от старых к новым; следующая страница — after_id=<id последнего>."""
+    return await DB.read(lambda c: _pending_payments(c, after_id, limit, statuses))
+
+
+def _spent_in_window(conn: sqlite3.Connection, since: int, until: int, user_id: int | None) -> int:
+    sql = "SELECT COALESCE(SUM(-amount), 0) FROM transactions WHERE type='spend' AND created_at>=? AND created_at<?"
+    params: tuple = (since, until)
+    if user_id is not None:
+        sql += " AND user_id=?"
+        params += (user_id,)
+    return int(conn.execute(sql, params).fetchone()[0])
+
+
+async def spent_in_window(
+    since: int, until: int | None = None, *, user_id: int | None = None
+) -> int:
+    """Сколько кредитов потрачено за [since, until) — всего или одним пользователем."""
+    end = until if until is not None else int(time.time()) + 1
+    return await DB.read(lambda c: _spent_in_window(c, since, end, user_id))
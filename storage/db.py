@@ -0,0 +1,275 @@
+"""
+Асинхронный фасад над SQLite: запросы выполняются вне event loop.
+
+- один выделенный поток-писатель со своим соединением: записи встают в очередь
+  и коммитятся группами (group commit) — всё, что накопилось за время прошлого
+  коммита, до SQLITE_GROUP_COMMIT_MAX операций (SQLITE_GROUP_COMMIT_MS — сколько
+  дополнительно ждать попутчиков, по умолчанию 0); каждая операция — в своём
+  SAVEPOINT, так что ошибка одной не откатывает соседей по группе, а future
+  вызывающего разрешается только после COMMIT (запись уже на диске: писатель
+  работает с synchronous=FULL — fsync WAL на каждый коммит, который group commit
+  делит на всю группу);
+- maintenance(): операции вне транзакции (VACUUM, checkpoint) в той же очереди
+  писателя — между группами, не пересекаясь с ними;
+- пул потоков-читателей, у каждого своё WAL-соединение (чтения идут параллельно);
+- соединения открываются лениво, при первом обращении, а не при импорте.
+"""
+
+import asyncio
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, TypeVar
+
+log = logging.getLogger("db")
+
+T = TypeVar("T")
+
+
+def _pragmas() -> dict[str, str]:
+    """
+    Профиль PRAGMA для бота: WAL, synchronous=FULL, крупный кэш и mmap.
+    why: при NORMAL в WAL последние коммиты могут пропасть при отключении питания,
+    а на них держатся кредиты и платежи. SQLITE_SYNCHRONOUS=NORMAL — на свой риск.
+    """
+    return {
+        "journal_mode": "WAL",
+        "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "FULL"),
+        "cache_size": os.getenv("SQLITE_CACHE_SIZE", "-16000"),  # ~16 МБ
+        "mmap_size": os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+        "busy_timeout": os.getenv("SQLITE_BUSY_TIMEOUT", "5000"),
+        "temp_store": "MEMORY",
+        "foreign_keys": "ON",
+    }
+
+
+def _readers_count() -> int:
+    try:
+        return max(1, int(os.getenv("SQLITE_READERS", "4")))
+    except ValueError:
+        return 4
+
+
+def _group_max() -> int:
+    try:
+        return max(1, int(os.getenv("SQLITE_GROUP_COMMIT_MAX", "256")))
+    except ValueError:
+        return 256
+
+
+def _group_wait() -> float:
+    try:
+        return max(0.0, float(os.getenv("SQLITE_GROUP_COMMIT_MS", "0")) / 1000)
+    except ValueError:
+        return 0.0
+
+
+_STOP = object()
+
+
+def _resolve(fut: asyncio.Future, result: Any, exc: BaseException | None) -> None:
+    if fut.cancelled():
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
+
+
+def migrate(
+    conn: sqlite3.Connection, migrations: list[Callable[[sqlite3.Connection], None]]
+) -> int:
+    """Применяет migrations[user_version:] по порядку, сдвигая PRAGMA user_version; -> версия."""
+    version = conn.execute("PRAGMA user_version;").fetchone()[0]
+    for number, step in enumerate(migrations[version:], start=version + 1):
+        step(conn)
+        conn.execute(f"PRAGMA user_version={number};")
+        log.info("%s: schema migrated to v%d", step.__module__, number)
+        version = number
+    return version
+
+
+def _notify(
+    loop: asyncio.AbstractEventLoop, fut: asyncio.Future, result: Any, exc: BaseException | None
+) -> None:
+    try:
+        loop.call_soon_threadsafe(_resolve, fut, result, exc)
+    except RuntimeError:
+        pass  # why: цикл вызывающего уже закрыт — запись всё равно закоммичена
+
+
+class Database:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._writer_thread: threading.Thread | None = None
+        self._reader_pool: ThreadPoolExecutor | None = None
+        self._writer_conn: sqlite3.Connection | None = None
+        self._local = threading.local()
+        self._conns: list[sqlite3.Connection] = []
+        self._stash: tuple | None = None  # операция maintenance, прервавшая сбор группы
+        self.writes = 0
+        self.commits = 0
+
+    # ── соединения
+    def _connect(self, *, readonly: bool) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        for name, value in _pragmas().items():
+            conn.execute(f"PRAGMA {name}={value};")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON;")
+        with self._lock:
+            self._conns.append(conn)
+        return conn
+
+    def _writer(self) -> sqlite3.Connection:
+        if self._writer_conn is None:
+            self._writer_conn = self._connect(readonly=False)
+        return self._writer_conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect(readonly=True)
+        return conn
+
+    def _start(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._writer_thread is None:
+                self._writer_thread = threading.Thread(
+                    target=self._writer_loop, name="db-writer", daemon=True
+                )
+                self._writer_thread.start()
+                self._reader_pool = ThreadPoolExecutor(
+                    _readers_count(), thread_name_prefix="db-reader"
+                )
+            return self._reader_pool
+
+    # ── group commit
+    def _collect(self, first: tuple) -> tuple[list[tuple], bool]:
+        """Добирает группу за first: до _group_max() операций или _group_wait() секунд."""
+        batch = [first]
+        limit = _group_max()
+        deadline = time.monotonic() + _group_wait()
+        while len(batch) < limit:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            if item[3]:
+                self._stash = item
+                break
+            batch.append(item)
+        return batch, False
+
+    def _commit_batch(self, batch: list[tuple]) -> None:
+        conn = self._writer()
+        outcomes: list[tuple[Any, BaseException | None]] = []
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            for fn, _, _, _ in batch:
+                # why: SAVEPOINT — ошибка одной операции откатывает только её
+                conn.execute("SAVEPOINT op;")
+                try:
+                    result = fn(conn)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op;")
+                    conn.execute("RELEASE op;")
+                    outcomes.append((None, e))
+                else:
+                    conn.execute("RELEASE op;")
+                    outcomes.append((result, None))
+            conn.execute("COMMIT;")
+        except Exception as e:
+            log.exception("group commit of %d ops failed", len(batch))
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            outcomes = [(None, e)] * len(batch)
+        self.writes += len(batch)
+        self.commits += 1
+        for (_, loop, fut, _), (result, exc) in zip(batch, outcomes, strict=True):
+            _notify(loop, fut, result, exc)
+
+    def _run_maintenance(self, item: tuple) -> None:
+        fn, loop, fut, _ = item
+        try:
+            result, exc = fn(self._writer()), None
+        except Exception as e:
+            result, exc = None, e
+        _notify(loop, fut, result, exc)
+
+    def _writer_loop(self) -> None:
+        stop = False
+        while not stop:
+            item, self._stash = self._stash or self._queue.get(), None
+            if item is _STOP:
+                break
+            if item[3]:
+                self._run_maintenance(item)
+                continue
+            batch, stop = self._collect(item)
+            self._commit_batch(batch)
+
+    # ── выполнение
+    def _run_read(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        return fn(self._reader())
+
+    async def write(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """fn(conn) в общей транзакции группы; результат — после COMMIT.
+
+        Операции применяются строго в порядке вызова, поэтому проверки вида
+        «баланс не уходит в минус» внутри fn видят все предыдущие записи.
+        """
+        return await self._submit(fn, raw=False)
+
+    async def maintenance(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """fn(conn) на соединении писателя вне транзакции (VACUUM, PRAGMA, checkpoint)."""
+        return await self._submit(fn, raw=True)
+
+    async def _submit(self, fn: Callable[[sqlite3.Connection], T], *, raw: bool) -> T:
+        self._start()
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._queue.put((fn, loop, fut, raw))
+        return await fut
+
+    async def read(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """fn(conn) на одном из соединений-читателей (параллельно с другими чтениями)."""
+        reader = self._start()
+        return await asyncio.get_running_loop().run_in_executor(reader, self._run_read, fn)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "writes": self.writes,
+            "commits": self.commits,
+            "ops_per_commit": round(self.writes / self.commits, 2) if self.commits else None,
+            "queued": self._queue.qsize(),
+        }
+
+    def close(self) -> None:
+        """Дописывает очередь, останавливает писателя и закрывает соединения."""
+        with self._lock:
+            thread, pool = self._writer_thread, self._reader_pool
+            self._writer_thread = self._reader_pool = None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+        if pool is not None:
+            pool.shutdown(wait=True)
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+        self._writer_conn = None
+        self._local = threading.local()
@@ -0,0 +1,303 @@
+"""
+Постоянная очередь задач генерации (storage/jobs.sqlite3).
+
+Каждая генерация — строка jobs: что делать (kind + payload), кому отправить
+(chat_id), KIE taskId и отпечаток ключа KIE после создания задачи и состояние:
+queued -> submitted (taskId известен) -> delivered | failed.
+Задачи одной пачки (сцены, альбом, одиночный кадр) объединены в batches:
+там резерв кредитов и счётчики для итогового сообщения.
+
+После рестарта незавершённые задачи поднимаются через unfinished() и
+продолжаются: с известным taskId — только ожидание результата, без повторной
+оплаты KIE.
+"""
+
+import json
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from storage.db import Database, migrate
+
+_DB_PATH = Path("storage") / "jobs.sqlite3"
+DB = Database(_DB_PATH)
+
+_OPEN = ("queued", "submitted")
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    batch_id: int
+    user_id: int
+    chat_id: int
+    payload: dict[str, Any]
+    state: str
+    task_id: str | None
+    attempts: int
+    hold_id: int | None  # резерв кредитов пачки
+    klass: str  # класс планировщика: '<paid|bonus>/<single|batch>'
+    kie_key: str | None  # отпечаток ключа KIE, которым создана задача (services.kie_keys)
+
+
+@dataclass
+class Batch:
+    id: int
+    user_id: int
+    chat_id: int
+    hold_id: int | None
+    total: int
+    finished: int
+    sent: int
+    summary: bool  # слать ли итог «Отправлено: N» по завершении
+
+    @property
+    def done(self) -> bool:
+        return self.finished >= self.total
+
+
+def _schema_v1(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+    CREATE TABLE IF NOT EXISTS batches(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        hold_id INTEGER,                   -- резерв в credits.holds
+        total INTEGER NOT NULL,
+        finished INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        summary INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER NOT NULL
+    );"""
+    )
+    conn.execute(
+        """
+    CREATE TABLE IF NOT EXISTS jobs(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        batch_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,                -- 'kie_image'|'kie_album'
+        user_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        payload TEXT NOT NULL,             -- JSON: файлы, промпт, подпись
+        state TEXT NOT NULL,               -- 'queued'|'submitted'|'delivered'|'failed'
+        task_id TEXT,                      -- KIE taskId
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL,
+        FOREIGN KEY(batch_id) REFERENCES batches(id)
+    );"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, id);")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_batch ON jobs(batch_id);")
+
+
+def _schema_v2(conn: sqlite3.Connection) -> None:
+    """Класс задачи для справедливого планировщика (services.fair_queue)."""
+    conn.execute("ALTER TABLE jobs ADD COLUMN klass TEXT NOT NULL DEFAULT 'bonus/batch';")
+
+
+def _schema_v3(conn: sqlite3.Connection) -> None:
+    """Отпечаток ключа KIE: задачу опрашиваем тем же ключом, которым создали."""
+    conn.execute("ALTER TABLE jobs ADD COLUMN kie_key TEXT;")
+
+
+_MIGRATIONS = [_schema_v1, _schema_v2, _schema_v3]
+
+
+async def init_db() -> None:
+    await DB.write(lambda c: migrate(c, _MIGRATIONS))
+
+
+def close_db() -> None:
+    DB.close()
+
+
+_SELECT_JOBS = """SELECT j.id, j.kind, j.batch_id, j.user_id, j.chat_id, j.payload, j.state,
+       j.task_id, j.attempts, b.hold_id, j.klass, j.kie_key
+FROM jobs j JOIN batches b ON b.id = j.batch_id"""
+
+
+def _job(row: tuple) -> Job:
+    payload = json.loads(row[5])
+    return Job(*row[:5], payload, *row[6:])
+
+
+def _enqueue(  # noqa: PLR0913
+    conn: sqlite3.Connection,
+    kind: str,
+    user_id: int,
+    chat_id: int,
+    payloads: list[dict[str, Any]],
+    *,
+    hold_id: int | None,
+    summary: bool,
+    klass: str,
+) -> list[int]:
+    now = int(time.time())
+    batch_id = conn.execute(
+        """INSERT INTO batches(user_id, chat_id, hold_id, total, summary, created_at)
+           VALUES(?,?,?,?,?,?)""",
+        (user_id, chat_id, hold_id, len(payloads), int(summary), now),
+    ).lastrowid
+    return [
+        conn.execute(
+            """INSERT INTO jobs(batch_id, kind, user_id, chat_id, payload, state, klass,
+                                created_at, updated_at)
+               VALUES(?,?,?,?,?,'queued',?,?,?)""",
+            (
+                batch_id,
+                kind,
+                user_id,
+                chat_id,
+                json.dumps(payload, ensure_ascii=False),
+                klass,
+                now,
+                now,
+            ),
+        ).lastrowid
+        for payload in payloads
+    ]
+
+
+async def enqueue(  # noqa: PLR0913
+    kind: str,
+    user_id: int,
+    chat_id: int,
+    payloads: list[dict[str, Any]],
+    *,
+    hold_id: int | None = None,
+    summary: bool = False,
+    klass: str = "bonus/batch",
+) -> list[int]:
+    """Создаёт пачку из len(payloads) задач; -> id задач (порядок как у payloads)."""
+    return await DB.write(
+        lambda c: _enqueue(
+            c, kind, user_id, chat_id, payloads, hold_id=hold_id, summary=summary, klass=klass
+        )
+    )
+
+
+async def get(job_id: int) -> Job | None:
+    row = await DB.read(lambda c: c.execute(f"{_SELECT_JOBS} WHERE j.id=?", (job_id,)).fetchone())
+    return _job(row) if row else None
+
+
+async def unfinished() -> list[Job]:
+    """Незавершённые задачи в порядке создания — для возобновления после рестарта."""
+    rows = await DB.read(
+        lambda c: c.execute(
+            f"{_SELECT_JOBS} WHERE j.state IN (?,?) ORDER BY j.id", _OPEN
+        ).fetchall()
+    )
+    return [_job(row) for row in rows]
+
+
+async def open_hold_ids() -> list[int]:
+    """Резервы кредитов пачек, в которых ещё есть незавершённые задачи."""
+    rows = await DB.read(
+        lambda c: c.execute(
+            "SELECT DISTINCT hold_id FROM batches WHERE finished < total AND hold_id IS NOT NULL"
+        ).fetchall()
+    )
+    return [row[0] for row in rows]
+
+
+async def mark_started(job_id: int) -> int:
+    """Учитывает попытку выполнения; -> номер попытки (1 — первая)."""
+
+    def op(conn: sqlite3.Connection) -> int:
+        conn.execute(
+            "UPDATE jobs SET attempts=attempts+1, updated_at=? WHERE id=?",
+            (int(time.time()), job_id),
+        )
+        return conn.execute("SELECT attempts FROM jobs WHERE id=?", (job_id,)).fetchone()[0]
+
+    return await DB.write(op)
+
+
+async def unmark_started(job_id: int) -> None:
+    """Возвращает попытку, прерванную остановкой процесса (это не сбой задачи)."""
+    await DB.write(
+        lambda c: c.execute(
+            "UPDATE jobs SET attempts=MAX(0, attempts-1), updated_at=? WHERE id=?",
+            (int(time.time()), job_id),
+        )
+    )
+
+
+async def set_task(job_id: int, task_id: str, kie_key: str | None = None) -> None:
+    await DB.write(
+        lambda c: c.execute(
+            "UPDATE jobs SET task_id=?, kie_key=?, state='submitted', updated_at=? WHERE id=?",
+            (task_id, kie_key, int(time.time()), job_id),
+        )
+    )
+
+
+def _finish(conn: sqlite3.Connection, job_id: int, ok: bool, error: str | None) -> Batch | None:
+    cur = conn.execute(
+        "UPDATE jobs SET state=?, error=?, updated_at=? WHERE id=? AND state IN (?,?)",
+        ("delivered" if ok else "failed", error, int(time.time()), job_id, *_OPEN),
+    )
+    if cur.rowcount == 0:
+        return None  # why: уже завершена (повторная доставка после рестарта)
+    batch_id = conn.execute("SELECT batch_id FROM jobs WHERE id=?", (job_id,)).fetchone()[0]
+    conn.execute(
+        "UPDATE batches SET finished=finished+1, sent=sent+? WHERE id=?", (int(ok), batch_id)
+    )
+    row = conn.execute(
+        """SELECT id, user_id, chat_id, hold_id, total, finished, sent, summary
+           FROM batches WHERE id=?""",
+        (batch_id,),
+    ).fetchone()
+    return Batch(*row[:7], summary=bool(row[7]))
+
+
+async def finish(job_id: int, *, ok: bool, error: str | None = None) -> Batch | None:
+    """
+    Закрывает задачу и возвращает её пачку со свежими счётчиками (или None, если
+    задача уже была закрыта). Ровно один вызов увидит batch.done — он и подводит итог.
+    """
+    return await DB.write(lambda c: _finish(c, job_id, ok, error))
+
+
+async def stats() -> dict[str, int]:
+    rows = await DB.read(
+        lambda c: c.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+    )
+    return dict(rows)
+
+
+def _purge(conn: sqlite3.Connection, before: int) -> int:
+    old = [
+        row[0]
+        for row in conn.execute(
+            """SELECT id FROM batches WHERE created_at < ? AND finished >= total LIMIT 1000""",
+            (before,),
+        ).fetchall()
+    ]
+    conn.executemany("DELETE FROM jobs WHERE batch_id=?", [(b,) for b in old])
+    conn.executemany("DELETE FROM batches WHERE id=?", [(b,) for b in old])
+    return len(old)
+
+
+def _keep_seconds() -> float:
+    try:
+        return float(os.getenv("JOBS_KEEP_DAYS", "7")) * 86400
+    except ValueError:
+        return 7 * 86400
+
+
+async def purge() -> int:
+    """Удаляет завершённые пачки старше JOBS_KEEP_DAYS (по 1000 за проход); -> сколько удалено."""
+    before = int(time.time() - _keep_seconds())
+    removed = 0
+    while n := await DB.write(lambda c: _purge(c, before)):
+        removed += n
+    return removed
@@ -0,0 +1,171 @@
+"""
+Компакция журнала кредитов (таблица transactions).
+
+Строки старше LEDGER_KEEP_DAYS сворачиваются в снимки: одна строка на
+(пользователь, месяц, тип) с суммой amount и meta='snapshot:YYYY-MM'. Сумма
+по пользователю не меняется, так что баланс по журналу восстанавливается
+точно. Детальные строки перед удалением дописываются в сжатый архив
+LEDGER_ARCHIVE_DIR/YYYY/MM/YYYY-MM-DD.jsonl.gz.
+
+Работает онлайн: чтение кандидатов идёт через читателей, удаление — небольшими
+пачками (LEDGER_COMPACT_BATCH) через общую очередь писателя, так что
+spend_credits ждёт не дольше одной пачки. Затем место возвращается
+инкрементальным VACUUM по LEDGER_VACUUM_PAGES страниц за шаг.
+"""
+
+import asyncio
+import calendar
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any
+
+from storage.credits import DB
+from utils.config import env_int
+
+log = logging.getLogger("ledger")
+
+_SNAPSHOT = "snapshot:"
+
+
+def _archive_dir() -> Path:
+    return Path(os.getenv("LEDGER_ARCHIVE_DIR", str(Path("storage") / "ledger_archive")))
+
+
+def _month(ts: int) -> str:
+    return time.strftime("%Y-%m", time.gmtime(ts))
+
+
+def _month_start(month: str) -> int:
+    return calendar.timegm(time.strptime(month + "-01", "%Y-%m-%d"))
+
+
+def _is_snapshot(meta: str | None) -> bool:
+    return bool(meta) and meta.startswith(_SNAPSHOT)
+
+
+# ── архив
+def _write_archive(rows: list[tuple]) -> None:
+    """Дописывает строки в gzip по дням; повтор после сбоя даст дубли, id их различает."""
+    by_day: dict[str, list[tuple]] = defaultdict(list)
+    for row in rows:
+        by_day[time.strftime("%Y-%m-%d", time.gmtime(row[5]))].append(row)
+    keys = ("id", "user_id", "type", "amount", "meta", "created_at")
+    for day, day_rows in by_day.items():
+        path = _archive_dir() / day[:4] / day[5:7] / f"{day}.jsonl.gz"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # why: каждый вызов — отдельный gzip-member, gzip/zcat читают их подряд
+        with open(path, "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+                for row in day_rows:
+                    line = json.dumps(dict(zip(keys, row, strict=True)), ensure_ascii=False)
+                    gz.write(line.encode("utf-8") + b"\n")
+            raw.flush()
+            os.fsync(raw.fileno())  # архив на диске до удаления строк из БД
+
+
+# ── свёртка
+_SnapshotKey = tuple[int, str, str]  # (user_id, type, meta)
+
+
+def _snapshot_ids(conn: sqlite3.Connection) -> dict[_SnapshotKey, int]:
+    rows = conn.execute(
+        "SELECT id, user_id, type, meta FROM transactions WHERE meta LIKE ?", (_SNAPSHOT + "%",)
+    ).fetchall()
+    return {(user_id, type_, meta): id_ for id_, user_id, type_, meta in rows}
+
+
+def _fold(conn: sqlite3.Connection, rows: list[tuple], snapshots: dict[_SnapshotKey, int]) -> int:
+    """Удаляет rows и прибавляет их суммы к снимкам; snapshots — id снимков, дополняется."""
+    totals: dict[tuple[int, str, str], int] = defaultdict(int)
+    for _, user_id, type_, amount, _, created_at in rows:
+        totals[(user_id, type_, _month(created_at))] += amount
+    conn.executemany("DELETE FROM transactions WHERE id=?", [(row[0],) for row in rows])
+    for (user_id, type_, month), amount in totals.items():
+        key = (user_id, type_, _SNAPSHOT + month)
+        snap_id = snapshots.get(key)
+        # why: обновление по id — точечное; поиск снимка по meta сканировал бы строки юзера
+        if snap_id is not None:
+            cur = conn.execute(
+                "UPDATE transactions SET amount=amount+? WHERE id=?", (amount, snap_id)
+            )
+            if cur.rowcount:
+                continue
+        snapshots[key] = conn.execute(
+            "INSERT INTO transactions(user_id, type, amount, meta, created_at) VALUES(?,?,?,?,?)",
+            (user_id, type_, amount, key[2], _month_start(month)),
+        ).lastrowid
+    return len(rows)
+
+
+def _scan(conn: sqlite3.Connection, after_id: int, limit: int) -> list[tuple]:
+    return conn.execute(
+        """SELECT id, user_id, type, amount, meta, created_at FROM transactions
+           WHERE id>? ORDER BY id LIMIT ?""",
+        (after_id, limit),
+    ).fetchall()
+
+
+async def compact(now: int | None = None) -> dict[str, Any]:
+    """Сворачивает строки старше LEDGER_KEEP_DAYS; -> {"archived": n, "freed_pages": m}."""
+    cutoff = (now or int(time.time())) - env_int("LEDGER_KEEP_DAYS", 90) * 86400
+    batch = max(1, env_int("LEDGER_COMPACT_BATCH", 200))
+    archived = 0
+    after_id = 0
+    done = False
+    snapshots = await DB.read(_snapshot_ids)
+    while not done:
+        rows = await DB.read(lambda c, a=after_id: _scan(c, a, batch))
+        if not rows:
+            break
+        after_id = rows[-1][0]
+        old: list[tuple] = []
+        for row in rows:
+            if _is_snapshot(row[4]):
+                continue
+            if row[5] >= cutoff:
+                # why: id растут вместе со временем — дальше только свежие строки
+                done = True
+                break
+            old.append(row)
+        if old:
+            await asyncio.to_thread(_write_archive, old)
+            archived += await DB.write(lambda c, r=old: _fold(c, r, snapshots))
+    freed = await vacuum() if archived else 0
+    if archived:
+        log.info("ledger compaction: archived %d rows, freed %d pages", archived, freed)
+    return {"archived": archived, "freed_pages": freed}
+
+
+def _vacuum_step(conn: sqlite3.Connection, pages: int) -> int:
+    before = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+    # why: через execute() sqlite3 делает один шаг прагмы (1 страница), executescript — все
+    conn.executescript(f"PRAGMA incremental_vacuum({pages});")
+    return before - conn.execute("PRAGMA freelist_count;").fetchone()[0]
+
+
+async def vacuum() -> int:
+    """Инкрементальный VACUUM шагами + усечение WAL; -> число освобождённых страниц."""
+    step = max(1, env_int("LEDGER_VACUUM_PAGES", 512))
+    freed = 0
+    while True:
+        # why: шаг 0 — список пуст или база не в режиме auto_vacuum=INCREMENTAL
+        done = await DB.maintenance(lambda c: _vacuum_step(c, step))
+        if done <= 0:
+            break
+        freed += done
+    await DB.maintenance(lambda c: c.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall())
+    return freed
+
+
+def compact_interval() -> float:
+    """Период компакции в секундах (LEDGER_COMPACT_INTERVAL_HOURS, 0 — выключено)."""
+    try:
+        return float(os.getenv("LEDGER_COMPACT_INTERVAL_HOURS", "24")) * 3600
+    except ValueError:
+        return 24 * 3600
@@ -0,0 +1,225 @@
+"""
+Кэш результатов генерации, адресуемый по содержимому запроса.
+
+Ключ — sha256 от (file_unique_id исходника, промпт, модель, extra_input,
+параметры вывода). Файлы лежат в storage/result_cache/, индекс — в SQLite рядом.
+Вытеснение: по возрасту (RESULT_CACHE_MAX_AGE_DAYS) и по суммарному размеру
+(RESULT_CACHE_MAX_BYTES, сначала давно не использованные).
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any
+
+log = logging.getLogger("result_cache")
+
+_DIR = Path("storage") / "result_cache"
+_DB_PATH = Path("storage") / "result_cache.sqlite3"
+_LOCK = threading.RLock()
+_CONN: dict[str, sqlite3.Connection] = {}
+
+# Счётчики для мониторинга (/cachestats)
+STATS: dict[str, int] = {
+    "hits": 0,
+    "misses": 0,
+    "phash_hits": 0,
+    "stores": 0,
+    "evictions": 0,
+}
+
+
+def is_enabled() -> bool:
+    return os.getenv("RESULT_CACHE", "1") == "1"
+
+
+def _max_bytes() -> int:
+    try:
+        return int(os.getenv("RESULT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+    except ValueError:
+        return 1024 * 1024 * 1024
+
+
+def _max_age() -> int:
+    try:
+        return int(float(os.getenv("RESULT_CACHE_MAX_AGE_DAYS", "30")) * 86400)
+    except ValueError:
+        return 30 * 86400
+
+
+def _conn() -> sqlite3.Connection:
+    conn = _CONN.get("db")
+    if conn is None:
+        _DIR.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(_DB_PATH, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute(
+            """
+        CREATE TABLE IF NOT EXISTS entries(
+            key TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            last_hit_at INTEGER NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        );"""
+        )
+        # Перцептивные хэши исходников (services/phash_index), хэш — знаковый int64
+        conn.execute(
+            """
+        CREATE TABLE IF NOT EXISTS phash(
+            hash INTEGER NOT NULL,
+            prompt_key TEXT NOT NULL,
+            cache_key TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            PRIMARY KEY(prompt_key, hash)
+        );"""
+        )
+        _CONN["db"] = conn
+    return conn
+
+
+def make_key(**parts: Any) -> str:
+    """Стабильный ключ кэша из частей запроса (порядок аргументов не важен)."""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _lookup(key: str) -> Path | None:
+    now = int(time.time())
+    with _LOCK:
+        conn = _conn()
+        row = conn.execute(
+            "SELECT filename, created_at FROM entries WHERE key=?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        filename, created_at = row
+        path = _DIR / filename
+        if now - created_at > _max_age() or not path.exists():
+            _drop(conn, key, filename)
+            STATS["evictions"] += 1
+            return None
+        conn.execute("UPDATE entries SET last_hit_at=?, hits=hits+1 WHERE key=?", (now, key))
+        return path
+
+
+def _store(key: str, data: bytes, suffix: str) -> Path:
+    filename = f"{key}{suffix}"
+    path = _DIR / filename
+    tmp = _DIR / f".{filename}.{uuid.uuid4().hex}.part"
+    now = int(time.time())
+    with _LOCK:
+        conn = _conn()
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        old = conn.execute("SELECT filename FROM entries WHERE key=?", (key,)).fetchone()
+        if old is not None and old[0] != filename:
+            # why: у ключа был файл с другим расширением — после REPLACE его никто не учтёт
+            (_DIR / old[0]).unlink(missing_ok=True)
+        conn.execute(
+            """INSERT OR REPLACE INTO entries(key, filename, size, created_at, last_hit_at, hits)
+                         VALUES(?,?,?,?,?,0)""",
+            (key, filename, len(data), now, now),
+        )
+        _evict(conn, now)
+    return path
+
+
+def _drop(conn: sqlite3.Connection, key: str, filename: str) -> None:
+    # why: STATS["evictions"] растёт после каждого _drop — по нему services.phash_index
+    # понимает, что его BK-деревья ссылаются на удалённые ключи, и перестраивает их
+    conn.execute("DELETE FROM entries WHERE key=?", (key,))
+    conn.execute("DELETE FROM phash WHERE cache_key=?", (key,))
+    (_DIR / filename).unlink(missing_ok=True)
+
+
+def _evict(conn: sqlite3.Connection, now: int) -> None:
+    cutoff = now - _max_age()
+    victims: list[tuple[str, str]] = conn.execute(
+        "SELECT key, filename FROM entries WHERE created_at < ?", (cutoff,)
+    ).fetchall()
+    total = conn.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM entries WHERE created_at >= ?", (cutoff,)
+    ).fetchone()[0]
+    limit = _max_bytes()
+    if total > limit:
+        for key, filename, size in conn.execute(
+            "SELECT key, filename, size FROM entries WHERE created_at >= ? ORDER BY last_hit_at",
+            (cutoff,),
+        ).fetchall():
+            if total <= limit:
+                break
+            victims.append((key, filename))
+            total -= size
+    for key, filename in victims:
+        _drop(conn, key, filename)
+    if victims:
+        STATS["evictions"] += len(victims)
+        log.info("result cache: evicted %d entries", len(victims))
+
+
+async def get(key: str, *, count: bool = True) -> Path | None:
+    """Путь к закэшированному результату или None (count — учитывать в hit/miss)."""
+    path = await asyncio.to_thread(_lookup, key)
+    if count:
+        STATS["hits" if path is not None else "misses"] += 1
+    return path
+
+
+def note_phash_hit() -> None:
+    """Точный поиск промахнулся, но нашёлся почти-дубликат — считаем как hit."""
+    STATS["misses"] -= 1
+    STATS["hits"] += 1
+    STATS["phash_hits"] += 1
+
+
+async def put(key: str, data: bytes, suffix: str) -> Path:
+    path = await asyncio.to_thread(_store, key, data, suffix)
+    STATS["stores"] += 1
+    return path
+
+
+async def put_file(key: str, src: Path) -> Path:
+    data = await asyncio.to_thread(src.read_bytes)
+    return await put(key, data, src.suffix)
+
+
+def _to_signed(h: int) -> int:
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+
+def add_phash(h: int, prompt_key: str, cache_key: str) -> None:
+    with _LOCK:
+        _conn().execute(
+            "INSERT OR REPLACE INTO phash(hash, prompt_key, cache_key, created_at) VALUES(?,?,?,?)",
+            (_to_signed(h), prompt_key, cache_key, int(time.time())),
+        )
+
+
+def phash_rows() -> list[tuple[int, str, str]]:
+    """Все (hash, prompt_key, cache_key) с хэшем в беззнаковом виде."""
+    with _LOCK:
+        rows = _conn().execute("SELECT hash, prompt_key, cache_key FROM phash").fetchall()
+    return [(h & ((1 << 64) - 1), pk, ck) for h, pk, ck in rows]
+
+
+def stats() -> dict[str, Any]:
+    with _LOCK:
+        count, size = (
+            _conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        )
+    lookups = STATS["hits"] + STATS["misses"]
+    return {
+        **STATS,
+        "entries": count,
+        "bytes": size,
+        "hit_rate": round(STATS["hits"] / lookups, 3) if lookups else None,
+    }
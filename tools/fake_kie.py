@@ -0,0 +1,121 @@
+"""
+Локальный фейковый KIE для ручной проверки бота без реального провайдера.
+
+Запуск:  python -m tools.fake_kie --port 8090 --delay 5
+В .env:  KIE_API_BASE=http://127.0.0.1:8090  KIE_API_KEY=fake
+
+Эмулирует createTask / recordInfo, через --delay секунд переводит задачу
+в success и, если в createTask был callBackUrl, шлёт на него callback.
+Результат — маленький PNG, который отдаётся с этого же сервера.
+Задача видна только ключу, которым создана (как у аккаунтов KIE);
+ключам из --broke-keys createTask отвечает code=402 (нет кредитов).
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import time
+import uuid
+
+import httpx
+from aiohttp import web
+
+# 1×1 прозрачный PNG
+_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+
+class FakeKIE:
+    def __init__(
+        self, *, delay: float, fail_every: int = 0, broke_keys: frozenset[str] = frozenset()
+    ) -> None:
+        self.delay = delay
+        self.fail_every = fail_every
+        self.broke_keys = broke_keys
+        self.tasks: dict[str, dict] = {}
+        self.created = 0
+        self.polls = 0
+
+    def _record(self, task_id: str, base: str) -> dict:
+        t = self.tasks[task_id]
+        done = time.monotonic() >= t["ready_at"]
+        data: dict = {
+            "taskId": task_id,
+            "model": t["model"],
+            "state": "generating",
+            "createTime": t["created_ms"],
+        }
+        if done and t["fail"]:
+            data.update(state="fail", failCode="500", failMsg="fake failure")
+        elif done:
+            data.update(
+                state="success",
+                completeTime=t["created_ms"] + int(self.delay * 1000),
+                costTime=int(self.delay * 1000),
+                resultJson=json.dumps({"resultUrls": [f"{base}/files/{task_id}.png"]}),
+            )
+        return {"code": 200, "msg": "success", "data": data}
+
+    async def create_task(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        key = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if key in self.broke_keys:
+            return web.json_response({"code": 402, "msg": "Credits insufficient"})
+        self.created += 1
+        task_id = uuid.uuid4().hex
+        self.tasks[task_id] = {
+            "key": key,
+            "model": body.get("model"),
+            "ready_at": time.monotonic() + self.delay,
+            "created_ms": int(time.time() * 1000),
+            "fail": bool(self.fail_every and self.created % self.fail_every == 0),
+        }
+        if body.get("callBackUrl"):
+            base = f"{request.scheme}://{request.host}"
+            asyncio.create_task(self._callback(body["callBackUrl"], task_id, base))
+        return web.json_response({"code": 200, "msg": "success", "data": {"taskId": task_id}})
+
+    async def _callback(self, url: str, task_id: str, base: str) -> None:
+        await asyncio.sleep(self.delay)
+        async with httpx.AsyncClient(timeout=10) as client:
+            await client.post(url, json=self._record(task_id, base))
+
+    async def record_info(self, request: web.Request) -> web.Response:
+        self.polls += 1
+        task_id = request.query.get("taskId", "")
+        key = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if task_id not in self.tasks or self.tasks[task_id]["key"] != key:
+            return web.json_response({"code": 404, "msg": "task not found"})
+        return web.json_response(self._record(task_id, f"{request.scheme}://{request.host}"))
+
+    async def file(self, request: web.Request) -> web.Response:
+        return web.Response(body=_PNG, content_type="image/png")
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/v1/jobs/createTask", self.create_task)
+        app.router.add_get("/api/v1/jobs/recordInfo", self.record_info)
+        app.router.add_get("/files/{name}", self.file)
+        return app
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Fake KIE server")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8090)
+    ap.add_argument("--delay", type=float, default=5.0, help="секунд до success")
+    ap.add_argument("--fail-every", type=int, default=0, help="каждая N-я задача — fail")
+    ap.add_argument("--broke-keys", default="", help="ключи без кредитов, через запятую")
+    args = ap.parse_args()
+    fake = FakeKIE(
+        delay=args.delay,
+        fail_every=args.fail_every,
+        broke_keys=frozenset(k for k in args.broke_keys.split(",") if k),
+    )
+    web.run_app(fake.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Фейковые уведомления YooKassa для ручной проверки webhook'а без реальной оплаты.
+
+Запуск:  python -m tools.fake_yk_notify --payment-id <id> --repeat 3
+В .env бота:  WEBHOOK_PORT=8080  YK_SHOP_ID=...  YK_SECRET=...  YK_WEBHOOK_IP_CHECK=0
+
+Шлёт payment.succeeded (или --event canceled) на webhook бота. Сумма, валюта и
+user_id берутся из строки payments в storage/credits.sqlite3 — как у настоящего
+уведомления; --amount подменяет сумму (проверка отказа). С --register платёж
+сначала заводится в БД (--user-id, --credits, --rub), как после «Купить».
+--repeat N шлёт одно и то же уведомление N раз: начислить должно ровно один.
+
+Бот начисляет только по статусу из API YooKassa, поэтому для проверки
+начисления нужен настоящий платёж тестового магазина: «Купить» в боте,
+оплата тестовой картой, затем --payment-id этого платежа. Уведомление о
+выдуманном платеже (--register) начислить ничего не должно — бот ответит 503
+(API не знает такой платёж), и это тоже проверка.
+"""
+
+import argparse
+import asyncio
+import uuid
+
+import httpx
+
+from storage.credits import BALANCES, ensure_user, get_balance, get_payment, register_payment
+
+
+async def _run(args: argparse.Namespace) -> None:
+    provider_id = args.payment_id or f"fake-{uuid.uuid4()}"
+    if args.register:
+        await ensure_user(args.user_id)
+        await register_payment(provider_id, args.user_id, args.credits, args.rub * 100, "RUB")
+    row = await get_payment(provider_id)
+    if row is None:
+        raise SystemExit(f"Платёж {provider_id} не найден в payments (нужен --register?)")
+    value = args.amount if args.amount is not None else f"{row['amount'] / 100:.2f}"
+    status = "succeeded" if args.event == "succeeded" else "canceled"
+    notification = {
+        "type": "notification",
+        "event": f"payment.{status}",
+        "object": {
+            "id": provider_id,
+            "status": status,
+            "paid": status == "succeeded",
+            "amount": {"value": value, "currency": row["currency"]},
+            "metadata": {"user_id": row["user_id"], "credits": row["credits"]},
+        },
+    }
+    params = {"token": args.token} if args.token else None
+    async with httpx.AsyncClient(timeout=10) as client:
+        for i in range(args.repeat):
+            r = await client.post(args.url, json=notification, params=params)
+            print(f"#{i + 1} {notification['event']} {provider_id} -> {r.status_code}")
+    row = await get_payment(provider_id)
+    BALANCES.drop(row["user_id"])  # why: начислял бот в своём процессе — кэш этого устарел
+    print(
+        f"payments.status={row['status']}  "
+        f"баланс user {row['user_id']}: {await get_balance(row['user_id'])}"
+    )
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Fake YooKassa notifier")
+    ap.add_argument("--url", default="http://127.0.0.1:8080/yookassa/notify")
+    ap.add_argument("--payment-id", default="", help="provider_id платежа из payments")
+    ap.add_argument("--event", choices=("succeeded", "canceled"), default="succeeded")
+    ap.add_argument("--amount", default=None, help="сумма в уведомлении, напр. 199.00")
+    ap.add_argument("--token", default="", help="YK_WEBHOOK_SECRET бота")
+    ap.add_argument("--repeat", type=int, default=1, help="сколько раз доставить")
+    ap.add_argument("--register", action="store_true", help="сначала завести платёж в БД")
+    ap.add_argument("--user-id", type=int, default=1)
+    ap.add_argument("--credits", type=int, default=10)
+    ap.add_argument("--rub", type=int, default=100)
+    asyncio.run(_run(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -37,6 +37,21 @@ def _parse_buy_packs(env: str) -> list[tuple[int, int]]:
     return res or DEFAULT_BUY_PACKS
 
 
+def env_float(name: str, default: float) -> float:
+    """Число из окружения на момент вызова (без перезапуска); кривое значение — default."""
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
 @dataclass
 class Config:
     # базовые
@@ -54,6 +69,14 @@ class Config:
     tnb_default_prompt: str = "fashion model walking"
     kie_scenes_limit: int = 7
 
+    # параллельная генерация сцен
+    scenes_parallel: bool = True
+    kie_max_inflight: int = 8
+    kie_max_inflight_per_user: int = 3
+
+    # кэш результатов: сколько кредитов списывать при попадании
+    cache_hit_cost: int = 1
+
     # платежи/кредиты
     welcome_credits: int = 5
     buy_packs: list[tuple[int, int]] = None
@@ -78,6 +101,20 @@ class Config:
         except ValueError:
             self.kie_scenes_limit = 7
 
+        self.scenes_parallel = os.getenv("SCENES_PARALLEL", "1") == "1"
+        try:
+            self.kie_max_inflight = int(os.getenv("KIE_MAX_INFLIGHT", "8"))
+        except ValueError:
+            self.kie_max_inflight = 8
+        try:
+            self.kie_max_inflight_per_user = int(os.getenv("KIE_MAX_INFLIGHT_PER_USER", "3"))
+        except ValueError:
+            self.kie_max_inflight_per_user = 3
+        try:
+            self.cache_hit_cost = max(0, int(os.getenv("CACHE_HIT_COST", "1")))
+        except ValueError:
+            self.cache_hit_cost = 1
+
         try:
             self.welcome_credits = int(os.getenv("WELCOME_CREDITS", "5"))
         except ValueError:
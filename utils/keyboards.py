@@ -35,3 +35,10 @@ def scenes_keyboard(scenes: list[list[tuple[str, str, str]]]) -> InlineKeyboardM
         )
     rows.append([InlineKeyboardButton(text="Отмена", callback_data="scene:cancel")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def more_keyboard(callback_data: str) -> InlineKeyboardMarkup:
+    """Одна кнопка «Ещё» для постраничных списков."""
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="Ещё ▸", callback_data=callback_data)]]
+    )